@@ -1,5 +1,6 @@
 from .nagios import (States, STATE_OK, STATE_WARNING, STATE_CRITICAL, STATE_UNKNOWN)
 from .nsca import NscaSender, log
+from . import pool
 
 # make pyflakes happy
 States = States
@@ -9,7 +10,7 @@ __version__ = ".".join(map(str, version_info)) + '-yelp1'
 __author__ = "James Brown <jbrown@yelp.com>"
 
 
-def send_nsca(status, host_name, service_name, text_output, remote_host, **kwargs):
+def send_nsca(status, host_name, service_name, text_output, remote_host, pooled=True, **kwargs):
     """Helper function to easily send a NSCA message (wraps .nsca.NscaSender)
 
     Arguments:
@@ -18,13 +19,18 @@ def send_nsca(status, host_name, service_name, text_output, remote_host, **kwarg
         service_name: Service to report as
         text_output: Freeform text, should be under 512b
         remote_host: Host name to send to
+        pooled: If true (the default), reuse a connected sender from the
+                process-wide pool.default_pool instead of connecting just for this message
 
         All other arguments are passed to the NscaSender constructor
     """
     try:
-        n = NscaSender(remote_host=remote_host, **kwargs)
-        n.send_service(host_name, service_name, status, text_output)
-        n.disconnect()
+        if pooled:
+            pool.default_pool.send_service(remote_host, host_name, service_name, status, text_output, **kwargs)
+        else:
+            n = NscaSender(remote_host=remote_host, **kwargs)
+            n.send_service(host_name, service_name, status, text_output)
+            n.disconnect()
     except Exception as e:
         log.error("Unable to send NSCA packet to %s for %s:%s (%s)", remote_host, host_name, service_name, str(e))
 
@@ -0,0 +1,203 @@
+"""
+An asyncio-native NSCA sender, for submitting results from inside an event
+loop without pushing a blocking NscaSender off to a thread.
+
+Requires Python 3.7 or later.
+"""
+
+import asyncio
+import socket
+import struct
+import time
+
+from .nsca import DEFAULT_CONFIG_PATH, DEFAULT_PORT, PADDING_POOL, NscaSender, _init_packet_format, _init_packet_size, log
+
+
+class _AsyncConnection(object):
+    def __init__(self, addrinfo, reader, writer, iv, timestamp, crypter):
+        self.addrinfo = addrinfo
+        self.reader = reader
+        self.writer = writer
+        self.iv = iv
+        self.timestamp = timestamp
+        self.crypter = crypter
+        self.handshake_time = time.time()
+
+    def packet_timestamp(self):
+        # see NscaSender._packet_timestamp
+        return self.timestamp + int(time.time() - self.handshake_time)
+
+    def is_closed(self):
+        # nsca never writes after the init packet, so EOF means it hung up
+        return self.writer.is_closing() or self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncNscaSender(object):
+    """Like NscaSender, but connect(), send_service(), send_host(),
+    send_many() and disconnect() are coroutines.
+
+    Every address remote_host resolves to is connected to and handshaken
+    with concurrently, and packets are written to all of them concurrently;
+    to talk to several NSCA servers at once, gather() the calls of several
+    AsyncNscaSenders."""
+
+    def __init__(self, remote_host, config_path=DEFAULT_CONFIG_PATH, port=DEFAULT_PORT, timeout=10, send_to_all=True,
+                 padding=PADDING_POOL, reconnect_backoff=0.5, max_reconnect_backoff=30):
+        """Constructor
+
+        Takes the same arguments as NscaSender. The config file is read
+        (synchronously) right here. A broken connection is always
+        reconnected, backing off like NscaSender's while that keeps failing.
+        """
+        # configuration, validation and packet building are shared with
+        # the blocking sender, which never connects
+        self._sender = NscaSender(
+            remote_host,
+            config_path=config_path,
+            port=port,
+            timeout=timeout,
+            send_to_all=send_to_all,
+            padding=padding,
+            reconnect=False,
+            reconnect_backoff=reconnect_backoff,
+            max_reconnect_backoff=max_reconnect_backoff,
+        )
+        self.remote_host = remote_host
+        self.port = port
+        # 0 means no timeout, as it does for NscaSender
+        self.timeout = timeout or None
+        self.send_to_all = send_to_all
+        self._conns = []
+        self._connect_lock = None
+
+    async def _open(self, addrinfo):
+        family, socktype, proto, sockaddr = addrinfo
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(sockaddr[0], sockaddr[1], family=family, proto=proto),
+            self.timeout,
+        )
+        try:
+            init_packet = await asyncio.wait_for(reader.readexactly(_init_packet_size), self.timeout)
+        except BaseException:
+            writer.close()
+            raise
+        iv, timestamp = struct.unpack(_init_packet_format, init_packet)
+        crypter = self._sender.Crypter(iv, self._sender.password, self._sender.random_generator)
+        return _AsyncConnection(addrinfo, reader, writer, iv, timestamp, crypter)
+
+    async def connect(self):
+        if self._conns:
+            return
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._conns:
+                return
+            loop = asyncio.get_running_loop()
+            addrinfos = [
+                (family, socktype, proto, sockaddr)
+                for (family, socktype, proto, canonname, sockaddr) in await loop.getaddrinfo(
+                    self.remote_host, self.port, family=socket.AF_UNSPEC, type=socket.SOCK_STREAM)
+            ]
+            if self.send_to_all:
+                results = await asyncio.gather(*[self._open(addrinfo) for addrinfo in addrinfos], return_exceptions=True)
+            else:
+                results = []
+                for addrinfo in addrinfos:
+                    try:
+                        results.append(await self._open(addrinfo))
+                        break
+                    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                        results.append(e)
+            for result in results:
+                if isinstance(result, BaseException) and not isinstance(result, Exception):
+                    raise result
+                elif isinstance(result, Exception):
+                    log.debug("could not connect to %s:%d: %r", self.remote_host, self.port, result)
+            conns = [result for result in results if isinstance(result, _AsyncConnection)]
+            if not conns:
+                raise socket.error("could not connect to %s:%d" % (self.remote_host, self.port))
+            self._conns = conns
+
+    async def _write(self, conn, make_payload):
+        if conn.is_closed():
+            raise ConnectionError("connection is closed")
+        conn.writer.write(make_payload(conn))
+        await asyncio.wait_for(conn.writer.drain(), self.timeout)
+
+    async def _send_one(self, index, make_payload):
+        conn = self._conns[index]
+        try:
+            await self._write(conn, make_payload)
+            return
+        except (OSError, asyncio.TimeoutError) as e:
+            log.warning("connection to %s:%d broken (%r); reconnecting", self.remote_host, self.port, e)
+            conn.close()
+        # the backoff is kept by the blocking sender, per connection slot
+        self._sender._check_reconnect_backoff(index)
+        try:
+            new_conn = await self._open(conn.addrinfo)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            self._sender._reconnect_failed(index)
+            raise socket.error("could not reconnect to %s:%d: %r" % (self.remote_host, self.port, e))
+        self._sender._reconnect_succeeded(index)
+        conn = self._conns[index] = new_conn
+        await self._write(conn, make_payload)
+
+    async def _send_to_conns(self, make_payload):
+        results = await asyncio.gather(
+            *[self._send_one(index, make_payload) for index in range(len(self._conns))],
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def send_service(self, host, service, state, description):
+        self._sender._check_alert(host=host, service=service, state=state, description=description)
+        await self.connect()
+        builder = self._sender._packet_builder
+
+        def make_packet(conn):
+            packet = builder.build(host, service, state, description, conn.packet_timestamp())
+            return conn.crypter.encrypt(packet)
+        await self._send_to_conns(make_packet)
+
+    async def send_host(self, host, state, description):
+        return await self.send_service(host, b'', state, description)
+
+    async def send_many(self, results, chunk_size=1000):
+        """Send a batch of results; see NscaSender.send_many"""
+        errors = []
+        for chunk in self._sender._chunk_results(results, chunk_size, errors):
+            await self.connect()
+            packed = {}
+
+            def make_packets(conn):
+                timestamp = conn.packet_timestamp()
+                if timestamp not in packed:
+                    packed[timestamp] = self._sender._pack_chunk(chunk, timestamp)
+                return conn.crypter.encrypt_packets(packed[timestamp])
+            await self._send_to_conns(make_packets)
+        return errors
+
+    async def disconnect(self):
+        conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+        for conn in conns:
+            try:
+                await conn.writer.wait_closed()
+            except (OSError, AttributeError):
+                # AttributeError: wait_closed() is new in Python 3.7
+                pass
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.disconnect()
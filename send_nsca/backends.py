@@ -0,0 +1,269 @@
+"""
+Block cipher backends for the CFB-mode crypters.
+
+The crypters only need "a cipher for algorithm X in 8-bit CFB mode with
+this key and IV", which three libraries, and this package itself, can
+provide:
+
+    pycryptodome    Crypto.Cipher (or Cryptodome.Cipher, from pycryptodomex)
+    pycrypto        the original Crypto.Cipher, which pycryptodome replaced
+    cryptography    OpenSSL, through cryptography's hazmat layer; AES and
+                    (3)DES only, since OpenSSL has no 8-bit CFB mode for
+                    Blowfish, CAST or RC2
+    python          send_nsca.ciphers: XTEA, Twofish and RC6, which none of
+                    the libraries have, in pure Python (and so slowly)
+
+Nothing is imported until a crypter that needs a cipher is first created,
+so senders using no encryption or XOR never load a crypto library at all.
+Each algorithm then uses the first installed backend in its preference
+order, which puts whichever measured fastest first (see
+`python -m send_nsca.benchmark --backends`). set_preference() or the
+SEND_NSCA_CRYPTO_BACKENDS environment variable (a comma-separated list of
+backend names) overrides the order.
+"""
+
+from __future__ import with_statement
+
+import functools
+import importlib
+import os
+import threading
+
+PYCRYPTODOME = 'pycryptodome'
+PYCRYPTO = 'pycrypto'
+CRYPTOGRAPHY = 'cryptography'
+PURE_PYTHON = 'python'
+
+BACKENDS = (PYCRYPTODOME, PYCRYPTO, CRYPTOGRAPHY, PURE_PYTHON)
+
+# the algorithms CryptoCrypter subclasses name
+DES = 'des'
+DES3 = 'des3'
+CAST128 = 'cast128'
+BLOWFISH = 'blowfish'
+RC2 = 'rc2'
+AES = 'aes'
+XTEA = 'xtea'
+TWOFISH = 'twofish'
+RC6 = 'rc6'
+
+block_sizes = {DES: 8, DES3: 8, CAST128: 8, BLOWFISH: 8, RC2: 8, AES: 16, XTEA: 8, TWOFISH: 16, RC6: 16}
+
+# OpenSSL's AES is the fastest, and its 3DES as fast as pycryptodome's but
+# quicker to set up; its DES has to be done as 3DES with the key repeated,
+# which is three times slower than pycryptodome's
+_DEFAULT_PREFERENCE = (PYCRYPTODOME, PYCRYPTO, CRYPTOGRAPHY, PURE_PYTHON)
+_PREFERENCES = {
+    AES: (CRYPTOGRAPHY, PYCRYPTODOME, PYCRYPTO),
+    DES3: (CRYPTOGRAPHY, PYCRYPTODOME, PYCRYPTO),
+}
+
+
+class BackendUnavailable(ImportError):
+    pass
+
+
+def _des_parity_stripped(key):
+    # DES ignores the low bit of every key byte (it's a parity bit)
+    return bytes(bytearray(c & 0xfe for c in bytearray(key)))
+
+
+def _single_des_key(key):
+    """If the 3DES key is really a single DES one -- the first two or last
+    two of its thirds the same, as the zero-padded keys short passwords
+    make are -- return the DES key it's equivalent to, otherwise None.
+
+    Encrypt-decrypt-encrypt with two equal keys in a row cancels out to
+    encrypting with the remaining one. pycryptodome refuses such keys, so
+    they're done with its single DES instead."""
+    k1, k2, k3 = [_des_parity_stripped(key[i:i + 8]) for i in (0, 8, 16)]
+    if k1 == k2:
+        return key[16:24]
+    if k2 == k3:
+        return key[:8]
+    return None
+
+
+class PyCryptoBackend(object):
+    """pycryptodome and PyCrypto, which share Crypto.Cipher's API"""
+    modules = {DES: 'DES', DES3: 'DES3', CAST128: 'CAST', BLOWFISH: 'Blowfish', RC2: 'ARC2', AES: 'AES'}
+
+    def __init__(self, name, package):
+        self.name = name
+        self.package = package
+        # pycryptodome can encrypt(value, output=value)
+        self.encrypts_in_place = name == PYCRYPTODOME
+
+    def supports(self, algorithm):
+        return algorithm in self.modules
+
+    def cipher_module(self, algorithm):
+        """The Crypto.Cipher module for algorithm"""
+        return importlib.import_module('%s.Cipher.%s' % (self.package, self.modules[algorithm]))
+
+    def cfb_factory(self, algorithm, key):
+        """Return a function of an IV that makes an 8-bit CFB cipher with
+        encrypt() and decrypt() methods"""
+        if algorithm == DES3:
+            single_key = _single_des_key(key)
+            if single_key is not None:
+                algorithm, key = DES, single_key
+        module = self.cipher_module(algorithm)
+        return functools.partial(module.new, key, module.MODE_CFB)
+
+
+class _CryptographyCipher(object):
+    """Gives a cryptography Cipher the encrypt()/decrypt() interface of
+    the Crypto.Cipher ones"""
+
+    def __init__(self, cipher):
+        self.cipher = cipher
+        self._encryptor = None
+        self._decryptor = None
+
+    def encrypt(self, value):
+        if self._encryptor is None:
+            self._encryptor = self.cipher.encryptor()
+        return self._encryptor.update(value)
+
+    def decrypt(self, value):
+        if self._decryptor is None:
+            self._decryptor = self.cipher.decryptor()
+        return self._decryptor.update(value)
+
+
+class CryptographyBackend(object):
+    name = CRYPTOGRAPHY
+    encrypts_in_place = False
+
+    def __init__(self):
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        try:
+            # these moved here (and are deprecated where they were) in newer versions of cryptography
+            from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
+        except ImportError:
+            TripleDES = algorithms.TripleDES
+        try:
+            from cryptography.hazmat.decrepit.ciphers.modes import CFB8
+        except ImportError:
+            CFB8 = modes.CFB8
+        self._Cipher = Cipher
+        self._CFB8 = CFB8
+        self._backend = default_backend()
+        self._algorithms = {
+            # single DES is 3DES with the same key three times
+            DES: lambda key: TripleDES(key * 3),
+            DES3: TripleDES,
+            AES: algorithms.AES,
+        }
+
+    def supports(self, algorithm):
+        return algorithm in self._algorithms
+
+    def cfb_factory(self, algorithm, key):
+        cipher_algorithm = self._algorithms[algorithm](key)
+
+        def factory(iv):
+            return _CryptographyCipher(self._Cipher(cipher_algorithm, self._CFB8(iv), backend=self._backend))
+        return factory
+
+
+class PurePythonBackend(object):
+    name = PURE_PYTHON
+    encrypts_in_place = False
+
+    def __init__(self):
+        from . import ciphers
+        self._ciphers = {XTEA: ciphers.XTEA, TWOFISH: ciphers.Twofish, RC6: ciphers.RC6}
+        self._CFB8 = ciphers.CFB8
+
+    def supports(self, algorithm):
+        return algorithm in self._ciphers
+
+    def cfb_factory(self, algorithm, key):
+        # the key schedule (and Twofish's tables) are worked out once and shared
+        return functools.partial(self._CFB8, self._ciphers[algorithm](key))
+
+
+def _load_pycryptodome():
+    try:
+        importlib.import_module('Cryptodome.Cipher')
+        return PyCryptoBackend(PYCRYPTODOME, 'Cryptodome')
+    except ImportError:
+        pass
+    crypto = importlib.import_module('Crypto')
+    if getattr(crypto, 'version_info', (2,))[0] < 3:
+        raise ImportError("Crypto is PyCrypto, not pycryptodome")
+    return PyCryptoBackend(PYCRYPTODOME, 'Crypto')
+
+
+def _load_pycrypto():
+    crypto = importlib.import_module('Crypto')
+    if getattr(crypto, 'version_info', (2,))[0] >= 3:
+        raise ImportError("Crypto is pycryptodome, not PyCrypto")
+    return PyCryptoBackend(PYCRYPTO, 'Crypto')
+
+
+_loaders = {
+    PYCRYPTODOME: _load_pycryptodome,
+    PYCRYPTO: _load_pycrypto,
+    CRYPTOGRAPHY: CryptographyBackend,
+    PURE_PYTHON: PurePythonBackend,
+}
+
+# backend name -> backend, or None if it isn't installed
+_loaded = {}
+_preference = None
+_lock = threading.Lock()
+
+
+def get_backend(name):
+    """The named backend, or None if its library isn't installed"""
+    with _lock:
+        if name not in _loaded:
+            try:
+                _loaded[name] = _loaders[name]()
+            except ImportError:
+                _loaded[name] = None
+        return _loaded[name]
+
+
+def available_backends():
+    return [name for name in BACKENDS if get_backend(name) is not None]
+
+
+def set_preference(names):
+    """Use the named backends, in this order, for every algorithm; None
+    to go back to the per-algorithm defaults"""
+    global _preference
+    if names is not None:
+        unknown = set(names) - set(BACKENDS)
+        if unknown:
+            raise ValueError("unknown crypto backends %s; choose from {%s}" % (','.join(sorted(unknown)), ','.join(BACKENDS)))
+        names = tuple(names)
+    _preference = names
+    # ciphers already set up were made by the old preference
+    from . import nsca
+    nsca._cipher_setups.clear()
+
+
+def preference(algorithm):
+    if _preference is not None:
+        return _preference
+    env = os.environ.get('SEND_NSCA_CRYPTO_BACKENDS')
+    if env:
+        return tuple(name.strip() for name in env.split(',') if name.strip() in _loaders)
+    return _PREFERENCES.get(algorithm, _DEFAULT_PREFERENCE)
+
+
+def backend_for(algorithm):
+    """The preferred installed backend for algorithm; raises
+    BackendUnavailable if none of them supports it"""
+    names = preference(algorithm)
+    for name in names:
+        backend = get_backend(name)
+        if backend is not None and backend.supports(algorithm):
+            return backend
+    raise BackendUnavailable("no installed crypto library can do %s (tried %s); install pycryptodome" % (
+        algorithm, ', '.join(names) or 'none'))
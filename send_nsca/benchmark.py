@@ -0,0 +1,451 @@
+"""
+Benchmarks for the hot paths of send_nsca: microbenchmarks of padding,
+packing, XOR encryption and cipher setup against the implementations they
+replaced, and end-to-end sends for every supported crypt_id, single and
+batched, to a loopback stand-in NSCA server. With --end-to-end, the latency from
+sending a result to a fake_server decoding it is measured too; with
+--backends, so are import time and each installed crypto backend's cipher
+throughput.
+
+Run with `python -m send_nsca.benchmark`; --output writes the results as
+JSON, so runs can be compared over time.
+"""
+
+from __future__ import print_function
+
+import array
+import binascii
+import json
+import math
+import optparse
+import os
+import platform
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+import six
+
+import send_nsca
+from . import backends
+from . import fake_server
+from . import nsca
+from .stats import _nearest_rank
+
+BENCHMARK_PASSWORD = b'BenchmarkPassword-0123456789abcdef'
+DEFAULT_OUTPUT_LENGTHS = (0, 64, nsca.MAX_PLUGINOUTPUT_LENGTH - 1)
+
+
+def legacy_xor_encrypt(value, iv, password):
+    """The original per-byte XORCrypter.encrypt, kept for comparison"""
+    value_s = six.iterbytes(value)
+    repeated_iv = six.iterbytes(list(int(math.ceil(float(len(value)) / len(iv))) * iv))
+    repeated_password = six.iterbytes(list(int(math.ceil(float(len(value)) / len(password))) * password))
+    xor1 = [a ^ b for a, b in zip(value_s, repeated_iv)]
+    xor2 = [a ^ b for a, b in zip(xor1, repeated_password)]
+    return b''.join(map(six.int2byte, xor2))
+
+
+def legacy_random_alphanumeric_bytes(bytesz):
+    """The original per-byte padding generator, kept for comparison"""
+    return ''.join(chr(random.randrange(ord('0'), ord('Z'))) for _ in range(bytesz)).encode('US-ASCII')
+
+
+def legacy_pack_packet(hostname, service, state, output, timestamp):
+    """The original struct.calcsize/array based _pack_packet, kept for comparison"""
+    requested_length = struct.calcsize(nsca._data_packet_format)
+    packet = array.array('B', b'\0' * requested_length)
+    header_format = '!hxxLLh'
+    offset = struct.calcsize(header_format)
+    struct.pack_into('!hxxLLh', packet, 0, nsca.PACKET_VERSION, 0, timestamp, state)
+    hostname = hostname + b'\0'
+    if len(hostname) < nsca.MAX_HOSTNAME_LENGTH:
+        hostname += legacy_random_alphanumeric_bytes(nsca.MAX_HOSTNAME_LENGTH - len(hostname))
+    struct.pack_into('!%ds' % (nsca.MAX_HOSTNAME_LENGTH,), packet, offset, hostname)
+    offset += struct.calcsize('!%ds' % (nsca.MAX_HOSTNAME_LENGTH,))
+    service = service + b'\0'
+    if len(service) < nsca.MAX_DESCRIPTION_LENGTH:
+        service += legacy_random_alphanumeric_bytes(nsca.MAX_DESCRIPTION_LENGTH - len(service))
+    struct.pack_into('%ds' % (nsca.MAX_DESCRIPTION_LENGTH,), packet, offset, service)
+    offset += struct.calcsize('!%ds' % (nsca.MAX_DESCRIPTION_LENGTH))
+    output = output + b'\0'
+    if len(output) < nsca.MAX_PLUGINOUTPUT_LENGTH:
+        output += legacy_random_alphanumeric_bytes(nsca.MAX_PLUGINOUTPUT_LENGTH - len(output))
+    struct.pack_into('%ds' % (nsca.MAX_PLUGINOUTPUT_LENGTH,), packet, offset, output)
+    crc_val = binascii.crc32(packet) & 0xffffffff
+    struct.pack_into('!L', packet, 4, crc_val)
+    # array.tostring() is gone in newer pythons
+    return getattr(packet, 'tobytes', getattr(packet, 'tostring', None))()
+
+
+def legacy_crypto_crypter_setup(crypter_class, iv, password):
+    """The original CryptoCrypter.__init__, which derived the key and looked
+    up the cipher for every connection, kept for comparison"""
+    backend = backends.get_backend(backends.PYCRYPTODOME) or backends.get_backend(backends.PYCRYPTO)
+    cipher = backend.cipher_module(crypter_class.algorithm)
+    iv_size = crypter_class.iv_size if crypter_class.iv_size is not None else cipher.block_size
+    if len(password) >= crypter_class.key_size:
+        key = password[:crypter_class.key_size]
+    else:
+        key = password + b'\0' * (crypter_class.key_size - len(password))
+    return cipher.new(key, cipher.MODE_CFB, iv[:iv_size])
+
+
+def _best_rate(func, number, repeat=3):
+    """Return the best calls-per-second rate of func over a few runs"""
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return number / best
+
+
+def bench_xor(number=2000, batch=100):
+    iv = os.urandom(nsca._TRANSMITTED_IV_SIZE)
+    password = b'TestingPassword'
+    crypter = nsca.XORCrypter(iv, password, os.urandom)
+    packet = os.urandom(nsca._data_packet_size)
+    packets = packet * batch
+    assert crypter.encrypt(packet) == legacy_xor_encrypt(packet, iv, password)
+    return [
+        ('xor legacy', _best_rate(lambda: legacy_xor_encrypt(packet, iv, password), number)),
+        ('xor keystream', _best_rate(lambda: crypter.encrypt(packet), number)),
+        ('xor keystream batch', batch * _best_rate(lambda: crypter.encrypt_packets(packets), max(1, number // batch))),
+    ]
+
+
+def bench_padding(number=2000):
+    # the padding needed by a packet with short hostname, service and output
+    sizes = (nsca.MAX_HOSTNAME_LENGTH - 10, nsca.MAX_DESCRIPTION_LENGTH - 10, nsca.MAX_PLUGINOUTPUT_LENGTH - 10)
+    results = []
+    for name, padding in (
+        ('padding legacy', legacy_random_alphanumeric_bytes),
+        ('padding fresh', nsca.FreshPadding()),
+        ('padding pool', nsca.PooledPadding()),
+    ):
+        results.append((name, _best_rate(lambda: [padding(size) for size in sizes], number)))
+    return results
+
+
+def bench_pack(number=2000):
+    args = (b'web01.example.com', b'disk_usage', 0, b'DISK OK - free space: / 3326 MB (56%)', 1349721600)
+    builder = nsca.PacketBuilder()
+    return [
+        ('pack legacy', _best_rate(lambda: legacy_pack_packet(*args), number)),
+        ('pack PacketBuilder', _best_rate(lambda: builder.build(*args), number)),
+    ]
+
+
+def bench_crypter_setup(number=2000):
+    """Per-connection crypter setup for the ciphers with expensive key
+    schedules, with and without the cached key and cipher factory. Both use
+    the library the legacy setup did, so that only the cache is measured;
+    the ciphers still expand their keys for every connection, so it buys
+    little beyond skipping the key derivation and module lookup."""
+    iv = os.urandom(nsca._TRANSMITTED_IV_SIZE)
+    backend = backends.get_backend(backends.PYCRYPTODOME) or backends.get_backend(backends.PYCRYPTO)
+    old_preference = backends._preference
+    backends.set_preference([backend.name])
+    try:
+        results = []
+        for crypter_class in (nsca.DES3Crypter, nsca.BlowFishCrypter, nsca.RC2Crypter):
+            name = crypter_class.__name__
+            results.append(('setup %s legacy' % name, _best_rate(
+                lambda: legacy_crypto_crypter_setup(crypter_class, iv, BENCHMARK_PASSWORD), number), 'setups'))
+            results.append(('setup %s cached' % name, _best_rate(
+                lambda: crypter_class(iv, BENCHMARK_PASSWORD, os.urandom), number), 'setups'))
+    finally:
+        backends.set_preference(old_preference)
+    return results
+
+
+BENCHMARKS = [
+    bench_xor,
+    bench_padding,
+    bench_pack,
+    bench_crypter_setup,
+]
+
+
+def _import_time(statement, repeat=5):
+    """Best wall time, in seconds, of statement in a fresh interpreter"""
+    code = 'import time; start = time.time(); %s; print(time.time() - start)' % (statement,)
+    best = None
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', code])
+        elapsed = float(output.decode('ascii').strip().splitlines()[-1])
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_imports(repeat=5):
+    """Seconds to import send_nsca.nsca, and then to load each installed
+    backend"""
+    results = [('import send_nsca.nsca', _import_time('import send_nsca.nsca', repeat))]
+    for name in backends.available_backends():
+        results.append(('import send_nsca.nsca + %s' % name, _import_time(
+            'import send_nsca.nsca, send_nsca.backends as b; b.get_backend(%r)' % name, repeat)))
+    return results
+
+
+def bench_backends(number=20, batch=100):
+    """Encryption rate of a batch of packets, and cipher setup rate, for
+    each algorithm on each installed backend"""
+    iv = os.urandom(16)
+    packets = os.urandom(nsca._data_packet_size * batch)
+    results = []
+    for crypter_class in sorted(set(nsca.crypters.values()), key=lambda c: c.crypt_id):
+        if not issubclass(crypter_class, nsca.CryptoCrypter):
+            continue
+        key = BENCHMARK_PASSWORD[:crypter_class.key_size].ljust(crypter_class.key_size, b'\0')
+        iv_size = backends.block_sizes[crypter_class.algorithm]
+        for name in backends.available_backends():
+            backend = backends.get_backend(name)
+            if not backend.supports(crypter_class.algorithm):
+                continue
+            factory = backend.cfb_factory(crypter_class.algorithm, key)
+            cipher = factory(iv[:iv_size])
+            label = '%s %s' % (crypter_class.__name__, name)
+            # the pure-Python ciphers take tens of milliseconds a packet; one will do
+            count = 1 if name == backends.PURE_PYTHON else batch
+            data = packets[:nsca._data_packet_size * count]
+            results.append(('encrypt ' + label, count * _best_rate(lambda: cipher.encrypt(data), number)))
+            results.append(('setup ' + label, _best_rate(lambda: factory(iv[:iv_size]).encrypt(b''), number * 50), 'setups'))
+    return results
+
+
+class LoopbackSink(object):
+    """A stand-in NSCA server on 127.0.0.1 that hands out init packets and
+    reads (and throws away) whatever it's sent"""
+
+    def __init__(self):
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.listen(16)
+        self.port = self._listener.getsockname()[1]
+        self._thread = threading.Thread(target=self._accept, name='LoopbackSink')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except (socket.error, OSError):
+                return
+            t = threading.Thread(target=self._handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _handle(self, conn):
+        conn.sendall(struct.pack(nsca._init_packet_format, os.urandom(nsca._TRANSMITTED_IV_SIZE), int(time.time())))
+        buf = bytearray(65536)
+        try:
+            while True:
+                n = conn.recv_into(buf)
+                if not n:
+                    break
+                with self._lock:
+                    self.bytes_received += n
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def wait_for(self, num_bytes, timeout=10):
+        deadline = time.time() + timeout
+        while self.bytes_received < num_bytes and time.time() < deadline:
+            time.sleep(0.001)
+
+    def close(self):
+        self._listener.close()
+
+
+def supported_crypt_ids():
+    return [crypt_id for crypt_id, crypter in sorted(nsca.crypters.items()) if crypter.available()]
+
+
+def default_crypt_ids():
+    """The supported crypt_ids, without the pure-Python ciphers, which
+    would take minutes to send thousands of packets with"""
+    return [
+        crypt_id for crypt_id in supported_crypt_ids()
+        if not (issubclass(nsca.crypters[crypt_id], nsca.CryptoCrypter) and
+                backends.backend_for(nsca.crypters[crypt_id].algorithm).name == backends.PURE_PYTHON)
+    ]
+
+
+def _summarize(packets, elapsed, latencies):
+    # no latencies if nothing got sent; report them as 0, like the rate
+    latencies = sorted(latencies) or [0.0]
+    return {
+        'packets': packets,
+        'seconds': elapsed,
+        'packets_per_sec': packets / elapsed if elapsed else 0.0,
+        'latency_us': dict(
+            [('p%d' % percent, 1e6 * _nearest_rank(latencies, percent)) for percent in (50, 90, 99)] +
+            [('max', 1e6 * latencies[-1])]
+        ),
+    }
+
+
+def bench_send(sink, crypt_id, output_length, mode, packets=2000, batch_size=100):
+    """Send packets results through a real NscaSender to sink, with
+    send_service() for mode 'single' or send_many() of batch_size results
+    for mode 'batched'. Latencies are per packet; for batches, that's the
+    batch's time divided by its size."""
+    sender = nsca.NscaSender('127.0.0.1', config_path=None, port=sink.port)
+    sender.Crypter = nsca.crypters[crypt_id]
+    sender.password = BENCHMARK_PASSWORD
+    sender.connect()
+    result = (b'web01.example.com', b'disk_usage', 0, b'x' * output_length)
+    latencies = []
+    start_bytes = sink.bytes_received
+    start = time.time()
+    if mode == 'single':
+        for _ in range(packets):
+            t = time.time()
+            sender.send_service(*result)
+            latencies.append(time.time() - t)
+    else:
+        batch = [result] * batch_size
+        for _ in range(max(1, packets // batch_size)):
+            t = time.time()
+            sender.send_many(batch)
+            latencies.extend([(time.time() - t) / batch_size] * batch_size)
+    sent = len(latencies)
+    sink.wait_for(start_bytes + sent * nsca._data_packet_size)
+    elapsed = time.time() - start
+    sender.disconnect()
+    summary = _summarize(sent, elapsed, latencies)
+    summary.update({
+        'name': 'send %s %s %d' % (nsca.crypters[crypt_id].__name__, mode, output_length),
+        'crypt_id': crypt_id,
+        'cipher': nsca.crypters[crypt_id].__name__,
+        'mode': mode,
+        'output_length': output_length,
+    })
+    return summary
+
+
+def run_send_benchmarks(crypt_ids, output_lengths, modes=('single', 'batched'), packets=2000, batch_size=100):
+    sink = LoopbackSink()
+    try:
+        return [
+            bench_send(sink, crypt_id, output_length, mode, packets, batch_size)
+            for crypt_id in crypt_ids
+            for output_length in output_lengths
+            for mode in modes
+        ]
+    finally:
+        sink.close()
+
+
+def bench_end_to_end(crypt_id, packets=1000):
+    """Time results from send_service() until a fake nsca server has
+    decrypted and decoded them; each result carries its send time in its
+    plugin output"""
+    latencies = []
+    server = fake_server.ThreadedNscaServer(
+        password=BENCHMARK_PASSWORD, crypt_id=crypt_id,
+        callback=lambda result: latencies.append(time.time() - float(result.output)),
+    ).start()
+    try:
+        sender = nsca.NscaSender('127.0.0.1', config_path=None, port=server.port)
+        sender.Crypter = nsca.crypters[crypt_id]
+        sender.password = BENCHMARK_PASSWORD
+        start = time.time()
+        for _ in range(packets):
+            sender.send_service(b'web01.example.com', b'disk_usage', 0, repr(time.time()).encode('ascii'))
+        server.wait_for(packets, timeout=30)
+        elapsed = time.time() - start
+        sender.disconnect()
+    finally:
+        server.stop()
+    summary = _summarize(len(latencies), elapsed, latencies)
+    summary.update({
+        'name': 'end-to-end %s' % nsca.crypters[crypt_id].__name__,
+        'crypt_id': crypt_id,
+        'cipher': nsca.crypters[crypt_id].__name__,
+        'mode': 'end-to-end',
+        'rejected': server.rejected,
+    })
+    return summary
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--packets", dest="packets", type=int, default=2000,
+                      help="Packets to send per send benchmark (default %default)")
+    parser.add_option("-b", "--batch-size", dest="batch_size", type=int, default=100,
+                      help="Results per send_many() in batched mode (default %default)")
+    parser.add_option("-c", "--crypt-ids", dest="crypt_ids", type=str, default=None,
+                      help="Comma-separated crypt_ids to benchmark (default: all supported, "
+                           "except those done in pure Python)")
+    parser.add_option("-l", "--output-lengths", dest="output_lengths", type=str,
+                      default=','.join(map(str, DEFAULT_OUTPUT_LENGTHS)),
+                      help="Comma-separated plugin output lengths (default %default)")
+    parser.add_option("--no-micro", dest="micro", action="store_false", default=True,
+                      help="Skip the padding/packing/XOR microbenchmarks")
+    parser.add_option("--backends", dest="backends", action="store_true", default=False,
+                      help="Also measure import time, and cipher throughput for each installed crypto backend")
+    parser.add_option("-e", "--end-to-end", dest="end_to_end", action="store_true", default=False,
+                      help="Also measure send-to-decode latency through a fake nsca server")
+    parser.add_option("-o", "--output", dest="output", type=str, default=None,
+                      help="Write the results to this file as JSON")
+    opts, args = parser.parse_args(argv)
+    if args:
+        parser.error("This program takes no un-flagged command-line options")
+    crypt_ids = _int_list(opts.crypt_ids) if opts.crypt_ids else default_crypt_ids()
+    unsupported = set(crypt_ids) - set(supported_crypt_ids())
+    if unsupported:
+        parser.error("unsupported crypt_ids: %s" % ','.join(map(str, sorted(unsupported))))
+
+    results = []
+    benchmarks = list(BENCHMARKS) if opts.micro else []
+    if opts.backends:
+        for name, seconds in bench_imports():
+            print("%-40s %10.1fms" % (name, seconds * 1000))
+            results.append({'name': name, 'seconds': seconds})
+        benchmarks.append(bench_backends)
+    for benchmark in benchmarks:
+        for result in benchmark():
+            # results are (name, rate) or (name, rate, unit)
+            name, rate, unit = (result + ('packets',))[:3]
+            print("%-40s %12.0f %s/s" % (name, rate, unit))
+            results.append({'name': name, '%s_per_sec' % unit: rate})
+    for result in run_send_benchmarks(crypt_ids, _int_list(opts.output_lengths), packets=opts.packets,
+                                      batch_size=opts.batch_size):
+        print("%-40s %12.0f packets/s  p50 %7.1fus  p99 %7.1fus" % (
+            result['name'], result['packets_per_sec'], result['latency_us']['p50'], result['latency_us']['p99']))
+        results.append(result)
+    if opts.end_to_end:
+        for crypt_id in crypt_ids:
+            result = bench_end_to_end(crypt_id, opts.packets)
+            print("%-40s %12.0f packets/s  p50 %7.1fus  p99 %7.1fus" % (
+                result['name'], result['packets_per_sec'], result['latency_us']['p50'], result['latency_us']['p99']))
+            results.append(result)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({
+                'time': time.time(),
+                'send_nsca_version': send_nsca.__version__,
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,316 @@
+"""
+Pure-Python block ciphers for the nsca encryption methods that none of the
+crypto libraries implement: XTEA, Twofish and RC6.
+
+Each cipher is table-driven where the algorithm allows it -- Twofish's
+key-dependent S-boxes are fused with its MDS matrix into four 256-entry
+tables at key setup, so a round is eight table lookups -- and keeps its
+state in plain ints, since 8-bit CFB (the only mode nsca uses) encrypts
+one whole block for every byte of the stream and only ever needs its first
+byte. That also makes the stream inherently sequential, so there's nothing
+to gain from vectorising across a packet.
+
+Word order follows each cipher's reference implementation: big-endian for
+XTEA, little-endian for Twofish and RC6.
+"""
+
+import binascii
+import struct
+
+_MASK = 0xffffffff
+
+
+def _rol(value, shift):
+    return ((value << shift) | (value >> (32 - shift))) & _MASK
+
+
+########  XTEA ########
+
+_XTEA_DELTA = 0x9e3779b9
+_XTEA_ROUNDS = 32
+
+
+class XTEA(object):
+    block_size = 8
+    byteorder = 'big'
+    key_sizes = (16,)
+
+    def __init__(self, key):
+        if len(key) not in self.key_sizes:
+            raise ValueError("XTEA keys are 16 bytes, not %d" % (len(key),))
+        k = struct.unpack('>4L', key)
+        # the sum and key word that each half-round adds, precomputed
+        self._schedule = []
+        total = 0
+        for _ in range(_XTEA_ROUNDS):
+            first = (total + k[total & 3]) & _MASK
+            total = (total + _XTEA_DELTA) & _MASK
+            self._schedule.append((first, (total + k[(total >> 11) & 3]) & _MASK))
+
+    def _encrypt(self, y, z):
+        # the shifted terms can spill past 32 bits, but only their low 32 bits reach the result
+        for first, second in self._schedule:
+            y = (y + ((((z << 4) ^ (z >> 5)) + z) ^ first)) & _MASK
+            z = (z + ((((y << 4) ^ (y >> 5)) + y) ^ second)) & _MASK
+        return y, z
+
+    def encrypt_block(self, block):
+        return struct.pack('>2L', *self._encrypt(*struct.unpack('>2L', block)))
+
+    def keystream_byte(self, register):
+        return self._encrypt(register >> 32, register & _MASK)[0] >> 24
+
+
+########  TWOFISH ########
+
+def _gf_multiply(a, b, polynomial):
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        a <<= 1
+        if a & 0x100:
+            a ^= polynomial
+        b >>= 1
+    return result
+
+
+def _twofish_q(t):
+    """One of Twofish's fixed 8-bit permutations, built from its four 4-bit ones"""
+    def ror4(value):
+        return ((value >> 1) | (value << 3)) & 0xf
+    q = []
+    for x in range(256):
+        a, b = x >> 4, x & 0xf
+        a, b = a ^ b, (a ^ ror4(b) ^ (a << 3)) & 0xf
+        a, b = t[0][a], t[1][b]
+        a, b = a ^ b, (a ^ ror4(b) ^ (a << 3)) & 0xf
+        a, b = t[2][a], t[3][b]
+        q.append((b << 4) | a)
+    return q
+
+
+_Q0 = _twofish_q((
+    (0x8, 0x1, 0x7, 0xD, 0x6, 0xF, 0x3, 0x2, 0x0, 0xB, 0x5, 0x9, 0xE, 0xC, 0xA, 0x4),
+    (0xE, 0xC, 0xB, 0x8, 0x1, 0x2, 0x3, 0x5, 0xF, 0x4, 0xA, 0x6, 0x7, 0x0, 0x9, 0xD),
+    (0xB, 0xA, 0x5, 0xE, 0x6, 0xD, 0x9, 0x0, 0xC, 0x8, 0xF, 0x3, 0x2, 0x4, 0x7, 0x1),
+    (0xD, 0x7, 0xF, 0x4, 0x1, 0x2, 0x6, 0xE, 0x9, 0xB, 0x3, 0x0, 0x8, 0x5, 0xC, 0xA),
+))
+_Q1 = _twofish_q((
+    (0x2, 0x8, 0xB, 0xD, 0xF, 0x7, 0x6, 0xE, 0x3, 0x1, 0x9, 0x4, 0x0, 0xA, 0xC, 0x5),
+    (0x1, 0xE, 0x2, 0xB, 0x4, 0xC, 0x3, 0x7, 0x6, 0xD, 0xA, 0x5, 0xF, 0x9, 0x0, 0x8),
+    (0x4, 0xC, 0x7, 0x5, 0x1, 0x6, 0x9, 0xA, 0x0, 0xE, 0xD, 0x8, 0x2, 0xB, 0x3, 0xF),
+    (0xB, 0x9, 0x5, 0x1, 0xC, 0x3, 0xD, 0xE, 0x6, 0x4, 0x7, 0xF, 0x2, 0x0, 0x8, 0xA),
+))
+
+_MDS_MATRIX = (
+    (0x01, 0xEF, 0x5B, 0x5B),
+    (0x5B, 0xEF, 0xEF, 0x01),
+    (0xEF, 0x5B, 0x01, 0xEF),
+    (0xEF, 0x01, 0xEF, 0x5B),
+)
+_RS_MATRIX = (
+    (0x01, 0xA4, 0x55, 0x87, 0x5A, 0x58, 0xDB, 0x9E),
+    (0xA4, 0x56, 0x82, 0xF3, 0x1E, 0xC6, 0x68, 0xE5),
+    (0x02, 0xA1, 0xFC, 0xC1, 0x47, 0xAE, 0x3D, 0x19),
+    (0xA4, 0x55, 0x87, 0x5A, 0x58, 0xDB, 0x9E, 0x03),
+)
+
+# _MDS[j][y]: what byte y in position j contributes to the MDS product, as a word
+_MDS = [
+    [sum(_gf_multiply(_MDS_MATRIX[i][j], y, 0x169) << (8 * i) for i in range(4)) for y in range(256)]
+    for j in range(4)
+]
+
+# the q permutations each byte position goes through in h(), outermost (applied last) first,
+# for the key words L[0], L[1], L[2] and L[3]
+_H_QS = (
+    (_Q1, _Q0, _Q0, _Q1, _Q1),
+    (_Q0, _Q0, _Q1, _Q1, _Q0),
+    (_Q1, _Q1, _Q0, _Q0, _Q0),
+    (_Q0, _Q1, _Q1, _Q0, _Q1),
+)
+
+
+def _twofish_sbox(x, position, key_bytes):
+    """The key-dependent S-box for one byte position of h(); key_bytes
+    has that position's byte of each of the key words L[0] .. L[k-1]"""
+    qs = _H_QS[position]
+    for i in range(len(key_bytes) - 1, -1, -1):
+        x = qs[i + 1][x] ^ key_bytes[i]
+    return qs[0][x]
+
+
+def _twofish_h(x, words):
+    result = 0
+    for position in range(4):
+        key_bytes = [(word >> (8 * position)) & 0xff for word in words]
+        result ^= _MDS[position][_twofish_sbox((x >> (8 * position)) & 0xff, position, key_bytes)]
+    return result
+
+
+class Twofish(object):
+    block_size = 16
+    byteorder = 'little'
+    key_sizes = (16, 24, 32)
+
+    def __init__(self, key):
+        if len(key) not in self.key_sizes:
+            raise ValueError("Twofish keys are 16, 24 or 32 bytes, not %d" % (len(key),))
+        k = len(key) // 8
+        words = struct.unpack('<%dL' % (2 * k), key)
+        even, odd = words[0::2], words[1::2]
+        key_bytes = bytearray(key)
+        # the S-box key words, in the reverse of the order they're computed in
+        sbox_words = []
+        for i in range(k):
+            chunk = key_bytes[8 * i:8 * i + 8]
+            word = 0
+            for row in range(4):
+                value = 0
+                for column in range(8):
+                    value ^= _gf_multiply(_RS_MATRIX[row][column], chunk[column], 0x14D)
+                word |= value << (8 * row)
+            sbox_words.insert(0, word)
+        subkeys = []
+        for i in range(20):
+            a = _twofish_h(2 * i * 0x01010101, even)
+            b = _rol(_twofish_h((2 * i + 1) * 0x01010101, odd), 8)
+            subkeys.append((a + b) & _MASK)
+            subkeys.append(_rol((a + 2 * b) & _MASK, 9))
+        self._subkeys = subkeys
+        # g() as four tables of S-box-then-MDS, one per input byte
+        self._g = [
+            [_MDS[position][_twofish_sbox(x, position, [(word >> (8 * position)) & 0xff for word in sbox_words])]
+             for x in range(256)]
+            for position in range(4)
+        ]
+
+    def _encrypt(self, a, b, c, d):
+        k = self._subkeys
+        g0, g1, g2, g3 = self._g
+        a ^= k[0]
+        b ^= k[1]
+        c ^= k[2]
+        d ^= k[3]
+        # two rounds at a time, so the halves swap roles instead of places
+        for r in range(8, 40, 4):
+            t0 = g0[a & 0xff] ^ g1[(a >> 8) & 0xff] ^ g2[(a >> 16) & 0xff] ^ g3[a >> 24]
+            t1 = g0[b >> 24] ^ g1[b & 0xff] ^ g2[(b >> 8) & 0xff] ^ g3[(b >> 16) & 0xff]
+            c ^= (t0 + t1 + k[r]) & _MASK
+            c = (c >> 1) | ((c << 31) & _MASK)
+            d = (((d << 1) & _MASK) | (d >> 31)) ^ ((t0 + 2 * t1 + k[r + 1]) & _MASK)
+            t0 = g0[c & 0xff] ^ g1[(c >> 8) & 0xff] ^ g2[(c >> 16) & 0xff] ^ g3[c >> 24]
+            t1 = g0[d >> 24] ^ g1[d & 0xff] ^ g2[(d >> 8) & 0xff] ^ g3[(d >> 16) & 0xff]
+            a ^= (t0 + t1 + k[r + 2]) & _MASK
+            a = (a >> 1) | ((a << 31) & _MASK)
+            b = (((b << 1) & _MASK) | (b >> 31)) ^ ((t0 + 2 * t1 + k[r + 3]) & _MASK)
+        return c ^ k[4], d ^ k[5], a ^ k[6], b ^ k[7]
+
+    def encrypt_block(self, block):
+        return struct.pack('<4L', *self._encrypt(*struct.unpack('<4L', block)))
+
+    def keystream_byte(self, register):
+        return self._encrypt(register & _MASK, (register >> 32) & _MASK, (register >> 64) & _MASK,
+                             register >> 96)[0] & 0xff
+
+
+########  RC6 ########
+
+_RC6_ROUNDS = 20
+_RC6_P = 0xb7e15163
+_RC6_Q = 0x9e3779b9
+
+
+class RC6(object):
+    block_size = 16
+    byteorder = 'little'
+    key_sizes = tuple(range(1, 257))
+
+    def __init__(self, key):
+        if not 0 < len(key) <= 256:
+            raise ValueError("RC6 keys are 1 to 256 bytes, not %d" % (len(key),))
+        padded = key + b'\0' * (-len(key) % 4)
+        words = list(struct.unpack('<%dL' % (len(padded) // 4), padded))
+        count = 2 * _RC6_ROUNDS + 4
+        schedule = [(_RC6_P + i * _RC6_Q) & _MASK for i in range(count)]
+        a = b = i = j = 0
+        for _ in range(3 * max(count, len(words))):
+            a = schedule[i] = _rol((schedule[i] + a + b) & _MASK, 3)
+            b = words[j] = _rol((words[j] + a + b) & _MASK, (a + b) & 31)
+            i = (i + 1) % count
+            j = (j + 1) % len(words)
+        self._first = schedule[0], schedule[1]
+        self._rounds = [(schedule[2 * i], schedule[2 * i + 1]) for i in range(1, _RC6_ROUNDS + 1)]
+        self._last = schedule[-2], schedule[-1]
+
+    def _encrypt(self, a, b, c, d):
+        b = (b + self._first[0]) & _MASK
+        d = (d + self._first[1]) & _MASK
+        for first, second in self._rounds:
+            t = (b * (2 * b + 1)) & _MASK
+            t = ((t << 5) | (t >> 27)) & _MASK
+            u = (d * (2 * d + 1)) & _MASK
+            u = ((u << 5) | (u >> 27)) & _MASK
+            a ^= t
+            s = u & 31
+            a = ((((a << s) | (a >> (32 - s))) & _MASK) + first) & _MASK
+            c ^= u
+            s = t & 31
+            c = ((((c << s) | (c >> (32 - s))) & _MASK) + second) & _MASK
+            a, b, c, d = b, c, d, a
+        return (a + self._last[0]) & _MASK, b, (c + self._last[1]) & _MASK, d
+
+    def encrypt_block(self, block):
+        return struct.pack('<4L', *self._encrypt(*struct.unpack('<4L', block)))
+
+    def keystream_byte(self, register):
+        return self._encrypt(register & _MASK, (register >> 32) & _MASK, (register >> 64) & _MASK,
+                             register >> 96)[0] & 0xff
+
+
+########  8-BIT CFB ########
+
+class CFB8(object):
+    """8-bit CFB mode, as mcrypt does it: each byte is XORed with the first
+    byte of the encrypted shift register, which then shifts in the
+    ciphertext byte. Separate instances are needed to encrypt and decrypt.
+
+    The register is kept as one int, in the cipher's byte order, which the
+    cipher's keystream_byte() splits straight into words."""
+
+    def __init__(self, cipher, iv):
+        if len(iv) != cipher.block_size:
+            raise ValueError("the IV should be %d bytes, not %d" % (cipher.block_size, len(iv)))
+        self.cipher = cipher
+        self.big_endian = cipher.byteorder == 'big'
+        iv = bytearray(iv)
+        if not self.big_endian:
+            iv.reverse()
+        self.register = int(binascii.hexlify(iv), 16)
+
+    def _shift(self, value, decrypt):
+        keystream_byte = self.cipher.keystream_byte
+        register = self.register
+        output = bytearray(value)
+        if self.big_endian:
+            mask = (1 << (8 * self.cipher.block_size - 8)) - 1
+        else:
+            top = 8 * self.cipher.block_size - 8
+        for i, byte in enumerate(output):
+            key = keystream_byte(register)
+            output[i] = byte ^ key
+            if not decrypt:
+                byte ^= key
+            if self.big_endian:
+                register = ((register & mask) << 8) | byte
+            else:
+                register = (register >> 8) | (byte << top)
+        self.register = register
+        return bytes(output)
+
+    def encrypt(self, value):
+        return self._shift(value, False)
+
+    def decrypt(self, value):
+        return self._shift(value, True)
@@ -0,0 +1,201 @@
+"""
+The py_send_nsca command line tool: reads check results from stdin, one per
+line, and sends them to an NSCA server.
+
+Lines are either host results:
+    <host_name>[TAB]<return_code>[TAB]<plugin_output>
+or service results:
+    <host_name>[TAB]<svc_description>[TAB]<return_code>[TAB]<plugin_output>
+"""
+
+from __future__ import print_function
+
+import logging
+import optparse
+import sys
+import time
+
+import send_nsca
+from .nsca import DEFAULT_CONFIG_PATH, DEFAULT_PORT, NscaSender
+from .queued import BLOCK, QueuedNscaSender
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+def parse_line(line, delimiter=b'\t'):
+    """Parse a line of input into (host, service, state, output); raises
+    ValueError if it's malformed"""
+    fields = line.rstrip().split(delimiter)
+    if len(fields) == 3:
+        host, state, output = fields
+        service = b''
+    elif len(fields) == 4:
+        host, service, state, output = fields
+    else:
+        raise ValueError("Incorrect number of fields")
+    return host, service, int(state), output
+
+
+def iter_lines(stream, block_size=READ_BLOCK_SIZE):
+    """Yield the lines of a binary stream, reading it a block at a time"""
+    leftover = b''
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        lines = (leftover + block).split(b'\n')
+        leftover = lines.pop()
+        for line in lines:
+            yield line
+    if leftover:
+        yield leftover
+
+
+def _binary(stream):
+    return getattr(stream, 'buffer', stream)
+
+
+def run_simple(sender, stdin, stderr, opts):
+    """Send each line as soon as it's read"""
+    stats = {'sent': 0, 'rejected': 0, 'failed': 0}
+    for line in stdin:
+        if not line.strip():
+            continue
+        try:
+            host, service, state, output = parse_line(line, opts.delimiter)
+            sender.send_service(host, service, state, output)
+        except ValueError as e:
+            logging.error("Rejected line %r: %s", line, e)
+            stats['rejected'] += 1
+            if not opts.continue_on_error:
+                print("Incorrect input line %r: %s" % (line, e), file=stderr)
+                break
+            continue
+        stats['sent'] += 1
+    sender.disconnect()
+    return stats
+
+
+def run_stream(sender, stdin, stderr, opts):
+    """Read stdin in large blocks and send in batches; a background thread
+    does the sending, so reading and parsing overlap with network writes"""
+    queue = QueuedNscaSender(
+        sender,
+        max_queue_size=opts.batch_size * 4,
+        full_policy=BLOCK,
+        batch_size=opts.batch_size,
+    )
+    rejected = 0
+    for line in iter_lines(stdin):
+        if not line.strip():
+            continue
+        try:
+            queue.send_service(*parse_line(line, opts.delimiter))
+        except ValueError as e:
+            logging.error("Rejected line %r: %s", line, e)
+            rejected += 1
+            if not opts.continue_on_error:
+                print("Incorrect input line %r: %s" % (line, e), file=stderr)
+                break
+    queue.close()
+    return {'sent': queue.sent, 'rejected': rejected, 'failed': queue.failed + queue.dropped}
+
+
+def run_sharded(sender_kwargs, stdin, stderr, opts):
+    """Like run_stream, but sending from opts.processes worker processes"""
+    # multiprocessing is slow to import, so only load it when it's needed
+    from .sharded import ShardedNscaSender
+    if opts.rate is not None:
+        # every process paces its own connections
+        sender_kwargs = dict(sender_kwargs, rate_limit=opts.rate / opts.processes)
+    sender = ShardedNscaSender(opts.host_address, processes=opts.processes, batch_size=opts.batch_size, **sender_kwargs)
+    rejected = 0
+    for line in iter_lines(stdin):
+        if not line.strip():
+            continue
+        try:
+            sender.send_service(*parse_line(line, opts.delimiter))
+        except ValueError as e:
+            logging.error("Rejected line %r: %s", line, e)
+            rejected += 1
+            if not opts.continue_on_error:
+                print("Incorrect input line %r: %s" % (line, e), file=stderr)
+                break
+    stats = sender.close()
+    return {'sent': stats['sent'], 'rejected': rejected, 'failed': stats['failed']}
+
+
+def make_parser():
+    parser = optparse.OptionParser(usage="%prog -H <host_address> [args]")
+    parser.add_option("-H", "--host-address", default=None, dest="host_address", help="The IP address or hostname of the machine running NSCA")
+    parser.add_option("-p", "--port", dest="port", type=int, default=DEFAULT_PORT, help="The port on which the daemon is running (default %default)")
+    parser.add_option("-t", "--timeout", dest="timeout", type=int, default=10, help="TCP timeout (default %default), 0 for none")
+    parser.add_option("-d", "--delim", dest="delimiter", type=str, default="\t", help="Delimiter between input fields (default TAB)")
+    parser.add_option("-c", "--config-file", dest="config_file", type=str, default=DEFAULT_CONFIG_PATH, help="Path to config file (default %default)")
+    parser.add_option("-s", "--stream", dest="stream", action="store_true", default=False,
+                      help="Read input in large blocks and send it in batches, overlapping reading with sending")
+    parser.add_option("-b", "--batch-size", dest="batch_size", type=int, default=500,
+                      help="Results per batch in --stream mode (default %default)")
+    parser.add_option("-P", "--processes", dest="processes", type=int, default=1,
+                      help="Shard results across this many sending processes, implies --stream (default %default)")
+    parser.add_option("-r", "--rate", dest="rate", type=float, default=None,
+                      help="Send at most this many packets per second to each server (default: no limit)")
+    parser.add_option("-k", "--continue-on-error", dest="continue_on_error", action="store_true", default=False,
+                      help="Skip (and count) malformed lines instead of stopping at the first one")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False, help="Be more verbose in output")
+    parser.add_option("-V", "--version", dest="version", action="store_true", default=False, help="Show version number")
+    return parser
+
+
+def main(argv=None, stdin=None, stdout=None, stderr=None):
+    stdin = _binary(stdin or sys.stdin)
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    parser = make_parser()
+    opts, args = parser.parse_args(argv)
+
+    format_str = "%(message)s"
+    logging.basicConfig(stream=stderr, level=logging.DEBUG if opts.verbose else logging.INFO, format=format_str)
+
+    if args:
+        parser.error("This program takes no un-flagged command-line options")
+    if opts.version:
+        print("py_send_nsca %s" % send_nsca.__version__, file=stdout)
+        return 0
+    if not opts.host_address:
+        parser.error("-H is required")
+    if len(opts.delimiter) > 1:
+        parser.error("delimiter must be a single character")
+    if opts.timeout < 0:
+        parser.error("timeout must be nonnegative")
+    if opts.batch_size < 1:
+        parser.error("batch size must be positive")
+    if opts.processes < 1:
+        parser.error("processes must be positive")
+    if opts.rate is not None and opts.rate <= 0:
+        parser.error("rate must be positive")
+    opts.delimiter = opts.delimiter.encode('latin1')
+
+    sender_kwargs = dict(config_path=opts.config_file, port=opts.port, timeout=opts.timeout)
+    if opts.rate is not None:
+        sender_kwargs['rate_limit'] = opts.rate
+    start = time.time()
+    if opts.processes > 1:
+        opts.stream = True
+        stats = run_sharded(sender_kwargs, stdin, stderr, opts)
+    elif opts.stream:
+        sender = NscaSender(remote_host=opts.host_address, **sender_kwargs)
+        stats = run_stream(sender, stdin, stderr, opts)
+    else:
+        sender = NscaSender(remote_host=opts.host_address, **sender_kwargs)
+        stats = run_simple(sender, stdin, stderr, opts)
+    elapsed = time.time() - start
+    if opts.stream or opts.verbose:
+        print(
+            "Sent %d results in %0.2fs (%0.0f/s); %d lines rejected, %d results failed" % (
+                stats['sent'], elapsed, stats['sent'] / elapsed if elapsed else 0, stats['rejected'], stats['failed']),
+            file=stderr
+        )
+    if stats['failed'] or (stats['rejected'] and not opts.continue_on_error):
+        return 1
+    return 0
@@ -0,0 +1,196 @@
+"""
+A coalescing front end for NscaSender: results are held for a short
+window and only the latest one for each (host, service) is sent, so that
+retries and overlapping schedulers reporting the same check several times
+in a few seconds cost one packet (and one Nagios check result) instead of
+several.
+
+With only_changes, a result whose state and output are the same as the
+last one sent for its (host, service) isn't sent at all, unless it's been
+resend_interval seconds since it last was (which keeps Nagios' freshness
+checking happy).
+"""
+
+from __future__ import with_statement
+
+import collections
+import threading
+import time
+
+from .nsca import log
+
+
+class CoalescingSender(object):
+    def __init__(self, sender, window=5, max_pending=10000, only_changes=False, resend_interval=None, batch_size=500,
+                 max_remembered=100000):
+        """Constructor
+
+        Arguments:
+            sender: the NscaSender that results are sent with
+            window: seconds to hold results for before sending them
+            max_pending: send early once this many distinct (host, service)s are waiting
+            only_changes: if true, don't send results whose state and output are the
+                          same as the last result sent for their (host, service)
+            resend_interval: with only_changes, seconds after which an unchanged result
+                             is sent anyway; None to never resend one
+            batch_size: maximum number of results to send with each send_many()
+            max_remembered: with only_changes, the most (host, service)s to remember the last
+                            result sent for; the least recently sent are forgotten first
+        """
+        self.sender = sender
+        self.window = window
+        self.max_pending = max_pending
+        self.only_changes = only_changes
+        self.resend_interval = resend_interval
+        self.batch_size = batch_size
+        self.max_remembered = max_remembered
+        # counters
+        self.received = 0
+        self.coalesced = 0
+        self.unchanged = 0
+        self.sent = 0
+        self.failed = 0
+        # (host, service) -> (state, description), in the order they first arrived
+        self._pending = collections.OrderedDict()
+        # (host, service) -> (state, description, time sent), with only_changes,
+        # in the order they were last sent
+        self._last_sent = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # only one flush talks to the sender at a time
+        self._send_lock = threading.Lock()
+        self._flush_requested = False
+        self._closed = False
+        self._thread = None
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='CoalescingSender')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send_service(self, host, service, state, description):
+        """Hold a result to be sent at the end of the window, replacing any
+        result already waiting for the same (host, service). Invalid results
+        raise ValueError right away; returns False if the result won't be
+        sent because it's unchanged, True otherwise."""
+        if service is None:
+            service = b''
+        self.sender._check_alert(host=host, service=service, state=state, description=description)
+        key = (host, service)
+        with self._lock:
+            if self._closed:
+                raise ValueError("sender is closed")
+            if self._thread is None:
+                self._start()
+            self.received += 1
+            if self.only_changes and self._unchanged(key, state, description):
+                self.unchanged += 1
+                # whatever was waiting has been superseded by a return to what was last sent
+                if self._pending.pop(key, None) is not None:
+                    self.coalesced += 1
+                return False
+            if key in self._pending:
+                self.coalesced += 1
+            self._pending[key] = (state, description)
+            if len(self._pending) >= self.max_pending and not self._flush_requested:
+                self._flush_requested = True
+                self._wakeup.notify()
+        return True
+
+    def send_host(self, host, state, description):
+        return self.send_service(host, b'', state, description)
+
+    def _unchanged(self, key, state, description):
+        # call with self._lock held
+        last = self._last_sent.get(key)
+        if last is None or last[0] != state or last[1] != description:
+            return False
+        return self.resend_interval is None or time.time() - last[2] < self.resend_interval
+
+    def _prune_last_sent(self, now):
+        # call with self._lock held. Results last sent more than
+        # resend_interval ago would be sent again anyway, so there's no
+        # point remembering them; this keeps a sender seeing an endless
+        # stream of new (host, service)s from growing without bound
+        if self.resend_interval is not None:
+            while self._last_sent:
+                key, (_, _, sent_at) = next(iter(self._last_sent.items()))
+                if now - sent_at < self.resend_interval:
+                    break
+                del self._last_sent[key]
+        while len(self._last_sent) > self.max_remembered:
+            self._last_sent.popitem(last=False)
+
+    def _run(self):
+        next_flush = time.time() + self.window
+        while True:
+            with self._lock:
+                while not self._closed and not self._flush_requested:
+                    remaining = next_flush - time.time()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.wait(remaining)
+                if self._closed:
+                    return
+                self._flush_requested = False
+            next_flush = time.time() + self.window
+            self.flush()
+
+    def flush(self):
+        """Send everything that's waiting now, rather than at the end of the
+        window; returns the number of results sent"""
+        with self._send_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                pending, self._pending = self._pending, collections.OrderedDict()
+            results = [(host, service, state, description) for (host, service), (state, description) in pending.items()]
+            sent_at = time.time()
+            try:
+                errors = self.sender.send_many(results, chunk_size=self.batch_size)
+            except Exception as e:
+                log.error("Unable to send %d NSCA packets to %s (%s)", len(results), self.sender.remote_host, e)
+                with self._lock:
+                    self.failed += len(results)
+                return 0
+            failed = set(index for index, _, _ in errors)
+            with self._lock:
+                if self.only_changes:
+                    for index, (host, service, state, description) in enumerate(results):
+                        if index not in failed:
+                            # re-insert, to move it to the end
+                            self._last_sent.pop((host, service), None)
+                            self._last_sent[(host, service)] = (state, description, sent_at)
+                    self._prune_last_sent(sent_at)
+                self.sent += len(results) - len(failed)
+                self.failed += len(failed)
+            return len(results) - len(failed)
+
+    def forget(self, host, service=b''):
+        """Forget what was last sent for (host, service), so that its next
+        result is sent even if it's unchanged"""
+        with self._lock:
+            self._last_sent.pop((host, service), None)
+
+    def close(self):
+        """Send whatever is waiting, stop the background thread and disconnect"""
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify_all()
+            thread = self._thread
+        if thread is not None:
+            # waits for a flush that's already sending, at most
+            thread.join()
+        self.flush()
+        self.sender.disconnect()
+
+    def counters(self):
+        with self._lock:
+            return {
+                'received': self.received,
+                'coalesced': self.coalesced,
+                'unchanged': self.unchanged,
+                'sent': self.sent,
+                'failed': self.failed,
+                'pending': len(self._pending),
+            }
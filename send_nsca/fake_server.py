@@ -0,0 +1,262 @@
+"""
+Pure-python stand-ins for the nsca daemon, for testing, load-testing and
+benchmarking senders without a real nsca binary or its command file.
+
+Like nsca, they hand each connection an init packet, decrypt what comes
+back with the crypter for crypt_id, and reject packets with a bad CRC32, an
+unknown version or a timestamp more than max_packet_age seconds off. Each
+accepted result is passed to callback, if given, and put on the results
+queue otherwise.
+
+ThreadedNscaServer handles each connection on its own thread;
+AsyncNscaServer handles them all on an asyncio event loop.
+"""
+
+from __future__ import with_statement
+
+import binascii
+import collections
+import os
+import socket
+import struct
+import threading
+import time
+
+from six.moves import queue
+from six.moves import socketserver
+
+from .nsca import (
+    MAX_DESCRIPTION_LENGTH, MAX_HOSTNAME_LENGTH, MAX_PLUGINOUTPUT_LENGTH, PACKET_VERSION, PacketBuilder,
+    _TRANSMITTED_IV_SIZE, _data_packet_size, _init_packet_format, crypters, log,
+)
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+DEFAULT_BACKLOG = 1024
+
+NscaResult = collections.namedtuple(
+    "NscaResult", ["host_name", "service_name", "status", "output", "timestamp", "received"])
+
+
+class PacketError(ValueError):
+    pass
+
+
+def _field(packet, offset, length):
+    value = packet[offset:offset + length]
+    end = value.find(b'\0')
+    return value if end < 0 else value[:end]
+
+
+def decode_packet(packet, max_packet_age=30, now=None):
+    """Check and decode a decrypted data packet into an NscaResult, raising
+    PacketError if nsca would have rejected it"""
+    if len(packet) != _data_packet_size:
+        raise PacketError("packet is %d bytes, not %d" % (len(packet), _data_packet_size))
+    version, crc, timestamp, status = PacketBuilder.header_struct.unpack_from(packet, 0)
+    if version != PACKET_VERSION:
+        raise PacketError("unknown packet version %d" % version)
+    zeroed = bytearray(packet)
+    PacketBuilder.crc_struct.pack_into(zeroed, PacketBuilder.crc_offset, 0)
+    if binascii.crc32(bytes(zeroed)) & 0xffffffff != crc:
+        raise PacketError("CRC32 mismatch")
+    received = time.time()
+    if now is None:
+        now = received
+    if max_packet_age is not None and abs(now - timestamp) > max_packet_age:
+        raise PacketError("packet is %ds old" % (now - timestamp))
+    return NscaResult(
+        _field(packet, PacketBuilder.hostname_offset, MAX_HOSTNAME_LENGTH),
+        _field(packet, PacketBuilder.description_offset, MAX_DESCRIPTION_LENGTH),
+        status,
+        _field(packet, PacketBuilder.output_offset, MAX_PLUGINOUTPUT_LENGTH),
+        timestamp,
+        received,
+    )
+
+
+class _FakeNscaServer(object):
+    def __init__(self, password=b'', crypt_id=1, max_packet_age=30, callback=None):
+        if crypt_id not in crypters:
+            raise ValueError("Unrecognized encryption method %d" % (crypt_id,))
+        self.password = password
+        self.Crypter = crypters[crypt_id]
+        self.max_packet_age = max_packet_age
+        self.callback = callback
+        self.results = queue.Queue()
+        # counters
+        self.connections = 0
+        self.received = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._received_changed = threading.Condition(self._lock)
+
+    def _new_connection(self):
+        """Return the init packet for a new connection and the crypter to
+        decrypt what's sent on it with"""
+        iv = os.urandom(_TRANSMITTED_IV_SIZE)
+        timestamp = int(time.time())
+        with self._lock:
+            self.connections += 1
+        return struct.pack(_init_packet_format, iv, timestamp), self.Crypter(iv, self.password, os.urandom)
+
+    def _handle_packet(self, crypter, packet):
+        try:
+            result = decode_packet(crypter.decrypt(packet), self.max_packet_age)
+        except PacketError as e:
+            log.warning("fake nsca server rejected a packet: %s", e)
+            with self._lock:
+                self.rejected += 1
+                self._received_changed.notify_all()
+            return
+        if self.callback is not None:
+            self.callback(result)
+        else:
+            self.results.put(result)
+        with self._lock:
+            self.received += 1
+            self._received_changed.notify_all()
+
+    def wait_for(self, count, timeout=5):
+        """Block until count packets have been received (accepted or
+        rejected); returns False on timeout. Don't call this from the event
+        loop an AsyncNscaServer is running on."""
+        deadline = time.time() + timeout
+        with self._lock:
+            while self.received + self.rejected < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._received_changed.wait(remaining)
+        return True
+
+    def get_results(self):
+        """Everything on the results queue right now"""
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+
+class _ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = DEFAULT_BACKLOG
+
+
+class ThreadedNscaServer(_FakeNscaServer):
+    def __init__(self, host='127.0.0.1', port=0, **kwargs):
+        """Constructor
+
+        Arguments:
+            host, port: where to listen, right away; port 0 picks a free port (see self.port)
+            password: the shared password
+            crypt_id: the encryption method, as in send_nsca.cfg
+            max_packet_age: seconds a packet's timestamp may be off by; None to not check
+            callback: called with each accepted NscaResult, from the connection's thread;
+                      if None, results are put on self.results
+        """
+        super(ThreadedNscaServer, self).__init__(**kwargs)
+        fake = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                fake._serve(self.request)
+        self._server = _ThreadedTCPServer((host, port), Handler)
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    def _serve(self, conn):
+        init_packet, crypter = self._new_connection()
+        conn.sendall(init_packet)
+        packet = bytearray(_data_packet_size)
+        view = memoryview(packet)
+        try:
+            while True:
+                have = 0
+                while have < _data_packet_size:
+                    n = conn.recv_into(view[have:])
+                    if not n:
+                        return
+                    have += n
+                self._handle_packet(crypter, bytes(packet))
+        except socket.error:
+            pass
+
+    def start(self):
+        # a short poll interval keeps stop() quick
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), name='ThreadedNscaServer')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if asyncio is not None:
+    class _NscaProtocol(asyncio.Protocol):
+        def __init__(self, fake):
+            self.fake = fake
+            self.buffer = bytearray()
+            self.crypter = None
+
+        def connection_made(self, transport):
+            init_packet, self.crypter = self.fake._new_connection()
+            transport.write(init_packet)
+
+        def data_received(self, data):
+            self.buffer.extend(data)
+            packets = len(self.buffer) // _data_packet_size
+            for i in range(packets):
+                offset = i * _data_packet_size
+                self.fake._handle_packet(self.crypter, bytes(self.buffer[offset:offset + _data_packet_size]))
+            del self.buffer[:packets * _data_packet_size]
+
+
+class AsyncNscaServer(_FakeNscaServer):
+    def __init__(self, host='127.0.0.1', port=0, **kwargs):
+        """Constructor
+
+        Takes the same arguments as ThreadedNscaServer, but doesn't listen
+        until started, and calls callback from the event loop.
+        """
+        if asyncio is None:
+            raise RuntimeError("AsyncNscaServer needs asyncio")
+        super(AsyncNscaServer, self).__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def start(self):
+        """Start listening; await the returned future"""
+        loop = asyncio.get_event_loop()
+        started = asyncio.ensure_future(loop.create_server(
+            lambda: _NscaProtocol(self), self.host, self.port, backlog=DEFAULT_BACKLOG))
+
+        def listening(future):
+            if not future.cancelled() and future.exception() is None:
+                self._server = future.result()
+                self.port = self._server.sockets[0].getsockname()[1]
+        started.add_done_callback(listening)
+        return started
+
+    def stop(self):
+        """Stop listening; await the returned future"""
+        self._server.close()
+        return asyncio.ensure_future(self._server.wait_closed())
@@ -1,7 +1,8 @@
 #!/usr/bin/python
 #
 # send_nsca.py: A replacement for the C-based send_nsca, able
-# to be run in pure-python. Depends on PyCrypto and Python >= 2.6.
+# to be run in pure-python. Depends on Python >= 2.6, and on pycryptodome,
+# PyCrypto or cryptography for the block ciphers (see backends.py).
 #
 # Heavily inspired by (and protocol-compatible with) the original send_nsca,
 # written by Ethan Galstad <nagios@nagios.org>, which was available under
@@ -21,26 +22,26 @@
 
 from __future__ import with_statement
 
-import array
 import binascii
+import collections
+import errno
 import functools
 import logging
 import math
 import os
-import random
+import select
 import socket
 import struct
+import threading
+import time
 
-import Crypto.Cipher.AES
-import Crypto.Cipher.ARC2
-import Crypto.Cipher.Blowfish
-import Crypto.Cipher.DES
-import Crypto.Cipher.DES3
-import Crypto.Cipher.CAST
-import Crypto.Util.randpool
 import six
 
+from . import backends
 from . import nagios
+from . import ratelimit
+from . import resolver
+from . import stats as metrics
 
 MAX_PASSWORD_LENGTH = 512
 MAX_HOSTNAME_LENGTH = 64
@@ -53,8 +54,45 @@ PACKET_VERSION = 3
 
 DEFAULT_PORT = 5667
 
+DEFAULT_CONFIG_PATH = '/etc/send_nsca.cfg'
+
 log = logging.getLogger("send_nsca")
 
+_CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, 'WSAEWOULDBLOCK', None))
+
+
+def _wait_for_sockets(readers, writers, timeout):
+    """Wait up to timeout seconds (None for ever) for any of readers to
+    become readable or writers writable, like select.select(), and return
+    (readable, writable, failed).
+
+    poll() is used where there is one, since select() raises ValueError
+    for file descriptors of FD_SETSIZE (usually 1024) or more, which a
+    long-running process with lots of files open can easily get."""
+    if not hasattr(select, 'poll'):
+        return select.select(readers, writers, readers + writers, timeout)
+    poller = select.poll()
+    sockets = {}
+    masks = {}
+    for sockets_, mask in ((readers, select.POLLIN | select.POLLPRI), (writers, select.POLLOUT)):
+        for s in sockets_:
+            fd = s.fileno()
+            sockets[fd] = s
+            masks[fd] = masks.get(fd, 0) | mask
+    for fd, mask in masks.items():
+        poller.register(fd, mask)
+    events = poller.poll(None if timeout is None else int(math.ceil(timeout * 1000)))
+    readable, writable, failed = [], [], []
+    for fd, event in events:
+        s = sockets[fd]
+        if event & (select.POLLIN | select.POLLPRI):
+            readable.append(s)
+        if event & select.POLLOUT:
+            writable.append(s)
+        if event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+            failed.append(s)
+    return readable, writable, failed
+
 ########  CIPHERS AND CRYPTERS IMPLEMENTATION ########
 
 crypters = {}
@@ -68,6 +106,26 @@ class _MetaCrypter(type):
         return cls
 
 
+if hasattr(int, 'from_bytes'):
+    def _xor_bytes(left, right):
+        """XOR two equal-length byte strings as a pair of big integers"""
+        length = len(left)
+        return (int.from_bytes(left, 'big') ^ int.from_bytes(right, 'big')).to_bytes(length, 'big')
+else:
+    def _xor_bytes(left, right):
+        """XOR two equal-length byte strings as a pair of big integers"""
+        if not left:
+            return b''
+        value = int(binascii.hexlify(left), 16) ^ int(binascii.hexlify(right), 16)
+        return binascii.unhexlify('%0*x' % (2 * len(left), value))
+
+
+def _repeat_to_length(value, length):
+    if not value:
+        return b'\0' * length
+    return (value * (length // len(value) + 1))[:length]
+
+
 class Crypter(six.with_metaclass(_MetaCrypter, object)):
     crypt_id = -1
 
@@ -76,13 +134,42 @@ class Crypter(six.with_metaclass(_MetaCrypter, object)):
         self.password = password
         self.random_generator = random_generator
 
+    @classmethod
+    def available(cls):
+        """Whether this crypter can be used with the libraries installed"""
+        return cls.crypt_id >= 0
+
     def encrypt(self, value):
         raise NotImplementedError("Implement me!")
 
+    def decrypt(self, value):
+        """The server's side of encrypt(), for receiving packets"""
+        raise NotImplementedError("Implement me!")
+
+    def encrypt_packets(self, value):
+        """Encrypt several data packets that were concatenated together.
+
+        Stream ciphers carry their state from one packet to the next, so
+        by default a batch is just a longer stream."""
+        return self.encrypt(value)
+
+    def encrypt_into(self, buf):
+        """Encrypt buf, a bytearray of whole data packets, in place and
+        return a memoryview of it for sendall().
+
+        By default this copies through encrypt_packets(); crypters that can
+        write their output straight back into buf override it."""
+        buf[:] = self.encrypt_packets(bytes(buf))
+        return memoryview(buf)
+
 
 class UnsupportedCrypter(Crypter):
     crypt_id = -1
 
+    @classmethod
+    def available(cls):
+        return False
+
 
 class NullCrypter(Crypter):
     crypt_id = 0
@@ -90,65 +177,157 @@ class NullCrypter(Crypter):
     def encrypt(self, value):
         return value
 
+    def decrypt(self, value):
+        return value
+
+    def encrypt_packets(self, value):
+        return value
+
+    def encrypt_into(self, buf):
+        return memoryview(buf)
+
 
 class XORCrypter(Crypter):
+    """XOR against the IV and then the password, restarting at the first
+    byte of each of them for every packet (just like nsca does).
+
+    The combined IV^password keystream is computed once per connection, so
+    encrypting a packet is a single big-integer XOR."""
     crypt_id = 1
 
+    def __init__(self, *args):
+        super(XORCrypter, self).__init__(*args)
+        self.packet_keystream = self.keystream(_data_packet_size)
+
+    def keystream(self, length):
+        return _xor_bytes(
+            _repeat_to_length(self.iv, length),
+            _repeat_to_length(self.password, length),
+        )
+
     def encrypt(self, value):
-        value_s = six.iterbytes(value)
-        repeated_iv = six.iterbytes(list(int(math.ceil(float(len(value)) / len(self.iv))) * self.iv))
-        repeated_password = six.iterbytes(list(int(math.ceil(float(len(value)) / len(self.password))) * self.password))
-        xor1 = [a ^ b for a, b in zip(value_s, repeated_iv)]
-        xor2 = [a ^ b for a, b in zip(xor1, repeated_password)]
-        return b''.join(map(six.int2byte, xor2))
+        if len(value) == len(self.packet_keystream):
+            return _xor_bytes(value, self.packet_keystream)
+        return _xor_bytes(value, self.keystream(len(value)))
+
+    # XOR is its own inverse
+    decrypt = encrypt
+
+    def encrypt_packets(self, value):
+        count, remainder = divmod(len(value), _data_packet_size)
+        if remainder:
+            raise ValueError("%d bytes is not a whole number of packets" % (len(value),))
+        return _xor_bytes(value, self.packet_keystream * count)
+
+    def encrypt_into(self, buf):
+        # the big integers read the bytearray directly; only the result is copied back
+        buf[:] = self.encrypt_packets(buf)
+        return memoryview(buf)
+
+
+# derived keys and cipher factories, by (crypter class, password)
+_cipher_setups = {}
+_MAX_CIPHER_SETUPS = 64
 
 
 class CryptoCrypter(Crypter):
+    """Encrypts with a block cipher in (8-bit) CFB mode, carrying its state
+    from packet to packet like mcrypt does. The cipher comes from whichever
+    installed library backends.backend_for() picks, which is only imported
+    the first time one of these is created.
+
+    Deriving the key from the password, and looking up how to make the
+    cipher, is done once per (class, password) and cached; each connection
+    only has to create a cipher with its own IV. The ciphers can't be
+    handed an already-expanded key schedule, so creating one still expands
+    the key."""
     crypt_id = -1
-    # override this
-    CryptoCipher = Crypto.Cipher.DES
+    # override this: one of the algorithms in backends
+    algorithm = backends.DES
     # usually override this
     key_size = 7
     # rarely override this
     iv_size = None
 
+    @classmethod
+    def available(cls):
+        try:
+            backends.backend_for(cls.algorithm)
+        except backends.BackendUnavailable:
+            return False
+        return cls.crypt_id >= 0
+
+    @classmethod
+    def _cipher_setup(cls, password):
+        """Return (key, iv_size, backend, cipher_factory) for password, where
+        cipher_factory(iv) makes a new CFB cipher"""
+        cache_key = (cls, password)
+        setup = _cipher_setups.get(cache_key)
+        if setup is None:
+            if len(password) >= cls.key_size:
+                key = password[:cls.key_size]
+            else:
+                key = password + b'\0' * (cls.key_size - len(password))
+            iv_size = cls.iv_size if cls.iv_size is not None else backends.block_sizes[cls.algorithm]
+            backend = backends.backend_for(cls.algorithm)
+            setup = (key, iv_size, backend, backend.cfb_factory(cls.algorithm, key))
+            if len(_cipher_setups) >= _MAX_CIPHER_SETUPS:
+                _cipher_setups.clear()
+            _cipher_setups[cache_key] = setup
+        return setup
+
     def __init__(self, *args):
         super(CryptoCrypter, self).__init__(*args)
-        key = self.password
+        key, iv_size, backend, cipher_factory = self._cipher_setup(self.password)
         iv = self.iv
-        if self.iv_size is not None:
-            iv_size = self.iv_size
+        if len(iv) >= iv_size:
+            iv = iv[:iv_size]
         else:
-            iv_size = self.CryptoCipher.block_size
-        if len(self.password) >= self.key_size:
-            key = self.password[:self.key_size]
-        else:
-            key += b'\0' * (self.key_size - len(self.password))
-        if len(self.iv) >= self.CryptoCipher.block_size:
-            iv = self.iv[:iv_size]
-        else:
-            iv += self.random_generator(iv_size - self.iv)
-        self.crypter = self.CryptoCipher.new(key, self.CryptoCipher.MODE_CFB, iv)
+            iv += self.random_generator(iv_size - len(iv))
+        self.key = key
+        self.cipher_iv = iv
+        self.cipher_factory = cipher_factory
+        self.backend = backend.name
+        self.crypter = cipher_factory(iv)
+        self.decrypter = None
+        self.encrypts_in_place = backend.encrypts_in_place
 
     def encrypt(self, value):
         return self.crypter.encrypt(value)
 
+    def encrypt_into(self, buf):
+        if self.encrypts_in_place:
+            try:
+                # pycryptodome can write the ciphertext over the plaintext
+                self.crypter.encrypt(buf, output=buf)
+                return memoryview(buf)
+            except TypeError:
+                # older versions can't; copy from now on
+                self.encrypts_in_place = False
+        return super(CryptoCrypter, self).encrypt_into(buf)
+
+    def decrypt(self, value):
+        # CFB keeps separate state in each direction
+        if self.decrypter is None:
+            self.decrypter = self.cipher_factory(self.cipher_iv)
+        return self.decrypter.decrypt(value)
+
 
 class DESCrypter(CryptoCrypter):
     crypt_id = 2
-    CryptoCipher = Crypto.Cipher.DES
+    algorithm = backends.DES
     key_size = 8
 
 
 class DES3Crypter(CryptoCrypter):
     crypt_id = 3
-    CryptoCipher = Crypto.Cipher.DES3
+    algorithm = backends.DES3
     key_size = 24
 
 
 class CAST128Crypter(CryptoCrypter):
     crypt_id = 4
-    CryptoCipher = Crypto.Cipher.CAST
+    algorithm = backends.CAST128
     key_size = 16
 
 
@@ -156,8 +335,10 @@ class CAST256Crypter(UnsupportedCrypter):
     crypt_id = 5
 
 
-class XTEACrypter(UnsupportedCrypter):
+class XTEACrypter(CryptoCrypter):
     crypt_id = 6
+    algorithm = backends.XTEA
+    key_size = 16
 
 
 class ThreeWayCrypter(UnsupportedCrypter):
@@ -166,12 +347,14 @@ class ThreeWayCrypter(UnsupportedCrypter):
 
 class BlowFishCrypter(CryptoCrypter):
     crypt_id = 8
-    CryptoCipher = Crypto.Cipher.Blowfish
+    algorithm = backends.BLOWFISH
     key_size = 56
 
 
-class TwoFishCrypter(UnsupportedCrypter):
+class TwoFishCrypter(CryptoCrypter):
     crypt_id = 9
+    algorithm = backends.TWOFISH
+    key_size = 32
 
 
 class Loki97Crypter(UnsupportedCrypter):
@@ -180,7 +363,7 @@ class Loki97Crypter(UnsupportedCrypter):
 
 class RC2Crypter(CryptoCrypter):
     crypt_id = 11
-    CryptoCipher = Crypto.Cipher.ARC2
+    algorithm = backends.RC2
     key_size = 128
 
 
@@ -191,68 +374,174 @@ class RC4Crypter(UnsupportedCrypter):
     # doesn't have a CFB mode)
 
 
-class RC6Crypter(UnsupportedCrypter):
+class RC6Crypter(CryptoCrypter):
     crypt_id = 13
+    algorithm = backends.RC6
+    key_size = 256
 
 
 class AES128Crypter(CryptoCrypter):
     crypt_id = 14
-    CryptoCipher = Crypto.Cipher.AES
+    algorithm = backends.AES
     key_size = 16
 
 
 class AES192Crypter(CryptoCrypter):
     crypt_id = 15
-    CryptoCipher = Crypto.Cipher.AES
+    algorithm = backends.AES
     key_size = 24
 
 
 class AES256Crypter(CryptoCrypter):
     crypt_id = 16
-    CryptoCipher = Crypto.Cipher.AES
+    algorithm = backends.AES
     key_size = 32
 
 ########  WIRE PROTOCOL IMPLEMENTATION ########
 
 _data_packet_format = '!hxxLLh%ds%ds%dsxx' % (MAX_HOSTNAME_LENGTH, MAX_DESCRIPTION_LENGTH, MAX_PLUGINOUTPUT_LENGTH)
 _init_packet_format = '!%dsL' % (_TRANSMITTED_IV_SIZE,)
+_init_packet_struct = struct.Struct(_init_packet_format)
+_init_packet_size = _init_packet_struct.size
+_data_packet_size = struct.calcsize(_data_packet_format)
 
 
-def get_random_alphanumeric_bytes(bytesz):
-    return ''.join(chr(random.randrange(ord('0'), ord('Z'))) for _ in range(bytesz)).encode('US-ASCII')
+_PADDING_ALPHABET = bytearray(range(ord('0'), ord('Z')))
+# maps every possible random byte onto the padding alphabet
+_padding_table = bytes(bytearray(_PADDING_ALPHABET[i % len(_PADDING_ALPHABET)] for i in range(256)))
+
+
+class FreshPadding(object):
+    """Padding drawn fresh from the random generator on every call"""
+
+    def __init__(self, random_generator=os.urandom):
+        self.random_generator = random_generator
+
+    def __call__(self, bytesz):
+        return self.random_generator(bytesz).translate(_padding_table)
+
+
+class PooledPadding(object):
+    """Padding sliced out of a pool of pre-generated random bytes, which is
+    refilled a block at a time when it runs out. Much cheaper than
+    FreshPadding, at the cost of generating padding ahead of time.
+
+    Safe to share between threads: no two calls get the same padding."""
 
+    def __init__(self, block_size=65536, random_generator=os.urandom):
+        self.block_size = block_size
+        self.fresh = FreshPadding(random_generator)
+        self._lock = threading.Lock()
+        self.refill()
 
-def _pack_packet(hostname, service, state, output, timestamp):
+    def refill(self):
+        with self._lock:
+            self._refill()
+
+    def _refill(self):
+        # call with self._lock held
+        self._pool = self.fresh(self.block_size)
+        self._offset = 0
+
+    def _after_fork(self):
+        # another thread may have held the lock when we forked, and it isn't
+        # around in the child to release it
+        self._lock = threading.Lock()
+        self.refill()
+
+    def __call__(self, bytesz):
+        if bytesz > self.block_size:
+            return self.fresh(bytesz)
+        with self._lock:
+            offset = self._offset
+            end = offset + bytesz
+            pool = self._pool
+            if end > len(pool):
+                self._refill()
+                pool = self._pool
+                offset, end = 0, bytesz
+            self._offset = end
+        return pool[offset:end]
+
+
+_default_padding = PooledPadding()
+if hasattr(os, 'register_at_fork'):
+    # don't let forked children hand out the same padding as their parent
+    os.register_at_fork(after_in_child=_default_padding._after_fork)
+
+
+def get_random_alphanumeric_bytes(bytesz):
+    return _default_padding(bytesz)
+
+
+PADDING_POOL = 'pool'
+PADDING_FRESH = 'fresh'
+
+DNS_CACHE_SHARED = 'shared'
+
+
+class PacketBuilder(object):
+    """Packs data packets using precompiled structs and fixed field offsets.
+
+    build() and build_into() write into a buffer that is reused from packet
+    to packet, so a PacketBuilder must not be shared between threads."""
+    header_struct = struct.Struct('!hxxLLh')
+    crc_struct = struct.Struct('!L')
+    crc_offset = 4
+    hostname_offset = header_struct.size
+    description_offset = hostname_offset + MAX_HOSTNAME_LENGTH
+    output_offset = description_offset + MAX_DESCRIPTION_LENGTH
+    trailer_offset = output_offset + MAX_PLUGINOUTPUT_LENGTH
+    packet_size = _data_packet_size
+
+    def __init__(self, padding=None):
+        """padding is a callable returning that many padding bytes; by default
+        the shared pool behind get_random_alphanumeric_bytes is used."""
+        self.padding = padding
+        self.buffer = bytearray(self.packet_size)
+
+    @staticmethod
+    def _pack_field(buf, start, size, value, padding):
+        """NUL-terminate value and fill the rest of the field with padding,
+        truncating (without a terminator) if it doesn't fit"""
+        length = len(value)
+        if length >= size:
+            buf[start:start + size] = value[:size]
+            return
+        end = start + length
+        buf[start:end] = value
+        buf[end] = 0
+        if length + 1 < size:
+            buf[end + 1:start + size] = padding(size - length - 1)
+
+    def pack_into(self, buf, offset, hostname, service, state, output, timestamp):
+        """Write a complete packet (CRC included) into buf at offset"""
+        padding = self.padding
+        if padding is None:
+            padding = get_random_alphanumeric_bytes
+        self.header_struct.pack_into(buf, offset, PACKET_VERSION, 0, timestamp, state)
+        self._pack_field(buf, offset + self.hostname_offset, MAX_HOSTNAME_LENGTH, hostname, padding)
+        self._pack_field(buf, offset + self.description_offset, MAX_DESCRIPTION_LENGTH, service, padding)
+        self._pack_field(buf, offset + self.output_offset, MAX_PLUGINOUTPUT_LENGTH, output, padding)
+        buf[offset + self.trailer_offset:offset + self.packet_size] = b'\0\0'
+        crc_val = binascii.crc32(memoryview(buf)[offset:offset + self.packet_size]) & 0xffffffff
+        self.crc_struct.pack_into(buf, offset + self.crc_offset, crc_val)
+
+    def build(self, hostname, service, state, output, timestamp):
+        """Return a packet as bytes; the only copy made is out of the buffer"""
+        return bytes(self.build_into(hostname, service, state, output, timestamp))
+
+    def build_into(self, hostname, service, state, output, timestamp):
+        """Pack a packet into the reused buffer and return the buffer itself,
+        which is overwritten by the next build"""
+        self.pack_into(self.buffer, 0, hostname, service, state, output, timestamp)
+        return self.buffer
+
+
+def _pack_packet(hostname, service, state, output, timestamp, padding=None):
     """This is more complicated than a call to struct.pack() because we want
     to pad our strings with random bytes, instead of with zeros."""
-    requested_length = struct.calcsize(_data_packet_format)
-    packet = array.array('B', b'\0' * requested_length)
-    # first, pack the version, initial crc32, timestamp, and state
-    # (collectively:header)
-    header_format = '!hxxLLh'
-    offset = struct.calcsize(header_format)
-    struct.pack_into('!hxxLLh', packet, 0, PACKET_VERSION, 0, timestamp, state)
-    # next, pad & pack the hostname
-    hostname = hostname + b'\0'
-    if len(hostname) < MAX_HOSTNAME_LENGTH:
-        hostname += get_random_alphanumeric_bytes(MAX_HOSTNAME_LENGTH - len(hostname))
-    struct.pack_into('!%ds' % (MAX_HOSTNAME_LENGTH,), packet, offset, hostname)
-    offset += struct.calcsize('!%ds' % (MAX_HOSTNAME_LENGTH,))
-    # next, pad & pack the service description
-    service = service + b'\0'
-    if len(service) < MAX_DESCRIPTION_LENGTH:
-        service += get_random_alphanumeric_bytes(MAX_DESCRIPTION_LENGTH - len(service))
-    struct.pack_into('%ds' % (MAX_DESCRIPTION_LENGTH,), packet, offset, service)
-    offset += struct.calcsize('!%ds' % (MAX_DESCRIPTION_LENGTH))
-    # finally, pad & pack the plugin output
-    output = output + b'\0'
-    if len(output) < MAX_PLUGINOUTPUT_LENGTH:
-        output += get_random_alphanumeric_bytes(MAX_PLUGINOUTPUT_LENGTH - len(output))
-    struct.pack_into('%ds' % (MAX_PLUGINOUTPUT_LENGTH,), packet, offset, output)
-    # compute the CRC32 of what we have so far
-    crc_val = binascii.crc32(packet) & 0xffffffff
-    struct.pack_into('!L', packet, 4, crc_val)
-    return packet.tostring()
+    return PacketBuilder(padding).build(hostname, service, state, output, timestamp)
 
 
 ########  MAIN CLASS IMPLEMENTATION ########
@@ -270,63 +559,232 @@ class ConfigParseError(Exception):
         return "ConfigParseError(%s, %d, %s)" % (self.filename, self.lineno, self.msg)
 
 
+class NscaConfig(collections.namedtuple('NscaConfig', ['password', 'encryption_method'])):
+    """A parsed send_nsca.cfg; a setting that isn't in the file is None"""
+    __slots__ = ()
+
+    @property
+    def Crypter(self):
+        if self.encryption_method is None:
+            return None
+        return crypters[self.encryption_method]
+
+
+def parse_config_file(config_file_object, config_path=""):
+    """Parse an open send_nsca.cfg into an NscaConfig, raising
+    ConfigParseError if it isn't valid"""
+    password = encryption_method = None
+    config_file_object.seek(0)
+    for line_no, line in enumerate(config_file_object):
+        if b'=' not in line or line.lstrip().startswith(b'#'):
+            continue
+        key, value = [res.strip() for res in line.split(b'=')]
+        try:
+            if key == b'password':
+                if len(value) > MAX_PASSWORD_LENGTH:
+                    raise ConfigParseError(config_path, line_no, "Password too long; max %d" % MAX_PASSWORD_LENGTH)
+                assert isinstance(value, bytes), value
+                password = value
+            elif key == b'encryption_method':
+                encryption_method = int(value)
+                if encryption_method not in crypters.keys():
+                    raise ConfigParseError(
+                        config_path,
+                        line_no,
+                        "Unrecognized uncryption method %d" % (encryption_method,)
+                    )
+                Crypter = crypters[encryption_method]
+                if issubclass(Crypter, UnsupportedCrypter):
+                    raise ConfigParseError(
+                        config_path,
+                        line_no,
+                        "Unsupported cipher type %d (%s)" % (Crypter.crypt_id, Crypter.__name__)
+                    )
+            else:
+                raise ConfigParseError(config_path, line_no, "Unrecognized key '%s'" % (key,))
+        except ConfigParseError:
+            raise
+        except:
+            raise ConfigParseError(config_path, line_no, "Could not parse value '%s' for key '%s'" % (value, key))
+    return NscaConfig(password, encryption_method)
+
+
+class _ConfigEntry(object):
+    __slots__ = ('config', 'version', 'checked')
+
+    def __init__(self, config, version, checked):
+        self.config = config
+        self.version = version
+        self.checked = checked
+
+
+def _file_version(st):
+    return (st.st_dev, st.st_ino, getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size)
+
+
+class ConfigCache(object):
+    """Parsed config files, shared between senders, so that making a sender
+    doesn't have to read and parse its config file again. A file is
+    re-read when its inode, mtime or size changes, which is checked for at
+    most every check_interval seconds."""
+
+    def __init__(self, check_interval=5):
+        self.check_interval = check_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Return the NscaConfig for path"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None:
+            if now - entry.checked < self.check_interval:
+                return entry.config
+            try:
+                version = _file_version(os.stat(path))
+            except OSError:
+                version = None
+            if version == entry.version:
+                entry.checked = now
+                return entry.config
+        return self.reload(path)
+
+    def reload(self, path):
+        """Re-read path now, whether or not it looks like it has changed"""
+        with open(path, 'rb') as f:
+            version = _file_version(os.fstat(f.fileno()))
+            config = parse_config_file(f, config_path=path)
+        with self._lock:
+            self._entries[path] = _ConfigEntry(config, version, time.time())
+        return config
+
+    def clear(self, path=None):
+        """Forget everything, or just path"""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+
+# shared by every NscaSender
+config_cache = ConfigCache()
+
+
+class PartialSendError(socket.error):
+    """Sending reached some servers but not the others; missed lists the
+    addresses of those it didn't reach"""
+
+    def __init__(self, message, missed):
+        super(PartialSendError, self).__init__(message)
+        self.missed = missed
+
+
 class NscaSender(object):
-    def __init__(self, remote_host, config_path='/etc/send_nsca.cfg', port=DEFAULT_PORT, timeout=10, send_to_all=True):
+    def __init__(self, remote_host, config_path=DEFAULT_CONFIG_PATH, port=DEFAULT_PORT, timeout=10, send_to_all=True,
+                 padding=PADDING_POOL, reconnect=True, reconnect_backoff=0.5, max_reconnect_backoff=30,
+                 connect_stagger=0.25, spool=None, stats=None, connect_timeout=None, handshake_timeout=None,
+                 send_timeout=None, dns_cache=DNS_CACHE_SHARED, rate_limit=None, rate_burst=None,
+                 adaptive_rate=False):
         """Constructor
 
         Arguments:
             config_path: path to the nsca config file. Usually /etc/send_nsca.cfg. None to disable.
             remote_host: host to send to
             send_to_all: If true, will repeat your message to *all* hosts that match the lookup for remote_host
+            timeout: default for the three timeouts below; None or 0 for no timeout
+            connect_timeout: seconds allowed for connecting to all of them (None to use timeout)
+            handshake_timeout: seconds allowed, once connected, for reading all of their init
+                               packets (None to use timeout)
+            send_timeout: seconds each send to a connection may block for (None to use timeout)
+            dns_cache: DNS_CACHE_SHARED to look remote_host up through the resolver.ResolverCache
+                       shared by every sender, a ResolverCache of its own, or None to look it
+                       up afresh for every connect
+            connect_stagger: If not send_to_all, seconds to wait for one address to connect before also
+                             trying the next
+            spool: a spool.Spool to keep results in when they can't be sent, instead of raising;
+                   they are replayed, oldest first, the next time sending works
+            padding: PADDING_POOL to pad packets from a shared pool of pre-generated random bytes,
+                     PADDING_FRESH to generate new random padding for every packet, or a callable
+                     returning the requested number of padding bytes
+            reconnect: If true, a connection that breaks is re-established (and the packet
+                       retried once) instead of failing every later send
+            reconnect_backoff: seconds to hold off reconnecting after a failed reconnect,
+                               doubling with each further failure...
+            max_reconnect_backoff: ...up to this many seconds
+            stats: an object with incr(name, count) and timing(name, seconds) methods to report
+                   counters and timings to; see send_nsca.stats
+            rate_limit: packets per second to send to each server (each address of remote_host
+                        is paced on its own), or a dict of them by server IP address, with
+                        the rate for any others under None; None for no limit
+            rate_burst: packets that may be sent to a server at once after a quiet spell
+                        (default: one second's worth)
+            adaptive_rate: if true, halve a server's rate whenever a send to it blocks, and
+                           recover gradually; see send_nsca.ratelimit
         """
         self.port = port
-        self.timeout = timeout
-        self.password = ''
+        # 0 has always meant no timeout on the command line
+        self.timeout = timeout or None
+        self.connect_timeout = connect_timeout
+        self.handshake_timeout = handshake_timeout
+        self.send_timeout = send_timeout
+        self.password = b''
         self.encryption_method_i = 0
         self.remote_host = remote_host
         self.send_to_all = send_to_all
         self._conns = []
         self._connected = False
+        self._handshake_times = {}
+        self._last_used = {}
+        self._conn_addrs = {}
+        self.connect_results = {}
+        self.connect_stagger = connect_stagger
+        self.spool = spool
+        self.stats = stats
+        if dns_cache == DNS_CACHE_SHARED:
+            dns_cache = resolver.default_cache
+        self.dns_cache = dns_cache
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.adaptive_rate = adaptive_rate
+        # by server address, so they survive reconnects
+        self._rate_limiters = {}
+        self.reconnect = reconnect
+        self.reconnect_backoff = reconnect_backoff
+        self.max_reconnect_backoff = max_reconnect_backoff
+        # by index in self._conns, so that one server staying down doesn't hold back reconnecting to the others
+        self._reconnect_delays = {}
+        self._next_reconnect_times = {}
         self.Crypter = Crypter
         self._cached_crypters = {}
         self.random_generator = os.urandom
+        if padding == PADDING_POOL:
+            self.padding = get_random_alphanumeric_bytes
+        elif padding == PADDING_FRESH:
+            self.padding = FreshPadding(self.random_generator)
+        elif callable(padding):
+            self.padding = padding
+        else:
+            raise ValueError("padding %r should be one of {%s, %s} or a callable" % (padding, PADDING_POOL, PADDING_FRESH))
+        self._packet_builder = PacketBuilder(self.padding)
+        self.config = None
         if config_path is not None:
-            with open(config_path, 'rb') as f:
-                self.parse_config(f, config_path=config_path)
+            self._apply_config(config_cache.get(config_path))
 
     def parse_config(self, config_file_object, config_path=""):
-        config_file_object.seek(0)
-        for line_no, line in enumerate(config_file_object):
-            if b'=' not in line or line.lstrip().startswith(b'#'):
-                continue
-            key, value = [res.strip() for res in line.split(b'=')]
-            try:
-                if key == b'password':
-                    if len(value) > MAX_PASSWORD_LENGTH:
-                        raise ConfigParseError(config_path, line_no, "Password too long; max %d" % MAX_PASSWORD_LENGTH)
-                    assert isinstance(value, bytes), value
-                    self.password = value
-                elif key == b'encryption_method':
-                    self.encryption_method_i = int(value)
-                    if self.encryption_method_i not in crypters.keys():
-                        raise ConfigParseError(
-                            config_path,
-                            line_no,
-                            "Unrecognized uncryption method %d" % (self.encryption_method_i,)
-                        )
-                    self.Crypter = crypters[self.encryption_method_i]
-                    if issubclass(self.Crypter, UnsupportedCrypter):
-                        raise ConfigParseError(
-                            config_path,
-                            line_no,
-                            "Unsupported cipher type %d (%s)" % (self.Crypter.crypt_id, self.Crypter.__name__)
-                        )
-                else:
-                    raise ConfigParseError(config_path, line_no, "Unrecognized key '%s'" % (key,))
-            except ConfigParseError:
-                raise
-            except:
-                raise ConfigParseError(config_path, line_no, "Could not parse value '%s' for key '%s'" % (value, key))
+        """Parse an already-open config file and apply it to this sender"""
+        config = parse_config_file(config_file_object, config_path)
+        self._apply_config(config)
+        return config
+
+    def _apply_config(self, config):
+        self.config = config
+        if config.password is not None:
+            self.password = config.password
+        if config.encryption_method is not None:
+            self.encryption_method_i = config.encryption_method
+            self.Crypter = config.Crypter
 
     def _check_alert(self, host=None, service=None, state=None, description=None):
         if state not in nagios.States.keys():
@@ -345,63 +803,540 @@ class NscaSender(object):
             if len(service) > MAX_DESCRIPTION_LENGTH:
                 raise ValueError("service %r too long (max length %d)" % (service, MAX_DESCRIPTION_LENGTH))
 
+    def _get_crypter(self, conn, iv):
+        if conn not in self._cached_crypters:
+            self._cached_crypters[conn] = self.Crypter(iv, self.password, self.random_generator)
+        return self._cached_crypters[conn]
+
+    def _packet_timestamp(self, conn, timestamp):
+        """nsca drops packets whose timestamp is older than its max_packet_age,
+        so advance the timestamp from the handshake by however long the
+        connection has been open"""
+        return timestamp + int(time.time() - self._handshake_times[conn])
+
+    def _timeout_for(self, timeout):
+        """Resolve one of the specific timeouts, which default to self.timeout"""
+        if timeout is None:
+            return self.timeout
+        return timeout or None
+
+    def _deadline(self, timeout):
+        timeout = self._timeout_for(timeout)
+        return None if timeout is None else time.time() + timeout
+
+    def _incr(self, name, count=1):
+        if self.stats is not None:
+            self.stats.incr(name, count)
+
+    def _timing(self, name, start):
+        if self.stats is not None:
+            self.stats.timing(name, time.time() - start)
+
+    def _pack_and_encrypt(self, pack, encrypt):
+        """Return encrypt(pack()), timing each if there's a stats object"""
+        stats = self.stats
+        if stats is None:
+            return encrypt(pack())
+        start = time.time()
+        packed = pack()
+        encrypt_start = time.time()
+        stats.timing(metrics.PACK, encrypt_start - start)
+        payload = encrypt(packed)
+        stats.timing(metrics.ENCRYPT, time.time() - encrypt_start)
+        return payload
+
     def send_service(self, host, service, state, description):
-        self._check_alert(host=host, service=service, state=state, description=description)
-        self.connect()
-        for conn, iv, timestamp in self._conns:
-            if conn not in self._cached_crypters:
-                self._cached_crypters[conn] = self.Crypter(iv, self.password, self.random_generator)
-            crypter = self._cached_crypters[conn]
-            packet = _pack_packet(host, service, state, description, timestamp)
-            packet = crypter.encrypt(packet)
-            conn.sendall(packet)
+        try:
+            self._check_alert(host=host, service=service, state=state, description=description)
+        except ValueError:
+            self._incr(metrics.VALIDATION_FAILURES)
+            raise
+        try:
+            self.connect()
+            self._replay_spool()
+
+            def make_packet(conn, crypter, timestamp):
+                return self._pack_and_encrypt(
+                    lambda: self._packet_builder.build_into(host, service, state, description, timestamp),
+                    crypter.encrypt_into,
+                )
+            self._send_to_conns(make_packet)
+        except socket.error as e:
+            self._spool_or_raise([(host, service, state, description)], e)
+
+    def send_many(self, results, chunk_size=1000):
+        """Send a batch of results, writing each chunk of packets to each
+        connection as one continuously-encrypted stream with one sendall
+
+        Arguments:
+            results: iterable of (host, service, state, description) tuples;
+                     use a service of b'' (or None) for host results
+            chunk_size: maximum number of packets to buffer before writing
+
+        Returns a list of (index, result, exception) tuples for the results
+        that failed validation and were not sent.
+
+        If a chunk can't be sent and there's no spool to put it in, the
+        socket.error raised has a sent attribute: the number of valid
+        results, from the start, that were sent before that chunk. (The
+        chunk itself reached some of the servers if it's a PartialSendError.)
+        """
+        errors = []
+        sent = 0
+        for chunk in self._chunk_results(results, chunk_size, errors):
+            try:
+                self.connect()
+                self._replay_spool()
+                self._send_chunk(chunk)
+            except socket.error as e:
+                e.sent = sent
+                self._spool_or_raise(chunk, e)
+            sent += len(chunk)
+        return errors
+
+    def _spool_or_raise(self, results, error):
+        if self.spool is None:
+            raise error
+        if isinstance(error, PartialSendError):
+            # the other servers have them, so only spool them for the ones that don't
+            log.warning("Unable to send %d NSCA packets to %s (%s); spooling them for it", len(results),
+                        ', '.join(error.missed), error)
+            for address in error.missed:
+                self._incr(metrics.SPOOLED, self.spool.extend(results, destination=address))
+            return
+        log.warning("Unable to send %d NSCA packets to %s:%d (%s); spooling them", len(results), self.remote_host, self.port, error)
+        self._incr(metrics.SPOOLED, self.spool.extend(results))
+
+    def _replay_spool(self):
+        if self.spool is not None and len(self.spool):
+            log.info("replaying %d spooled NSCA results to %s:%d", len(self.spool), self.remote_host, self.port)
+            self.spool.replay(self._send_chunk)
+
+    def _chunk_results(self, results, chunk_size, errors):
+        """Validate results, yielding lists of up to chunk_size valid
+        (host, service, state, description) tuples and appending
+        (index, result, exception) to errors for each invalid one"""
+        chunk = []
+        for index, result in enumerate(results):
+            try:
+                host, service, state, description = result
+                if service is None:
+                    service = b''
+                self._check_alert(host=host, service=service, state=state, description=description)
+            except (TypeError, ValueError) as e:
+                self._incr(metrics.VALIDATION_FAILURES)
+                errors.append((index, result, e))
+                continue
+            chunk.append((host, service, state, description))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _pack_chunk(self, chunk, timestamp):
+        """Pack chunk into a new bytearray"""
+        packet_size = self._packet_builder.packet_size
+        buf = bytearray(packet_size * len(chunk))
+        for i, (host, service, state, description) in enumerate(chunk):
+            self._packet_builder.pack_into(buf, i * packet_size, host, service, state, description, timestamp)
+        return buf
+
+    def _send_chunk(self, chunk, destination=None):
+        if len(self._conns) == 1:
+            # nothing to share, so encrypt and send the packed buffer itself
+            pack = functools.partial(self._pack_chunk, chunk)
+        else:
+            # the packets only differ between connections by the server's
+            # timestamp, so only pack once per distinct timestamp and give
+            # each connection a copy to encrypt
+            packed = {}
+
+            def pack(timestamp):
+                if timestamp not in packed:
+                    packed[timestamp] = self._pack_chunk(chunk, timestamp)
+                return bytearray(packed[timestamp])
+
+        def make_packets(conn, crypter, timestamp):
+            return self._pack_and_encrypt(lambda: pack(timestamp), crypter.encrypt_into)
+        self._send_to_conns(make_packets, destination)
+
+    def _conn_address(self, conn):
+        """The address conn is (or was last) connected to, or None if it isn't known"""
+        # addrinfos here are (family, socktype, proto, sockaddr)
+        addrinfo = self._conn_addrs.get(conn)
+        return addrinfo[3][0] if addrinfo is not None else None
+
+    def _send_to_conns(self, make_payload, destination=None):
+        """sendall() make_payload(conn, crypter, timestamp) to every connection,
+        or only to the one to the address destination.
+
+        If a connection has broken, it is re-established and the payload is
+        rebuilt (with the new connection's crypter and timestamp) and retried
+        once. Connections that still fail don't stop us from sending to the
+        rest; once they've all been tried, PartialSendError is raised if some
+        got the payload (or it was for one destination), or else the first
+        error."""
+        error = None
+        missed = []
+        delivered = 0
+        for index in range(len(self._conns)):
+            conn, iv, timestamp = self._conns[index]
+            address = self._conn_address(conn)
+            if destination is not None and address != destination:
+                continue
+            try:
+                if self.reconnect and (conn not in self._handshake_times or self._peer_closed(conn)):
+                    # either the server hung up, or an earlier reconnect failed
+                    raise socket.error("connection is closed")
+                self._send_payload(conn, iv, timestamp, make_payload)
+                delivered += 1
+                continue
+            except socket.error as e:
+                failure = e
+            if self.reconnect:
+                log.warning("connection to %s:%d broken (%s); reconnecting", self.remote_host, self.port, failure)
+                try:
+                    conn, iv, timestamp = self._reconnect(index)
+                    self._send_payload(conn, iv, timestamp, make_payload)
+                    delivered += 1
+                    continue
+                except socket.error as e:
+                    failure = e
+            error = error or failure
+            missed.append(address)
+        if destination is not None and not delivered and error is None:
+            log.warning("no longer connected to %s; dropping what was spooled for it", destination)
+            return
+        if error is not None:
+            if (delivered or destination is not None) and None not in missed:
+                raise PartialSendError(str(error), missed)
+            raise error
+
+    def _rate_limiter(self, conn):
+        """The TokenBucket for conn's server, or None if it isn't limited"""
+        if self.rate_limit is None:
+            return None
+        address = self._conn_address(conn)
+        key = address if address is not None else conn
+        limiter = self._rate_limiters.get(key)
+        if limiter is None:
+            rate = self.rate_limit
+            if isinstance(rate, dict):
+                rate = rate.get(address, rate.get(None))
+                if rate is None:
+                    return None
+            limiter = self._rate_limiters[key] = ratelimit.TokenBucket(rate, self.rate_burst, self.adaptive_rate)
+        return limiter
+
+    def _send_payload(self, conn, iv, timestamp, make_payload):
+        crypter = self._get_crypter(conn, iv)
+        payload = make_payload(conn, crypter, self._packet_timestamp(conn, timestamp))
+        stats = self.stats
+        limiter = self._rate_limiter(conn)
+        if stats is None and limiter is None:
+            conn.sendall(payload)
+        else:
+            packets = len(payload) // _data_packet_size
+            if limiter is not None:
+                waited = limiter.wait(packets)
+                if stats is not None and waited:
+                    stats.timing(metrics.THROTTLE, waited)
+            start = time.time()
+            conn.sendall(payload)
+            took = time.time() - start
+            if limiter is not None:
+                backoffs = limiter.backoffs
+                limiter.sent(took)
+                if stats is not None and limiter.backoffs > backoffs:
+                    stats.incr(metrics.RATE_BACKOFFS)
+            if stats is not None:
+                stats.timing(metrics.SENDALL, took)
+                stats.incr(metrics.BYTES_SENT, len(payload))
+                stats.incr(metrics.PACKETS_SENT, packets)
+        self._last_used[conn] = time.time()
+
+    def _peer_closed(self, conn):
+        """nsca never writes to us after the init packet, so a socket that
+        has become readable means the server hung up. Sending to it would
+        appear to succeed and the packet would be silently lost, so check
+        connections that have been sitting idle before using them."""
+        last_used = self._last_used.get(conn)
+        if last_used is None or time.time() - last_used < 1:
+            return False
+        try:
+            readable, _, failed = _wait_for_sockets([conn], [], 0)
+            if failed and not readable:
+                return True
+            return bool(readable) and not conn.recv(1, socket.MSG_PEEK)
+        except socket.error:
+            return True
+
+    def _reconnect(self, index):
+        """Replace the broken connection at self._conns[index] with a new,
+        handshaken one to the same address, backing off exponentially while
+        reconnects to that slot keep failing"""
+        old_conn = self._conns[index][0]
+        addrinfo = self._conn_addrs.get(old_conn)
+        self._forget_conn(old_conn)
+        if addrinfo is not None:
+            # remember where this slot reconnects to, in case this attempt fails
+            self._conn_addrs[old_conn] = addrinfo
+        self._check_reconnect_backoff(index)
+        try:
+            send_timeout = self._timeout_for(self.send_timeout)
+            connect_deadline = self._deadline(self.connect_timeout)
+            if self.send_to_all and addrinfo is not None:
+                conns = [self._connect_addrinfo(addrinfo, send_timeout, deadline=connect_deadline)]
+            else:
+                conns = self._sock_connect(self.remote_host, self.port, send_timeout, connect_all=False,
+                                           deadline=connect_deadline)
+            self._conns[index] = self._handshake_all(conns, self._deadline(self.handshake_timeout))[0]
+        except (socket.error, struct.error) as e:
+            self._reconnect_failed(index)
+            raise socket.error("could not reconnect to %s:%d: %s" % (self.remote_host, self.port, e))
+        self._reconnect_succeeded(index)
+        self._conn_addrs.pop(old_conn, None)
+        return self._conns[index]
+
+    def _check_reconnect_backoff(self, index):
+        """Raise socket.error if reconnecting to the connection slot index
+        is still being held off after a failed reconnect"""
+        now = time.time()
+        next_reconnect_time = self._next_reconnect_times.get(index, 0)
+        if now < next_reconnect_time:
+            raise socket.error("not reconnecting to %s:%d for another %0.1fs" % (
+                self.remote_host, self.port, next_reconnect_time - now))
+
+    def _reconnect_failed(self, index):
+        self._incr(metrics.RECONNECT_FAILURES)
+        delay = self._reconnect_delays.get(index, self.reconnect_backoff)
+        self._next_reconnect_times[index] = time.time() + delay
+        self._reconnect_delays[index] = min(delay * 2, self.max_reconnect_backoff)
+
+    def _reconnect_succeeded(self, index):
+        self._incr(metrics.RECONNECTS)
+        self._reconnect_delays.pop(index, None)
+        self._next_reconnect_times.pop(index, None)
+
+    def _forget_conn(self, conn):
+        try:
+            conn.close()
+        except socket.error:
+            pass
+        self._cached_crypters.pop(conn, None)
+        self._handshake_times.pop(conn, None)
+        self._last_used.pop(conn, None)
+        self._conn_addrs.pop(conn, None)
 
     def send_host(self, host, state, description):
         return self.send_service(host, b'', state, description)
 
-    def _sock_connect(self, host, port, timeout=None, connect_all=True):
+    def _connect_addrinfo(self, addrinfo, timeout=None, deadline=None):
+        return self._connect_addrinfos([addrinfo], timeout, deadline=deadline)[0]
+
+    def _sock_connect(self, host, port, timeout=None, connect_all=True, deadline=None):
+        start = time.time()
+        getaddrinfo = socket.getaddrinfo if self.dns_cache is None else self.dns_cache.getaddrinfo
+        try:
+            addrinfos = [
+                (family, socktype, proto, sockaddr)
+                for (family, socktype, proto, canonname, sockaddr) in getaddrinfo(
+                    host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, 0)
+            ]
+        except socket.error:
+            self._incr(metrics.DNS_FAILURES)
+            raise
+        self._timing(metrics.DNS, start)
+        return self._connect_addrinfos(addrinfos, timeout, connect_all, deadline)
+
+    def _start_connect(self, addrinfo):
+        """Start a non-blocking connect; returns the socket and whether it
+        has already connected"""
+        family, socktype, proto, sockaddr = addrinfo
+        s = socket.socket(family, socktype, proto)
+        s.setblocking(False)
+        try:
+            s.connect(sockaddr)
+        except socket.error as e:
+            if e.args and e.args[0] in _CONNECT_IN_PROGRESS:
+                return s, False
+            s.close()
+            raise
+        return s, True
+
+    def _finish_connect(self, s, addrinfo, timeout):
+        if timeout is not None:
+            s.settimeout(timeout)
+        else:
+            s.setblocking(True)
+        self._conn_addrs[s] = addrinfo
+        self.connect_results[addrinfo[3]] = None
+        return s
+
+    def _connect_addrinfos(self, addrinfos, timeout=None, connect_all=True, deadline=None):
+        """Connect to addrinfos concurrently, giving up on any that haven't
+        connected by the deadline (timeout seconds from now, by default).
+        Connected sockets are left with timeout as their socket timeout.
+
+        With connect_all, returns every socket that connected. Otherwise,
+        returns the first one to connect: each address is given
+        connect_stagger seconds to connect before the next is tried
+        alongside it."""
+        start = time.time()
+        if deadline is None and timeout is not None:
+            deadline = start + timeout
+        to_start = list(reversed(addrinfos))
+        pending = {}
         conns = []
-        for (family, socktype, proto, canonname, sockaddr) in socket.getaddrinfo(
-                host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, 0):
-            try:
-                s = socket.socket(family, socktype, proto)
-                s.connect(sockaddr)
-                conns.append(s)
-                if timeout is not None:
-                    s.settimeout(timeout)
+        next_start = 0
+        while to_start or pending:
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                break
+            if to_start and now >= next_start:
+                addrinfo = to_start.pop()
+                next_start = now if connect_all else now + self.connect_stagger
+                try:
+                    s, connected = self._start_connect(addrinfo)
+                except socket.error as e:
+                    self._incr(metrics.CONNECT_FAILURES)
+                    self.connect_results[addrinfo[3]] = e
+                    next_start = now
+                    continue
+                if not connected:
+                    pending[s] = addrinfo
+                    continue
+                conns.append(self._finish_connect(s, addrinfo, timeout))
                 if not connect_all:
                     break
-            except socket.error:
                 continue
+            wait_until = deadline
+            if to_start and (wait_until is None or next_start < wait_until):
+                wait_until = next_start
+            waiting = list(pending)
+            _, writable, failed = _wait_for_sockets(
+                [], waiting, None if wait_until is None else max(0, wait_until - now))
+            for s in set(writable) | set(failed):
+                addrinfo = pending.pop(s)
+                err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    s.close()
+                    self._incr(metrics.CONNECT_FAILURES)
+                    self.connect_results[addrinfo[3]] = socket.error(err, os.strerror(err))
+                else:
+                    conns.append(self._finish_connect(s, addrinfo, timeout))
+            if conns and not connect_all:
+                break
+            if not pending:
+                next_start = 0
+        for s, addrinfo in pending.items():
+            s.close()
+            if conns and not connect_all:
+                # lost the race to another address rather than failing
+                self.connect_results.pop(addrinfo[3], None)
+            else:
+                self._incr(metrics.CONNECT_FAILURES)
+                self.connect_results[addrinfo[3]] = socket.timeout("timed out connecting")
+        self._timing(metrics.CONNECT, start)
         if not conns:
             raise socket.error("could not connect to %s:%d" % (self.remote_host, self.port))
         return conns
 
-    def _handshake_all(self, conns):
-        handshakes = []
-        for conn in conns:
-            iv, timestamp = self._read_init_packet(conn)
-            handshakes.append((conn, iv, timestamp))
-        return handshakes
+    def _wait_readable(self, conns, deadline):
+        timeout = None if deadline is None else max(0, deadline - time.time())
+        readable, _, failed = _wait_for_sockets(conns, [], timeout)
+        return list(set(readable) | set(failed))
+
+    def _handshake_all(self, conns, deadline=None):
+        """Read the init packet from each of conns as it arrives, closing any
+        that fail or haven't sent one by the deadline"""
+        results = {}
+        pending = list(conns)
+        while pending:
+            ready = self._wait_readable(pending, deadline)
+            if not ready:
+                break
+            for conn in ready:
+                pending.remove(conn)
+                start = time.time()
+                try:
+                    iv, timestamp = self._read_init_packet(conn, deadline)
+                except (socket.error, struct.error) as e:
+                    self._handshake_failed(conn, e)
+                    continue
+                self._timing(metrics.HANDSHAKE, start)
+                self._handshake_times[conn] = self._last_used[conn] = time.time()
+                results[conn] = (conn, iv, timestamp)
+        for conn in pending:
+            self._handshake_failed(conn, socket.timeout("timed out waiting for init packet"))
+        if not results:
+            raise socket.error("could not handshake with %s:%d" % (self.remote_host, self.port))
+        return [results[conn] for conn in conns if conn in results]
+
+    def _handshake_failed(self, conn, error):
+        addrinfo = self._conn_addrs.get(conn)
+        if addrinfo is not None:
+            self.connect_results[addrinfo[3]] = error
+        self._incr(metrics.HANDSHAKE_FAILURES)
+        log.warning("handshake with %s:%d failed: %s", self.remote_host, self.port, error)
+        self._forget_conn(conn)
 
     def connect(self):
+        """Connect and handshake with every address remote_host resolves to
+        (or the first that connects, if not send_to_all), concurrently;
+        connecting to them all has to finish within connect_timeout
+        seconds, and then reading their init packets within
+        handshake_timeout seconds.
+
+        Afterwards, connect_results maps each address tried to None if it
+        was connected to, or to the exception explaining why it wasn't."""
         if self._connected:
             return
-        conns = self._sock_connect(self.remote_host, self.port, self.timeout, connect_all=self.send_to_all)
-        self._conns.extend(self._handshake_all(conns))
+        self.connect_results = {}
+        conns = self._sock_connect(self.remote_host, self.port, self._timeout_for(self.send_timeout),
+                                   connect_all=self.send_to_all, deadline=self._deadline(self.connect_timeout))
+        self._conns.extend(self._handshake_all(conns, self._deadline(self.handshake_timeout)))
         self._connected = True
 
     def disconnect(self):
         if not self._connected:
             return
         for conn, _, _ in self._conns:
-            conn.close()
+            self._forget_conn(conn)
         self._conns = []
+        self._reconnect_delays.clear()
+        self._next_reconnect_times.clear()
         self._connected = False
 
-    def _read_init_packet(self, fd):
-        init_packet = fd.recv(struct.calcsize(_init_packet_format))
-        transmitted_iv, timestamp = struct.unpack(_init_packet_format, init_packet)
+    def _read_init_packet(self, fd, deadline=None):
+        """Read the init packet from fd, which should already be readable.
+        It nearly always arrives in one piece; if it doesn't, keep reading
+        until it's all here, giving up at the deadline."""
+        init_packet = bytearray(_init_packet_size)
+        view = memoryview(init_packet)
+        received = 0
+        restore_timeout = False
+        try:
+            while received < _init_packet_size:
+                if received and deadline is not None:
+                    # a short read: only now is it worth adjusting the timeout
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise socket.timeout("timed out reading init packet (%d of %d bytes)" % (
+                            received, _init_packet_size))
+                    if not restore_timeout:
+                        original_timeout = fd.gettimeout()
+                        restore_timeout = True
+                    fd.settimeout(remaining)
+                n = fd.recv_into(view[received:])
+                if not n:
+                    raise socket.error("connection closed after %d bytes of the init packet" % received)
+                received += n
+        finally:
+            if restore_timeout:
+                fd.settimeout(original_timeout)
+        transmitted_iv, timestamp = _init_packet_struct.unpack(init_packet)
         return transmitted_iv, timestamp
 
     def __del__(self):
@@ -0,0 +1,184 @@
+"""
+A process-wide pool of connected NscaSenders.
+
+The send_nsca() convenience functions use this so that they don't have to
+re-read the config file, resolve the remote host, connect and handshake
+with nsca for every single result.
+"""
+
+from __future__ import with_statement
+
+import collections
+import os
+import threading
+import time
+
+from .nsca import DEFAULT_CONFIG_PATH, DEFAULT_PORT, NscaSender, PartialSendError, _file_version
+
+
+def _freeze(value):
+    """A hashable stand-in for an option's value, so that dicts and lists
+    of options (like a rate_limit per server) can be part of a pool key"""
+    if isinstance(value, dict):
+        return (dict, frozenset((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_freeze(v) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return (set, frozenset(_freeze(v) for v in value))
+    return value
+
+
+class _PoolEntry(object):
+    def __init__(self, sender):
+        self.sender = sender
+        # NscaSenders aren't thread-safe, so only one thread may use each
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        self.closed = False
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.sender.disconnect()
+
+    def close_inherited(self):
+        """Close a forked child's copies of the sender's sockets. This doesn't
+        take the lock, which a thread that only exists in the parent may have
+        held when we forked; and closing (not shutting down) our copies
+        leaves the parent's connections alone."""
+        self.closed = True
+        self.sender.disconnect()
+
+
+class SenderPool(object):
+    def __init__(self, max_size=16, idle_timeout=60):
+        """Constructor
+
+        Arguments:
+            max_size: maximum number of senders to keep; the least recently used are closed first
+            idle_timeout: seconds a sender may sit unused before it is closed
+        """
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _key(remote_host, kwargs):
+        """Senders are shared between callers using the same remote host,
+        port, config file (as long as it hasn't changed) and options"""
+        port = kwargs.get('port', DEFAULT_PORT)
+        config_path = kwargs.get('config_path', DEFAULT_CONFIG_PATH)
+        config_version = None
+        if config_path is not None:
+            try:
+                config_version = _file_version(os.stat(config_path))
+            except OSError:
+                pass
+        options = tuple(sorted((k, _freeze(v)) for k, v in kwargs.items() if k not in ('port', 'config_path')))
+        return (remote_host, port, config_path, config_version, options)
+
+    def _checkout(self, remote_host, kwargs):
+        """Return (key, entry) for a sender to use; key is None for a sender
+        that isn't pooled, because its options can't be keyed on"""
+        key = self._key(remote_host, kwargs)
+        try:
+            hash(key)
+        except TypeError:
+            return None, _PoolEntry(NscaSender(remote_host=remote_host, **kwargs))
+        stale = []
+        inherited = []
+        with self._lock:
+            if self._pid != os.getpid():
+                # we've forked, so the connections are shared with our
+                # parent; close our copies rather than writing to them
+                inherited = list(self._entries.values())
+                self._reset()
+            now = time.time()
+            for other_key, other in list(self._entries.items()):
+                if now - other.last_used > self.idle_timeout:
+                    stale.append(self._entries.pop(other_key))
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # re-insert, to move it to the end
+                self._entries[key] = entry
+        for other in inherited:
+            other.close_inherited()
+        if entry is None:
+            # reading the config and setting up the crypter can be slow, so
+            # don't hold up every other thread using the pool while we do
+            new_entry = _PoolEntry(NscaSender(remote_host=remote_host, **kwargs))
+            with self._lock:
+                # another thread may have made one in the meantime
+                entry = self._entries.pop(key, None)
+                if entry is None:
+                    entry, new_entry = new_entry, None
+                    while len(self._entries) >= self.max_size:
+                        stale.append(self._entries.popitem(last=False)[1])
+                self._entries[key] = entry
+            if new_entry is not None:
+                stale.append(new_entry)
+        for other in stale:
+            other.close()
+        return key, entry
+
+    def _discard(self, key, entry):
+        with self._lock:
+            if key is not None and self._entries.get(key) is entry:
+                del self._entries[key]
+        entry.close()
+
+    def send_service(self, remote_host, host, service, state, description, **kwargs):
+        """Send a service result through a pooled sender for remote_host;
+        all other arguments are passed to the NscaSender constructor.
+
+        A sender that couldn't send to any of its servers is thrown away, and
+        the result is retried once on a freshly-connected one. One that
+        reached some of them is kept, and the error raised without a retry:
+        sending again would duplicate the result on the servers that got
+        it, and the sender reconnects to the others itself."""
+        retried = False
+        while True:
+            key, entry = self._checkout(remote_host, kwargs)
+            try:
+                with entry.lock:
+                    if entry.closed:
+                        # evicted by another thread after we checked it out
+                        continue
+                    try:
+                        entry.sender.send_service(host, service, state, description)
+                    finally:
+                        entry.last_used = time.time()
+                if key is None:
+                    entry.close()
+                return
+            except PartialSendError:
+                if key is None:
+                    entry.close()
+                raise
+            except EnvironmentError:
+                self._discard(key, entry)
+                if retried:
+                    raise
+                retried = True
+
+    def send_host(self, remote_host, host, state, description, **kwargs):
+        return self.send_service(remote_host, host, b'', state, description, **kwargs)
+
+    def close(self):
+        """Disconnect and forget every pooled sender"""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            entry.close()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+default_pool = SenderPool()
@@ -0,0 +1,164 @@
+"""
+A non-blocking front end for NscaSender: results are put on a bounded
+in-memory queue and sent in batches by a background thread, so that the
+threads reporting them never wait on the network.
+"""
+
+from __future__ import with_statement
+
+import collections
+import threading
+import time
+
+from .nsca import log
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+
+FULL_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class QueuedNscaSender(object):
+    def __init__(self, sender, max_queue_size=10000, full_policy=DROP_OLDEST, batch_size=500):
+        """Constructor
+
+        Arguments:
+            sender: the NscaSender that the background thread sends with
+            max_queue_size: maximum number of results waiting to be sent
+            full_policy: what to do with a new result when the queue is full:
+                         DROP_OLDEST to throw away the oldest queued result to make room,
+                         DROP_NEWEST to throw away the new result, or
+                         BLOCK to wait until there's room
+            batch_size: maximum number of results to send with each send_many()
+        """
+        if full_policy not in FULL_POLICIES:
+            raise ValueError("full_policy %r should be one of {%s}" % (full_policy, ','.join(FULL_POLICIES)))
+        self.sender = sender
+        self.max_queue_size = max_queue_size
+        self.full_policy = full_policy
+        self.batch_size = batch_size
+        # counters
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+        # results queued or being sent
+        self._unfinished = 0
+        self._closed = False
+        self._thread = None
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='QueuedNscaSender')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send_service(self, host, service, state, description):
+        """Queue a result to be sent. Invalid results raise ValueError right
+        away; returns False if the result was dropped because the queue was
+        full, True otherwise."""
+        self.sender._check_alert(host=host, service=service, state=state, description=description)
+        with self._lock:
+            if self._closed:
+                raise ValueError("sender is closed")
+            if self._thread is None:
+                self._start()
+            if len(self._queue) >= self.max_queue_size:
+                if self.full_policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self.full_policy == DROP_OLDEST:
+                    self._queue.popleft()
+                    self._done(1)
+                    self.dropped += 1
+                else:
+                    while len(self._queue) >= self.max_queue_size and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        raise ValueError("sender is closed")
+            self._queue.append((host, service, state, description))
+            self.queued += 1
+            self._unfinished += 1
+            self._not_empty.notify()
+        return True
+
+    def send_host(self, host, state, description):
+        return self.send_service(host, b'', state, description)
+
+    def _done(self, count):
+        # call with self._lock held
+        self._unfinished -= count
+        if not self._unfinished:
+            self._all_done.notify_all()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._not_empty.wait()
+                if not self._queue:
+                    return
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                self._not_full.notify_all()
+            sent = failed = 0
+            try:
+                errors = self.sender.send_many(batch)
+                failed = len(errors)
+                sent = len(batch) - failed
+            except Exception as e:
+                log.error("Unable to send %d NSCA packets to %s (%s)", len(batch), self.sender.remote_host, e)
+                failed = len(batch)
+            with self._lock:
+                self.sent += sent
+                self.failed += failed
+                self._done(len(batch))
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far has been sent (or has failed);
+        returns False if that didn't happen within timeout seconds"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._unfinished:
+                if deadline is None:
+                    self._all_done.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._all_done.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """Send whatever is still queued, stop the background thread and
+        disconnect. Anything that couldn't be sent within timeout seconds is
+        dropped, and False is returned."""
+        drained = self.flush(timeout)
+        with self._lock:
+            self._closed = True
+            if self._queue:
+                self.dropped += len(self._queue)
+                self._done(len(self._queue))
+                self._queue.clear()
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+            thread = self._thread
+        if thread is not None:
+            # waits for a batch that's already being sent, at most
+            thread.join()
+        self.sender.disconnect()
+        return drained
+
+    def counters(self):
+        with self._lock:
+            return {
+                'queued': self.queued,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'pending': self._unfinished,
+            }
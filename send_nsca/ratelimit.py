@@ -0,0 +1,88 @@
+"""
+Pacing for NscaSender, so that a burst of results doesn't arrive at an nsca
+daemon faster than it (and the Nagios command file behind it) can take
+them.
+
+Each destination gets a TokenBucket of packets per second. An adaptive
+bucket also halves its rate when a sendall() to its destination blocks for
+longer than slow_send seconds -- which is what a full socket send buffer
+looks like from here -- and then creeps back up towards the configured
+rate while sends are quick again (additive increase, multiplicative
+decrease).
+"""
+
+from __future__ import with_statement
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None, adaptive=False, min_rate=None, slow_send=0.1, recovery_time=10):
+        """Constructor
+
+        Arguments:
+            rate: packets per second
+            burst: packets that may be sent at once after a quiet spell (default: rate,
+                   i.e. one second's worth)
+            adaptive: if true, back off when sends are slow, as described above
+            min_rate: the rate never backs off below this (default: a tenth of rate)
+            slow_send: seconds a sendall() may take before it counts as blocked
+            recovery_time: seconds of quick sends to get from min_rate back up to rate
+        """
+        if rate <= 0:
+            raise ValueError("rate %r should be positive" % (rate,))
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.adaptive = adaptive
+        self.min_rate = float(min_rate if min_rate is not None else rate / 10.0)
+        self.slow_send = slow_send
+        self.increase = (self.max_rate - self.min_rate) / recovery_time
+        # counters
+        self.backoffs = 0
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._last_backoff = 0
+        self._last_adjusted = self._updated
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        # call with self._lock held
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, count=1):
+        """Take count tokens and return how many seconds to wait before
+        sending that many packets. A count bigger than the burst is allowed;
+        it just waits longer."""
+        with self._lock:
+            self._refill(time.time())
+            self._tokens -= count
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def wait(self, count=1):
+        """reserve() and sleep; returns the seconds slept"""
+        delay = self.reserve(count)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def sent(self, seconds):
+        """Tell an adaptive bucket how long a sendall() took"""
+        if not self.adaptive:
+            return
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            if seconds > self.slow_send:
+                # back off at most once per slow_send, so one blocked burst doesn't halve the rate repeatedly
+                if now - self._last_backoff >= self.slow_send and self.rate > self.min_rate:
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    self._last_backoff = now
+                    self.backoffs += 1
+            elif self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.increase * (now - self._last_adjusted))
+            self._last_adjusted = now
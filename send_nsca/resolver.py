@@ -0,0 +1,88 @@
+"""
+A small getaddrinfo() cache, so that connecting (and reconnecting) to
+remote_host for every batch of results doesn't cost a resolver query each
+time.
+
+getaddrinfo() doesn't tell us the records' real TTLs, so answers are kept
+for a fixed ttl; failures are cached for negative_ttl, so a missing name
+doesn't get looked up on every send either. If the resolver fails after a
+name has resolved, the last good answer keeps being used (for up to
+max_stale seconds) rather than failing sends that would probably have
+worked.
+"""
+
+from __future__ import with_statement
+
+import logging
+import socket
+import threading
+import time
+
+log = logging.getLogger("send_nsca")
+
+
+class _Entry(object):
+    __slots__ = ('addrinfos', 'error', 'expires', 'resolved')
+
+    def __init__(self, addrinfos, error, expires, resolved):
+        self.addrinfos = addrinfos
+        self.error = error
+        self.expires = expires
+        # when addrinfos were last good
+        self.resolved = resolved
+
+
+class ResolverCache(object):
+    def __init__(self, ttl=60, negative_ttl=5, max_stale=3600):
+        """Constructor
+
+        Arguments:
+            ttl: seconds to keep using a successful lookup
+            negative_ttl: seconds to keep failing a lookup that failed, without asking again
+            max_stale: seconds after its last successful lookup that an answer may still be
+                       used when the resolver is failing; 0 to never serve stale answers
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_stale = max_stale
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def getaddrinfo(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        """socket.getaddrinfo(), cached"""
+        key = (host, port, family, socktype, proto, flags)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and now < entry.expires:
+            if entry.error is not None:
+                raise entry.error
+            return list(entry.addrinfos)
+        try:
+            # looked up through the module every time, so it can be patched
+            addrinfos = socket.getaddrinfo(host, port, family, socktype, proto, flags)
+        except socket.error as e:
+            if entry is not None and entry.addrinfos is not None and now - entry.resolved < self.max_stale:
+                log.warning("could not resolve %s (%s); using the addresses it had %ds ago", host, e, now - entry.resolved)
+                with self._lock:
+                    self._entries[key] = _Entry(entry.addrinfos, None, now + self.negative_ttl, entry.resolved)
+                return list(entry.addrinfos)
+            with self._lock:
+                self._entries[key] = _Entry(None, e, now + self.negative_ttl, None)
+            raise
+        with self._lock:
+            self._entries[key] = _Entry(addrinfos, None, now + self.ttl, now)
+        return list(addrinfos)
+
+    def clear(self, host=None):
+        """Forget everything, or just everything about host"""
+        with self._lock:
+            if host is None:
+                self._entries.clear()
+            else:
+                for key in [key for key in self._entries if key[0] == host]:
+                    del self._entries[key]
+
+
+# shared by every NscaSender that isn't given its own
+default_cache = ResolverCache()
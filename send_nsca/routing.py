@@ -0,0 +1,317 @@
+"""
+Spread results across several NSCA receivers, instead of sending every
+result to every address of one remote_host.
+
+Each result goes to one endpoint, chosen by the routing strategy:
+
+    HASH            consistent hashing on the result's host, so all of a
+                    host's results go to the same receiver, and only 1/N
+                    of hosts move when a receiver comes or goes
+    LEAST_LOADED    the receiver with the fewest results in flight, then
+                    the fastest recent sends
+    ROUND_ROBIN     each receiver in turn
+
+An endpoint whose send fails is marked down and the results it didn't
+get are sent to the next endpoint instead; it is tried again, by
+connecting to it, once retry_interval seconds have passed. Results an
+endpoint got before failing, even if only some of its servers did (a
+PartialSendError), aren't sent anywhere else.
+"""
+
+from __future__ import with_statement
+
+import bisect
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from .nsca import DEFAULT_PORT, NscaSender, PartialSendError, log
+
+HASH = 'hash'
+LEAST_LOADED = 'least_loaded'
+ROUND_ROBIN = 'round_robin'
+
+STRATEGIES = (HASH, LEAST_LOADED, ROUND_ROBIN)
+
+
+def parse_endpoint(endpoint, default_port=DEFAULT_PORT):
+    """Turn 'host', 'host:port', '[v6addr]:port' or (host, port) into (host, port)"""
+    if isinstance(endpoint, tuple):
+        return endpoint
+    if endpoint.startswith('['):
+        host, _, rest = endpoint[1:].partition(']')
+        return host, int(rest[1:]) if rest.startswith(':') else default_port
+    if endpoint.count(':') == 1:
+        host, port = endpoint.split(':')
+        return host, int(port)
+    return endpoint, default_port
+
+
+def _ring_point(value):
+    return zlib.crc32(value) & 0xffffffff
+
+
+class Endpoint(object):
+    def __init__(self, host, port, sender):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        # NscaSenders aren't thread-safe, so only one thread may use each
+        self.lock = threading.Lock()
+        self.healthy = True
+        self.failures = 0
+        self.next_check = 0
+        self.in_flight = 0
+        # moving average of seconds per result sent, or None until one is
+        self.send_time = None
+        # counters
+        self.sent = 0
+        self.failed = 0
+
+    def __repr__(self):
+        return 'Endpoint(%r, %d)' % (self.host, self.port)
+
+    def status(self):
+        return {
+            'host': self.host,
+            'port': self.port,
+            'healthy': self.healthy,
+            'in_flight': self.in_flight,
+            'sent': self.sent,
+            'failed': self.failed,
+        }
+
+
+class RoutingNscaSender(object):
+    def __init__(self, endpoints, strategy=HASH, retry_interval=10, max_failures=1, replicas=100,
+                 **sender_kwargs):
+        """Constructor
+
+        Arguments:
+            endpoints: list of receivers, as 'host', 'host:port' or (host, port)
+            strategy: HASH, LEAST_LOADED or ROUND_ROBIN; see above
+            retry_interval: seconds to wait before trying an endpoint that's down again
+            max_failures: consecutive failed sends before an endpoint is marked down
+            replicas: points each endpoint has on the HASH ring; more spreads hosts more evenly
+            sender_kwargs: passed to each endpoint's NscaSender (which sends to the first of
+                           the endpoint's addresses that connects, unless send_to_all is given)
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError("strategy %r should be one of {%s}" % (strategy, ','.join(STRATEGIES)))
+        if not endpoints:
+            raise ValueError("at least one endpoint is needed")
+        self.strategy = strategy
+        self.retry_interval = retry_interval
+        self.max_failures = max_failures
+        default_port = sender_kwargs.pop('port', DEFAULT_PORT)
+        sender_kwargs.setdefault('send_to_all', False)
+        self.endpoints = []
+        for endpoint in endpoints:
+            host, port = parse_endpoint(endpoint, default_port)
+            self.endpoints.append(Endpoint(host, port, NscaSender(host, port=port, **sender_kwargs)))
+        self._ring = []
+        for index, endpoint in enumerate(self.endpoints):
+            for replica in range(replicas):
+                self._ring.append((_ring_point(('%s:%d-%d' % (endpoint.host, endpoint.port, replica)).encode('utf-8')), index))
+        self._ring.sort()
+        self._ring_points = [point for point, _ in self._ring]
+        self._next = 0
+        self._lock = threading.Lock()
+        # so that a QueuedNscaSender or CoalescingSender can sit in front of this
+        self.remote_host = ','.join('%s:%d' % (endpoint.host, endpoint.port) for endpoint in self.endpoints)
+        self._check_alert = self.endpoints[0].sender._check_alert
+
+    def _usable(self, endpoint, now):
+        # call with self._lock held
+        return endpoint.healthy or now >= endpoint.next_check
+
+    def _candidates(self, key, exclude):
+        """Endpoints to try, in order of preference, for results with the
+        routing key key (their host, for HASH)"""
+        now = time.time()
+        with self._lock:
+            if self.strategy == HASH:
+                order = []
+                start = bisect.bisect(self._ring_points, _ring_point(key))
+                for i in range(len(self._ring)):
+                    endpoint = self.endpoints[self._ring[(start + i) % len(self._ring)][1]]
+                    if endpoint not in order:
+                        order.append(endpoint)
+                        if len(order) == len(self.endpoints):
+                            break
+            elif self.strategy == ROUND_ROBIN:
+                start = self._next
+                self._next = (self._next + 1) % len(self.endpoints)
+                order = self.endpoints[start:] + self.endpoints[:start]
+            else:
+                order = sorted(self.endpoints, key=lambda e: (e.in_flight, e.send_time or 0))
+            order = [e for e in order if e not in exclude]
+            usable = [e for e in order if self._usable(e, now)]
+            if usable:
+                return usable
+            # everything's down; try whichever is due to be retried first rather than giving up
+            return sorted(order, key=lambda e: e.next_check)
+
+    def route(self, host):
+        """The endpoint a result from host would be sent to now"""
+        return self._candidates(host, ())[0]
+
+    def send_service(self, host, service, state, description):
+        self._check_alert(host=host, service=service, state=state, description=description)
+        self._dispatch({host: [(host, service, state, description)]}, set())
+
+    def send_host(self, host, state, description):
+        self.send_service(host, b'', state, description)
+
+    def send_many(self, results, chunk_size=1000):
+        """Send results, each to one endpoint, failing over to the next
+        endpoint when one is down.
+
+        Returns a list of (index, result, exception) tuples for the results
+        that failed validation and were not sent. If some results couldn't be
+        sent to any endpoint, socket.error is raised after the rest have
+        been; chunk_size is passed on to each endpoint's send_many()."""
+        errors = []
+        groups = {}
+        for index, result in enumerate(results):
+            try:
+                host, service, state, description = result
+                if service is None:
+                    service = b''
+                self._check_alert(host=host, service=service, state=state, description=description)
+            except (TypeError, ValueError) as e:
+                errors.append((index, result, e))
+                continue
+            if self.strategy == HASH:
+                key = host
+            elif self.strategy == ROUND_ROBIN:
+                key = index
+            else:
+                # a LEAST_LOADED batch goes to one endpoint, rather than paying every endpoint's latency
+                key = None
+            groups.setdefault(key, []).append((host, service, state, description))
+        if groups:
+            self._dispatch(groups, set(), chunk_size)
+        return errors
+
+    def _dispatch(self, groups, failed, chunk_size=1000):
+        """Send each group of results (by routing key) to its endpoint, with
+        one send_many() per endpoint, re-routing the results any endpoint
+        that fails didn't get to the endpoints that haven't failed"""
+        by_endpoint = {}
+        error = None
+        for key, group in groups.items():
+            candidates = self._candidates(key, failed)
+            if not candidates:
+                error = error or socket.error("no NSCA endpoint left to send %d results to" % len(group))
+                continue
+            by_endpoint.setdefault(candidates[0], []).extend((key, result) for result in group)
+        for endpoint, keyed_batch in by_endpoint.items():
+            batch = [result for _, result in keyed_batch]
+            try:
+                if endpoint in failed:
+                    # it failed a re-routed batch since these were routed to it
+                    raise socket.error("already failed")
+                self._send_to(endpoint, batch, chunk_size)
+            except socket.error as e:
+                delivered = self._delivered(e, len(batch), chunk_size)
+                if isinstance(e, PartialSendError):
+                    # the endpoint reconnects to the servers it missed itself
+                    error = error or e
+                log.warning("Unable to send %d NSCA packets to %s:%d (%s); failing over", len(batch) - delivered,
+                            endpoint.host, endpoint.port, e)
+                failed.add(endpoint)
+                undelivered = {}
+                for key, result in keyed_batch[delivered:]:
+                    undelivered.setdefault(key, []).append(result)
+                try:
+                    if undelivered:
+                        self._dispatch(undelivered, failed, chunk_size)
+                except socket.error as e:
+                    error = error or e
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _delivered(error, count, chunk_size):
+        """How many of the count results in a failed send_many() got through:
+        the chunks before the one that failed, and that one too if some of
+        the endpoint's servers got it"""
+        delivered = getattr(error, 'sent', 0)
+        if isinstance(error, PartialSendError):
+            delivered = min(count, delivered + chunk_size)
+        return delivered
+
+    def _send_to(self, endpoint, batch, chunk_size):
+        with self._lock:
+            endpoint.in_flight += len(batch)
+        start = time.time()
+        try:
+            with endpoint.lock:
+                endpoint.sender.send_many(batch, chunk_size=chunk_size)
+        except (socket.error, struct.error) as e:
+            delivered = self._delivered(e, len(batch), chunk_size)
+            with self._lock:
+                endpoint.in_flight -= len(batch)
+                endpoint.sent += delivered
+                endpoint.failed += len(batch) - delivered
+                self._failed(endpoint)
+            if isinstance(e, socket.error):
+                raise
+            raise socket.error(str(e))
+        elapsed = (time.time() - start) / len(batch)
+        with self._lock:
+            endpoint.in_flight -= len(batch)
+            endpoint.sent += len(batch)
+            endpoint.healthy = True
+            endpoint.failures = 0
+            if endpoint.send_time is None:
+                endpoint.send_time = elapsed
+            else:
+                endpoint.send_time = 0.8 * endpoint.send_time + 0.2 * elapsed
+
+    def _failed(self, endpoint):
+        # call with self._lock held
+        endpoint.failures += 1
+        if endpoint.failures >= self.max_failures:
+            if endpoint.healthy:
+                log.warning("NSCA endpoint %s:%d is down; retrying it in %ds", endpoint.host, endpoint.port,
+                            self.retry_interval)
+            endpoint.healthy = False
+            endpoint.next_check = time.time() + self.retry_interval
+
+    def check_health(self):
+        """Try connecting to each endpoint that's down and due to be retried,
+        marking it up if that works; returns the number of healthy endpoints.
+
+        Endpoints are also retried with real results once they're due, so
+        calling this is only needed to find out sooner."""
+        now = time.time()
+        with self._lock:
+            due = [e for e in self.endpoints if not e.healthy and now >= e.next_check]
+        for endpoint in due:
+            try:
+                with endpoint.lock:
+                    endpoint.sender.disconnect()
+                    endpoint.sender.connect()
+            except (socket.error, struct.error) as e:
+                log.info("NSCA endpoint %s:%d is still down (%s)", endpoint.host, endpoint.port, e)
+                with self._lock:
+                    self._failed(endpoint)
+            else:
+                with self._lock:
+                    endpoint.healthy = True
+                    endpoint.failures = 0
+        with self._lock:
+            return len([e for e in self.endpoints if e.healthy])
+
+    def status(self):
+        with self._lock:
+            return [endpoint.status() for endpoint in self.endpoints]
+
+    def disconnect(self):
+        for endpoint in self.endpoints:
+            with endpoint.lock:
+                endpoint.sender.disconnect()
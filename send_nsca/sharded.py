@@ -0,0 +1,178 @@
+"""
+A multi-process NSCA sender for very large result sets. Packing and
+(especially) encrypting packets is CPU-bound, so results are split across a
+pool of worker processes, each with its own NscaSender and connections.
+
+Results are sharded by (host, service), so every result for a given key is
+sent by the same worker, in the order it was given.
+"""
+
+from __future__ import with_statement
+
+import multiprocessing
+import time
+import zlib
+
+from six.moves import queue
+
+from .nsca import NscaSender, log
+
+
+def shard_for(host, service, shards):
+    """Which of shards workers sends results for (host, service); stable
+    across processes and runs, unlike hash()"""
+    return (zlib.crc32(host + b'\0' + service) & 0xffffffff) % shards
+
+
+def _worker(index, remote_host, sender_kwargs, inbox, outbox):
+    stats = {'worker': index, 'sent': 0, 'failed': 0, 'batches': 0, 'elapsed': 0.0}
+    sender = NscaSender(remote_host, **sender_kwargs)
+    try:
+        while True:
+            batch = inbox.get()
+            if batch is None:
+                break
+            start = time.time()
+            try:
+                errors = sender.send_many(batch)
+                stats['failed'] += len(errors)
+                stats['sent'] += len(batch) - len(errors)
+            except Exception as e:
+                log.error("Unable to send %d NSCA packets to %s (%s)", len(batch), remote_host, e)
+                stats['failed'] += len(batch)
+            stats['batches'] += 1
+            stats['elapsed'] += time.time() - start
+    finally:
+        sender.disconnect()
+        outbox.put(stats)
+
+
+class ShardedNscaSender(object):
+    def __init__(self, remote_host, processes=None, batch_size=500, max_pending_batches=4, mp_context=None,
+                 **sender_kwargs):
+        """Constructor
+
+        Arguments:
+            remote_host: as for NscaSender
+            processes: number of worker processes (default: one per CPU)
+            batch_size: results per send_many() in the workers
+            max_pending_batches: batches that may wait for each worker
+                                 before send_service() blocks
+            mp_context: multiprocessing context to start the workers with
+                        (default: the multiprocessing module's default)
+            sender_kwargs: passed on to each worker's NscaSender, so must be
+                           picklable
+        """
+        self.remote_host = remote_host
+        self.processes = processes or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.max_pending_batches = max_pending_batches
+        self.sender_kwargs = sender_kwargs
+        self._mp = mp_context or multiprocessing
+        # validates results before they're handed to a worker; never connects
+        self._validator = NscaSender(remote_host, reconnect=False, **sender_kwargs)
+        self._workers = []
+        self._inboxes = []
+        self._outbox = None
+        self._buffers = [[] for _ in range(self.processes)]
+        self._queued = [0] * self.processes
+        self._closed = False
+
+    def _start(self):
+        self._outbox = self._mp.Queue()
+        for index in range(self.processes):
+            inbox = self._mp.Queue(self.max_pending_batches)
+            worker = self._mp.Process(
+                target=_worker,
+                args=(index, self.remote_host, self.sender_kwargs, inbox, self._outbox),
+                name='ShardedNscaSender-%d' % index,
+            )
+            worker.daemon = True
+            worker.start()
+            self._inboxes.append(inbox)
+            self._workers.append(worker)
+
+    def send_service(self, host, service, state, description):
+        """Queue a result for its worker. Invalid results raise ValueError
+        right away."""
+        if self._closed:
+            raise ValueError("sender is closed")
+        self._validator._check_alert(host=host, service=service, state=state, description=description)
+        if not self._workers:
+            self._start()
+        shard = shard_for(host, service, self.processes)
+        buf = self._buffers[shard]
+        buf.append((host, service, state, description))
+        self._queued[shard] += 1
+        if len(buf) >= self.batch_size:
+            self._flush_shard(shard)
+
+    def send_host(self, host, state, description):
+        return self.send_service(host, b'', state, description)
+
+    def send_many(self, results):
+        """Queue an iterable of (host, service, state, description) tuples.
+
+        Returns a list of (index, result, exception) tuples for the results
+        that failed validation and were not queued."""
+        errors = []
+        for index, result in enumerate(results):
+            try:
+                host, service, state, description = result
+                self.send_service(host, service or b'', state, description)
+            except (TypeError, ValueError) as e:
+                errors.append((index, result, e))
+        return errors
+
+    def _put(self, shard, item):
+        # don't wait forever on the inbox of a worker that has died
+        while self._workers[shard].is_alive():
+            try:
+                self._inboxes[shard].put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _flush_shard(self, shard):
+        if self._buffers[shard]:
+            self._put(shard, self._buffers[shard])
+            self._buffers[shard] = []
+
+    def close(self):
+        """Send everything queued, stop the workers and return their merged
+        statistics: totals for 'sent', 'failed' and 'batches', plus the
+        per-worker statistics under 'workers'"""
+        if self._closed:
+            raise ValueError("sender is already closed")
+        self._closed = True
+        worker_stats = {}
+        if self._workers:
+            for shard in range(self.processes):
+                self._flush_shard(shard)
+                self._put(shard, None)
+            all_exited = False
+            while len(worker_stats) < len(self._workers):
+                try:
+                    stats = self._outbox.get(timeout=1)
+                except queue.Empty:
+                    if all_exited:
+                        break
+                    # go round once more after they've all exited, in case
+                    # the last one's stats arrived in the meantime
+                    all_exited = not any(worker.is_alive() for worker in self._workers)
+                    continue
+                worker_stats[stats['worker']] = stats
+            for worker in self._workers:
+                worker.join()
+        for index in range(self.processes):
+            if index not in worker_stats:
+                if self._workers:
+                    log.error("NSCA sender worker %d died; counting its %d results as failed", index, self._queued[index])
+                worker_stats[index] = {'worker': index, 'sent': 0, 'failed': self._queued[index], 'batches': 0, 'elapsed': 0.0}
+        workers = [worker_stats[index] for index in range(self.processes)]
+        return {
+            'sent': sum(stats['sent'] for stats in workers),
+            'failed': sum(stats['failed'] for stats in workers),
+            'batches': sum(stats['batches'] for stats in workers),
+            'workers': workers,
+        }
@@ -0,0 +1,199 @@
+"""
+An append-only, on-disk spool of results that couldn't be sent, so that
+they survive the NSCA server being unreachable (or this process restarting)
+and can be replayed once it's back.
+
+Every record is the same size, so the spool can be memory-mapped and read
+without any parsing state. A record torn by a crash is cut off when the
+spool is next opened, so that later records stay aligned.
+
+A record can be for one destination -- the address of the one server, of
+several that a sender sends every result to, that didn't get it -- so that
+replaying it doesn't send it again to the servers that did.
+"""
+
+from __future__ import with_statement
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .nsca import MAX_DESCRIPTION_LENGTH, MAX_HOSTNAME_LENGTH, MAX_PLUGINOUTPUT_LENGTH, log
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+_RECORD_MAGIC = b'NSP2'
+_MAX_DESTINATION_LENGTH = 64
+# magic, time spooled, state, lengths of host, service, output and destination,
+# then the host, service, output and destination themselves
+_record_struct = struct.Struct('!4sdhHHHB%ds%ds%ds%ds' % (
+    MAX_HOSTNAME_LENGTH, MAX_DESCRIPTION_LENGTH, MAX_PLUGINOUTPUT_LENGTH, _MAX_DESTINATION_LENGTH))
+RECORD_SIZE = _record_struct.size
+
+
+def _pack_record(timestamp, result, destination=None):
+    host, service, state, description = result
+    destination = destination.encode('ascii') if destination is not None else b''
+    return _record_struct.pack(
+        _RECORD_MAGIC, timestamp, state, len(host), len(service), len(description), len(destination),
+        host, service, description, destination,
+    )
+
+
+class Spool(object):
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, fsync=FSYNC_INTERVAL, fsync_interval=1.0, max_age=30):
+        """Constructor
+
+        Arguments:
+            path: file to spool to; records already in it will be replayed
+            max_bytes: maximum size of the spool; results that don't fit are dropped
+            fsync: FSYNC_ALWAYS to fsync after every append,
+                   FSYNC_INTERVAL to fsync at most every fsync_interval seconds, or
+                   FSYNC_NEVER to leave writes in the file buffer until it fills or the spool is replayed or closed
+            max_age: seconds after which a spooled result is too old to replay (like nsca's max_packet_age)
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync %r should be one of {%s}" % (fsync, ','.join(FSYNC_POLICIES)))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.max_age = max_age
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+        size = os.fstat(self._file.fileno()).st_size
+        self._count = size // RECORD_SIZE
+        if size % RECORD_SIZE:
+            # a crash tore the last record; appending after it would misalign every later one
+            log.warning("NSCA spool %s ends with a torn record; truncating it (%d bytes)", path, size % RECORD_SIZE)
+            self._file.truncate(self._count * RECORD_SIZE)
+        self._last_sync = time.time()
+
+    def __len__(self):
+        return self._count
+
+    def extend(self, results, timestamp=None, destination=None):
+        """Spool (host, service, state, description) tuples, which should
+        already have been validated, for destination (an address) or for
+        every server if it's None; returns how many fit"""
+        if destination is not None and len(destination) > _MAX_DESTINATION_LENGTH:
+            raise ValueError("destination %r too long (max length %d)" % (destination, _MAX_DESTINATION_LENGTH))
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            room = max(0, (self.max_bytes // RECORD_SIZE) - self._count)
+            results = list(results)
+            if len(results) > room:
+                log.error("NSCA spool %s is full; dropping %d results", self.path, len(results) - room)
+                self.dropped += len(results) - room
+                results = results[:room]
+            for result in results:
+                self._file.write(_pack_record(timestamp, result, destination))
+            self._count += len(results)
+            self._sync()
+        return len(results)
+
+    def append(self, host, service, state, description, timestamp=None, destination=None):
+        return self.extend([(host, service, state, description)], timestamp, destination) == 1
+
+    def _sync(self, force=False):
+        now = time.time()
+        if force or self.fsync == FSYNC_ALWAYS or (self.fsync == FSYNC_INTERVAL and now - self._last_sync >= self.fsync_interval):
+            self._file.flush()
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self._file.fileno())
+            self._last_sync = now
+
+    def _read_records(self):
+        """Return every intact record in the spool as (timestamp, result, destination)"""
+        self._file.flush()
+        size = os.fstat(self._file.fileno()).st_size
+        if size < RECORD_SIZE:
+            return []
+        records = []
+        with open(self.path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), size - size % RECORD_SIZE, access=mmap.ACCESS_READ)
+            try:
+                for offset in range(0, len(mapped), RECORD_SIZE):
+                    (magic, timestamp, state, host_len, service_len, description_len, destination_len,
+                        host, service, description, destination) = _record_struct.unpack_from(mapped, offset)
+                    if magic != _RECORD_MAGIC:
+                        continue
+                    destination = destination[:destination_len].decode('ascii') if destination_len else None
+                    records.append((timestamp, (host[:host_len], service[:service_len], state, description[:description_len]),
+                                    destination))
+            finally:
+                mapped.close()
+        return records
+
+    def _batches(self, records, batch_size):
+        """Split records into lists of up to batch_size, each for a single destination"""
+        batch = []
+        for record in records:
+            if batch and (len(batch) >= batch_size or record[2] != batch[0][2]):
+                yield batch
+                batch = []
+            batch.append(record)
+        if batch:
+            yield batch
+
+    def replay(self, send_batch, batch_size=500):
+        """Pass spooled results, oldest first, to send_batch(results,
+        destination) in lists of up to batch_size, and empty the spool.
+        Results older than max_age are dropped.
+
+        If send_batch raises an exception with a missed attribute -- the
+        destinations that didn't get the batch -- the batch is kept for
+        just those and replaying carries on. Any other exception stops it:
+        the results that didn't get through are put back in the spool and
+        the exception is re-raised.
+
+        Returns the number of results replayed."""
+        with self._lock:
+            records = self._read_records()
+            # the sort is stable, so equal timestamps keep their spool order
+            records.sort(key=lambda record: record[0])
+            cutoff = time.time() - self.max_age
+            fresh = [record for record in records if record[0] >= cutoff]
+            if len(fresh) < len(records):
+                log.warning("dropping %d spooled NSCA results older than %ds", len(records) - len(fresh), self.max_age)
+                self.dropped += len(records) - len(fresh)
+            keep = []
+            batches = list(self._batches(fresh, batch_size))
+            try:
+                while batches:
+                    batch = batches[0]
+                    try:
+                        send_batch([result for _, result, _ in batch], batch[0][2])
+                    except Exception as e:
+                        missed = getattr(e, 'missed', None)
+                        if missed is None:
+                            raise
+                        log.warning("%d spooled NSCA results didn't reach %s (%s); keeping them for it",
+                                    len(batch), ', '.join(missed), e)
+                        keep.extend((timestamp, result, destination) for destination in missed
+                                    for timestamp, result, _ in batch)
+                    batches.pop(0)
+            finally:
+                self._file.seek(0)
+                self._file.truncate()
+                self._count = 0
+                for timestamp, result, destination in keep + [record for batch in batches for record in batch]:
+                    self._file.write(_pack_record(timestamp, result, destination))
+                    self._count += 1
+                self._sync(force=True)
+            return len(fresh)
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._sync(force=True)
+            self._file.close()
@@ -0,0 +1,112 @@
+"""
+Metrics for NscaSender.
+
+Pass NscaSender a stats object and it reports where its time goes. A
+stats object is anything with two methods, which StatsD clients and the
+like are easily adapted to:
+
+    incr(name, count=1)     add count to a counter
+    timing(name, seconds)   record how long something took
+
+The timings reported are:
+    dns             resolving remote_host
+    connect         connecting to all of its addresses
+    handshake       reading one connection's init packet
+    pack            packing a packet, or a chunk of them
+    encrypt         encrypting a packet, or a chunk of them
+    sendall         writing a packet, or a chunk of them, to one connection
+    throttle        waiting for the rate limit before writing to one connection
+
+and the counters:
+    bytes_sent, packets_sent
+    dns_failures, connect_failures, handshake_failures
+    reconnects, reconnect_failures
+    validation_failures, spooled
+    rate_backoffs
+
+With no stats object (the default), none of this costs more than checking
+for one.
+"""
+
+from __future__ import with_statement
+
+import collections
+import math
+import threading
+
+DNS = 'dns'
+CONNECT = 'connect'
+HANDSHAKE = 'handshake'
+PACK = 'pack'
+ENCRYPT = 'encrypt'
+SENDALL = 'sendall'
+THROTTLE = 'throttle'
+
+BYTES_SENT = 'bytes_sent'
+PACKETS_SENT = 'packets_sent'
+DNS_FAILURES = 'dns_failures'
+CONNECT_FAILURES = 'connect_failures'
+HANDSHAKE_FAILURES = 'handshake_failures'
+RECONNECTS = 'reconnects'
+RECONNECT_FAILURES = 'reconnect_failures'
+VALIDATION_FAILURES = 'validation_failures'
+SPOOLED = 'spooled'
+RATE_BACKOFFS = 'rate_backoffs'
+
+
+def _nearest_rank(sorted_values, percent):
+    return sorted_values[max(0, int(math.ceil(percent / 100.0 * len(sorted_values))) - 1)]
+
+
+class InMemoryStats(object):
+    """A stats object that keeps everything in memory, for tests,
+    benchmarks and exporters that poll"""
+
+    def __init__(self, max_timings=10000):
+        """Constructor
+
+        Arguments:
+            max_timings: how many of the most recent timings to keep for each name
+        """
+        self.max_timings = max_timings
+        self.counters = collections.defaultdict(int)
+        self.timings = collections.defaultdict(lambda: collections.deque(maxlen=max_timings))
+        self._lock = threading.Lock()
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self.counters[name] += count
+
+    def timing(self, name, seconds):
+        with self._lock:
+            self.timings[name].append(seconds)
+
+    def percentile(self, name, percent):
+        """Nearest-rank percentile of the kept timings for name, or None"""
+        with self._lock:
+            values = sorted(self.timings.get(name, ()))
+        if not values:
+            return None
+        return _nearest_rank(values, percent)
+
+    def summary(self):
+        """A snapshot of the counters, and the count, total, p50, p99 and max
+        of each timing"""
+        with self._lock:
+            counters = dict(self.counters)
+            timings = dict((name, sorted(values)) for name, values in self.timings.items() if values)
+        summary = {'counters': counters, 'timings': {}}
+        for name, values in timings.items():
+            summary['timings'][name] = {
+                'count': len(values),
+                'total': sum(values),
+                'p50': _nearest_rank(values, 50),
+                'p99': _nearest_rank(values, 99),
+                'max': values[-1],
+            }
+        return summary
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
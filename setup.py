@@ -21,14 +21,18 @@ setup(
     scripts=["bin/py_send_nsca"],
     packages=["send_nsca"],
     provides=["send_nsca"],
-    install_requires=["pycrypto>=2.0.0", 'six',],
+    install_requires=["pycryptodome", 'six',],
+    extras_require={
+        # faster AES and 3DES; pycryptodome is still needed for the other ciphers
+        'cryptography': ['cryptography'],
+    },
     tests_require=["nose", "mock==1.0.1"],
     long_description="""send_nsca -- a pure-python nsca sender
 
 NSCA is the remote passive acceptance daemon used with many Nagios installs. It
 ships with a (C-language) executable called send_nsca for submitting checks.
 This is a mostly-clean re-implementation of send_nsca in pure-python. It
-supports 10 of the 26 crypto functions used by upstream NSCA, sending to
+supports 13 of the 26 crypto functions used by upstream NSCA, sending to
 multiple hosts with one invocation, and timeouts.
 """
 )
@@ -0,0 +1,133 @@
+import sys
+import time
+
+from unittest2 import TestCase, skipIf
+
+from send_nsca import fake_server
+from send_nsca import nsca
+
+if sys.version_info >= (3, 7):
+    import asyncio
+    from send_nsca.aio import AsyncNscaSender
+
+
+PASSWORD = b'TestingPassword'
+
+
+async def wait_for(server, count, timeout=2):
+    # server.wait_for() would block the event loop the server runs on
+    deadline = time.time() + timeout
+    while server.received < count and time.time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+def sent_to(server):
+    return [(r.host_name, r.service_name, r.status, r.output) for r in server.get_results()]
+
+
+@skipIf(sys.version_info < (3, 7), "asyncio sender tests need Python 3.7+")
+class TestAsyncNscaSender(TestCase):
+    def run_with_servers(self, test, n_servers=1):
+        async def run():
+            servers = [fake_server.AsyncNscaServer(password=PASSWORD, crypt_id=1) for _ in range(n_servers)]
+            for server in servers:
+                await server.start()
+            try:
+                await test(servers)
+            finally:
+                for server in servers:
+                    await server.stop()
+        asyncio.run(run())
+
+    def make_sender(self, server, **kwargs):
+        sender = AsyncNscaSender('127.0.0.1', config_path=None, port=server.port, **kwargs)
+        sender._sender.Crypter = nsca.XORCrypter
+        sender._sender.password = PASSWORD
+        return sender
+
+    def break_connection(self, sender):
+        sender._conns[0].writer.transport.abort()
+
+    def test_send_service_and_host(self):
+        async def test(servers):
+            async with self.make_sender(servers[0]) as sender:
+                await sender.send_service(b'host', b'service', 1, b'warning')
+                await sender.send_host(b'host', 0, b'up')
+                await wait_for(servers[0], 2)
+            self.assertEqual(sent_to(servers[0]), [(b'host', b'service', 1, b'warning'), (b'host', b'', 0, b'up')])
+        self.run_with_servers(test)
+
+    def test_send_many(self):
+        async def test(servers):
+            sender = self.make_sender(servers[0])
+            results = [(b'host', b'service %d' % i, i % 4, b'output') for i in range(50)]
+            errors = await sender.send_many(results + [(b'host', b'service', 9, b'bad')], chunk_size=20)
+            await wait_for(servers[0], 50)
+            await sender.disconnect()
+            self.assertEqual([index for index, _, _ in errors], [50])
+            self.assertEqual(sent_to(servers[0]), results)
+        self.run_with_servers(test)
+
+    def test_many_targets_concurrently(self):
+        async def test(servers):
+            senders = [self.make_sender(server) for server in servers]
+            await asyncio.gather(*[sender.send_service(b'host', b'service', 0, b'ok') for sender in senders])
+            for server in servers:
+                await wait_for(server, 1)
+                self.assertEqual(sent_to(server), [(b'host', b'service', 0, b'ok')])
+            await asyncio.gather(*[sender.disconnect() for sender in senders])
+        self.run_with_servers(test, n_servers=5)
+
+    def test_zero_timeout_means_none(self):
+        async def test(servers):
+            sender = self.make_sender(servers[0], timeout=0)
+            self.assertIsNone(sender.timeout)
+            await sender.send_service(b'host', b'service', 0, b'ok')
+            await wait_for(servers[0], 1)
+            await sender.disconnect()
+            self.assertEqual(sent_to(servers[0]), [(b'host', b'service', 0, b'ok')])
+        self.run_with_servers(test)
+
+    def test_reconnects(self):
+        async def test(servers):
+            sender = self.make_sender(servers[0])
+            await sender.send_service(b'host', b'service', 0, b'first')
+            await wait_for(servers[0], 1)
+            self.break_connection(sender)
+            await sender.send_service(b'host', b'service', 0, b'second')
+            await wait_for(servers[0], 2)
+            await sender.disconnect()
+            self.assertEqual(servers[0].connections, 2)
+            self.assertEqual([output for _, _, _, output in sent_to(servers[0])], [b'first', b'second'])
+        self.run_with_servers(test)
+
+    def test_reconnect_backoff(self):
+        async def test(servers):
+            sender = self.make_sender(servers[0], reconnect_backoff=60)
+            await sender.send_service(b'host', b'service', 0, b'first')
+            await servers[0].stop()
+            self.break_connection(sender)
+            with self.assertRaises(OSError):
+                await sender.send_service(b'host', b'service', 0, b'down')
+            await servers[0].start()
+            # held off, so not even tried
+            with self.assertRaises(OSError):
+                await sender.send_service(b'host', b'service', 0, b'backing off')
+            self.assertEqual(servers[0].connections, 1)
+            sender._sender._next_reconnect_times[0] = 0
+            await sender.send_service(b'host', b'service', 0, b'back')
+            await wait_for(servers[0], 2)
+            await sender.disconnect()
+            self.assertEqual(servers[0].connections, 2)
+            self.assertEqual(sender._sender._reconnect_delays, {})
+            self.assertEqual([output for _, _, _, output in sent_to(servers[0])], [b'first', b'back'])
+        self.run_with_servers(test)
+
+    def test_connect_failure(self):
+        async def test(servers):
+            sender = self.make_sender(servers[0])
+            await servers[0].stop()
+            with self.assertRaises(OSError):
+                await sender.send_service(b'host', b'service', 0, b'ok')
+            await servers[0].start()
+        self.run_with_servers(test)
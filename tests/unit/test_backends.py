@@ -0,0 +1,96 @@
+import os
+import subprocess
+import sys
+
+import mock
+from unittest2 import TestCase
+
+from send_nsca import backends
+from send_nsca import benchmark
+from send_nsca import nsca
+
+
+class TestBackends(TestCase):
+    def setUp(self):
+        self.addCleanup(backends.set_preference, None)
+        self.iv = os.urandom(nsca._TRANSMITTED_IV_SIZE)
+        self.password = b'TestingPassword-0123456789'
+        self.packets = os.urandom(nsca._data_packet_size * 2)
+
+    def crypter_classes(self):
+        return [c for c in nsca.crypters.values() if issubclass(c, nsca.CryptoCrypter)]
+
+    def test_import_loads_no_crypto_library(self):
+        code = 'import sys, send_nsca.nsca; print(sorted(m for m in sys.modules if m.split(".")[0] in ("Crypto", "Cryptodome", "cryptography")))'
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(nsca.__file__)))
+        self.assertEqual(output.strip(), b'[]')
+
+    def test_backends_agree(self):
+        available = backends.available_backends()
+        self.assertTrue(available)
+        for crypter_class in self.crypter_classes():
+            ciphertexts = {}
+            for name in available:
+                backends.set_preference([name])
+                if not crypter_class.available():
+                    continue
+                crypter = crypter_class(self.iv, self.password, os.urandom)
+                self.assertEqual(crypter.backend, name)
+                ciphertexts[name] = crypter.encrypt(self.packets)
+                decrypter = crypter_class(self.iv, self.password, os.urandom)
+                self.assertEqual(decrypter.decrypt(ciphertexts[name]), self.packets)
+            self.assertTrue(ciphertexts, crypter_class.__name__)
+            self.assertEqual(len(set(ciphertexts.values())), 1, (crypter_class.__name__, sorted(ciphertexts)))
+
+    def test_des3_with_short_passwords(self):
+        # zero-padding these makes 3DES keys that degenerate to single DES
+        for password in (b'short', b'12345678', b'a' * 16):
+            ciphertexts = set()
+            for name in backends.available_backends():
+                backends.set_preference([name])
+                if not nsca.DES3Crypter.available():
+                    continue
+                ciphertext = nsca.DES3Crypter(self.iv, password, os.urandom).encrypt(self.packets)
+                self.assertEqual(nsca.DES3Crypter(self.iv, password, os.urandom).decrypt(ciphertext), self.packets)
+                ciphertexts.add(ciphertext)
+            self.assertEqual(len(ciphertexts), 1, password)
+            # EDE with two equal keys in a row is single DES with the other
+            backends.set_preference(None)
+            key = nsca.DES3Crypter._cipher_setup(password)[0]
+            single = nsca.DESCrypter(self.iv, key[16:] if key[:8] == key[8:16] else key[:8], os.urandom)
+            self.assertEqual(single.encrypt(self.packets), ciphertexts.pop())
+
+    def test_encrypt_into_on_every_backend(self):
+        for name in backends.available_backends():
+            backends.set_preference([name])
+            for crypter_class in self.crypter_classes():
+                if not crypter_class.available():
+                    continue
+                buf = bytearray(self.packets)
+                crypter_class(self.iv, self.password, os.urandom).encrypt_into(buf)
+                self.assertEqual(bytes(buf), crypter_class(self.iv, self.password, os.urandom).encrypt(self.packets))
+
+    def test_default_preference(self):
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(backends.preference(backends.BLOWFISH)[0], backends.PYCRYPTODOME)
+            self.assertEqual(backends.preference(backends.AES)[0], backends.CRYPTOGRAPHY)
+        with mock.patch.dict(os.environ, {'SEND_NSCA_CRYPTO_BACKENDS': 'pycrypto, pycryptodome,bogus'}):
+            self.assertEqual(backends.preference(backends.AES), (backends.PYCRYPTO, backends.PYCRYPTODOME))
+
+    def test_unavailable(self):
+        backends.set_preference([])
+        self.assertFalse(nsca.DES3Crypter.available())
+        self.assertTrue(nsca.XORCrypter.available())
+        self.assertFalse(nsca.TwoFishCrypter.available())
+        self.assertRaises(backends.BackendUnavailable, nsca.DES3Crypter, self.iv, self.password, os.urandom)
+        self.assertRaises(ValueError, backends.set_preference, ['openssl'])
+
+    def test_missing_library(self):
+        with mock.patch.dict(backends._loaded, clear=True):
+            with mock.patch.dict(backends._loaders, {backends.CRYPTOGRAPHY: mock.Mock(side_effect=ImportError)}):
+                self.assertIsNone(backends.get_backend(backends.CRYPTOGRAPHY))
+                self.assertNotIn(backends.CRYPTOGRAPHY, backends.available_backends())
+
+    def test_benchmark(self):
+        results = benchmark.bench_backends(number=1, batch=1)
+        self.assertIn('encrypt AES128Crypter %s' % backends.backend_for(backends.AES).name, [r[0] for r in results])
@@ -0,0 +1,58 @@
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+from unittest2 import TestCase
+
+from send_nsca import backends
+from send_nsca import benchmark
+from send_nsca import nsca
+
+
+class TestBenchmark(TestCase):
+    def test_summarize(self):
+        summary = benchmark._summarize(100, 2.0, [i / 1e6 for i in range(100, 0, -1)])
+        self.assertEqual(summary['packets_per_sec'], 50)
+        self.assertEqual(summary['latency_us'], {'p50': 50, 'p90': 90, 'p99': 99, 'max': 100})
+        # nothing got sent
+        summary = benchmark._summarize(0, 0.5, [])
+        self.assertEqual(summary['packets_per_sec'], 0)
+        self.assertEqual(summary['latency_us'], {'p50': 0, 'p90': 0, 'p99': 0, 'max': 0})
+
+    def test_crypter_setup_uses_one_backend(self):
+        self.addCleanup(backends.set_preference, None)
+        backends.set_preference([backends.CRYPTOGRAPHY, backends.PYCRYPTODOME])
+        made = []
+        with mock.patch.object(benchmark, '_best_rate', side_effect=lambda func, number: made.append(func()) or 1):
+            benchmark.bench_crypter_setup(number=1)
+        legacy, cached = made[0::2], made[1::2]
+        for cipher, crypter in zip(legacy, cached):
+            self.assertEqual(crypter.backend, backends.PYCRYPTODOME)
+            self.assertEqual(type(cipher), type(crypter.crypter))
+        self.assertEqual(backends.preference(backends.DES3), (backends.CRYPTOGRAPHY, backends.PYCRYPTODOME))
+
+    def test_send_reaches_sink(self):
+        sink = benchmark.LoopbackSink()
+        self.addCleanup(sink.close)
+        for mode in ('single', 'batched'):
+            start = sink.bytes_received
+            result = benchmark.bench_send(sink, 3, 10, mode, packets=20, batch_size=10)
+            self.assertEqual(result['packets'], 20)
+            self.assertEqual(sink.bytes_received - start, 20 * nsca._data_packet_size)
+            self.assertEqual(result['cipher'], 'DES3Crypter')
+
+    def test_main_writes_json(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'results.json')
+        self.assertEqual(benchmark.main(['--no-micro', '-n', '10', '-b', '5', '-c', '0,1', '-l', '0', '-o', path]), 0)
+        with open(path) as f:
+            results = json.load(f)['results']
+        self.assertEqual([(r['crypt_id'], r['mode']) for r in results], [(0, 'single'), (0, 'batched'), (1, 'single'), (1, 'batched')])
+
+    def test_end_to_end(self):
+        result = benchmark.bench_end_to_end(1, packets=20)
+        self.assertEqual(result['packets'], 20)
+        self.assertEqual(result['rejected'], 0)
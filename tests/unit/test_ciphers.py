@@ -0,0 +1,101 @@
+import binascii
+import os
+
+from unittest2 import TestCase
+
+from send_nsca import ciphers
+from send_nsca import nsca
+
+
+def _unhex(value):
+    return binascii.unhexlify(value.replace(' ', ''))
+
+
+class _AESForCFB8(object):
+    """pycryptodome's AES with the interface CFB8 expects, to check CFB8
+    against pycryptodome's own CFB mode"""
+    block_size = 16
+    byteorder = 'big'
+
+    def __init__(self, key):
+        from Crypto.Cipher import AES
+        self.cipher = AES.new(key, AES.MODE_ECB)
+
+    def keystream_byte(self, register):
+        return bytearray(self.cipher.encrypt(_unhex('%032x' % register)))[0]
+
+
+class TestKnownAnswers(TestCase):
+    def check(self, cipher_class, key, plaintext, ciphertext):
+        self.assertEqual(binascii.hexlify(cipher_class(_unhex(key)).encrypt_block(_unhex(plaintext))),
+                         ciphertext.replace(' ', '').lower().encode('ascii'))
+
+    def test_xtea(self):
+        self.check(ciphers.XTEA, '000102030405060708090a0b0c0d0e0f', '4142434445464748', '497df3d072612cb5')
+        self.check(ciphers.XTEA, '00' * 16, '4142434445464748', 'a0390589f8b8efa5')
+
+    def test_twofish(self):
+        # from the Twofish paper
+        self.check(ciphers.Twofish, '00' * 16, '00' * 16, '9F589F5CF6122C32B6BFEC2F2AE8C35A')
+        self.check(ciphers.Twofish, '0123456789ABCDEFFEDCBA98765432100011223344556677', '00' * 16,
+                   'CFD1D2E5A9BE9CDF501F13B892BD2248')
+        self.check(ciphers.Twofish, '0123456789ABCDEFFEDCBA987654321000112233445566778899AABBCCDDEEFF', '00' * 16,
+                   '37527BE0052334B89F0CFCCAE87CFA20')
+        self.check(ciphers.Twofish, '00' * 32, '00' * 16, '57FF739D4DC92C1BD7FC01700CC8216F')
+
+    def test_rc6(self):
+        # from the RC6 paper
+        self.check(ciphers.RC6, '00' * 16, '00' * 16, '8fc3a53656b1f778c129df4e9848a41e')
+        self.check(ciphers.RC6, '0123456789abcdef0112233445566778', '02132435465768798a9bacbdcedfe0f1',
+                   '524e192f4715c6231f51f6367ea43f18')
+        self.check(ciphers.RC6, '0123456789abcdef0112233445566778899aabbccddeeff01032547698badcfe',
+                   '02132435465768798a9bacbdcedfe0f1', 'c8241816f0d7e48920ad16a1674e5d48')
+
+    def test_bad_key_size(self):
+        self.assertRaises(ValueError, ciphers.XTEA, b'\0' * 15)
+        self.assertRaises(ValueError, ciphers.Twofish, b'\0' * 20)
+        self.assertRaises(ValueError, ciphers.RC6, b'')
+
+
+class TestCFB8(TestCase):
+    def test_matches_pycryptodome(self):
+        from Crypto.Cipher import AES
+        key, iv, value = os.urandom(16), os.urandom(16), os.urandom(100)
+        expected = AES.new(key, AES.MODE_CFB, iv, segment_size=8).encrypt(value)
+        cfb = ciphers.CFB8(_AESForCFB8(key), iv)
+        # in pieces, to check the register carries over
+        self.assertEqual(cfb.encrypt(value[:33]) + cfb.encrypt(value[33:]), expected)
+        self.assertEqual(ciphers.CFB8(_AESForCFB8(key), iv).decrypt(expected), value)
+
+    def test_round_trip(self):
+        value = os.urandom(100)
+        for cipher_class, key_size in ((ciphers.XTEA, 16), (ciphers.Twofish, 32), (ciphers.RC6, 256)):
+            cipher = cipher_class(os.urandom(key_size))
+            iv = os.urandom(cipher.block_size)
+            ciphertext = ciphers.CFB8(cipher, iv).encrypt(value)
+            self.assertNotEqual(ciphertext, value)
+            self.assertEqual(ciphers.CFB8(cipher, iv).decrypt(ciphertext), value)
+            # a cipher byte depends only on the ones before it
+            self.assertEqual(ciphers.CFB8(cipher, iv).encrypt(value[:10]), ciphertext[:10])
+
+    def test_bad_iv(self):
+        self.assertRaises(ValueError, ciphers.CFB8, ciphers.XTEA(b'\0' * 16), b'\0' * 16)
+
+
+class TestCrypters(TestCase):
+    def test_crypters_use_cfb8(self):
+        iv = os.urandom(nsca._TRANSMITTED_IV_SIZE)
+        packet = os.urandom(nsca._data_packet_size)
+        for crypter_class, cipher_class in (
+            (nsca.XTEACrypter, ciphers.XTEA),
+            (nsca.TwoFishCrypter, ciphers.Twofish),
+            (nsca.RC6Crypter, ciphers.RC6),
+        ):
+            self.assertTrue(crypter_class.available())
+            crypter = crypter_class(iv, b'password', os.urandom)
+            self.assertEqual(crypter.backend, 'python')
+            self.assertEqual(crypter.decrypt(crypter.encrypt(packet)), packet)
+            # the password is zero-padded to mcrypt's key size, and the IV cut to the block size
+            cipher = cipher_class(b'password'.ljust(crypter_class.key_size, b'\0'))
+            self.assertEqual(crypter_class(iv, b'password', os.urandom).encrypt(packet),
+                             ciphers.CFB8(cipher, iv[:cipher.block_size]).encrypt(packet))
@@ -0,0 +1,94 @@
+import io
+import os
+import socket
+import subprocess
+import sys
+
+import mock
+from unittest2 import TestCase
+
+from send_nsca import cli
+from send_nsca import nsca
+
+
+class TestParseLine(TestCase):
+    def test_service_and_host_lines(self):
+        self.assertEqual(cli.parse_line(b'host\tservice\t2\toutput\n'), (b'host', b'service', 2, b'output'))
+        self.assertEqual(cli.parse_line(b'host\t0\toutput'), (b'host', b'', 0, b'output'))
+        self.assertEqual(cli.parse_line(b'host,1,output', b','), (b'host', b'', 1, b'output'))
+
+    def test_malformed_lines(self):
+        self.assertRaises(ValueError, cli.parse_line, b'host\toutput')
+        self.assertRaises(ValueError, cli.parse_line, b'host\tservice\tx\toutput')
+        self.assertRaises(ValueError, cli.parse_line, b'a\tb\tc\t0\td')
+
+    def test_iter_lines_across_blocks(self):
+        stream = io.BytesIO(b'one\ntwo\n\nthree')
+        self.assertEqual(list(cli.iter_lines(stream, block_size=3)), [b'one', b'two', b'', b'three'])
+
+
+class TestMain(TestCase):
+    def setUp(self):
+        self.sent = []
+        self.stderr = io.StringIO() if str is not bytes else io.BytesIO()
+
+        def send_many(results):
+            self.sent.extend(results)
+            return []
+        patches = [
+            mock.patch.object(nsca.NscaSender, 'send_many', autospec=True, side_effect=lambda self, results: send_many(results)),
+            mock.patch.object(nsca.NscaSender, 'send_service', autospec=True,
+                              side_effect=lambda self, *result: self.__class__._check_alert(self, *result) or send_many([result])),
+            mock.patch.object(nsca.NscaSender, 'disconnect', autospec=True),
+            mock.patch('logging.basicConfig'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def run_main(self, data, *args):
+        return cli.main(['-H', 'test', '-c', '/dev/null'] + list(args), stdin=io.BytesIO(data), stderr=self.stderr)
+
+    def test_simple(self):
+        self.assertEqual(self.run_main(b'host\tservice\t0\tok\nhost\t1\twarn\n'), 0)
+        self.assertEqual(self.sent, [(b'host', b'service', 0, b'ok'), (b'host', b'', 1, b'warn')])
+
+    def test_stops_at_bad_line(self):
+        self.assertEqual(self.run_main(b'host\t0\tok\nbad\nhost\t1\tnever\n'), 1)
+        self.assertEqual(self.sent, [(b'host', b'', 0, b'ok')])
+
+    def test_stream(self):
+        data = b''.join(b'host\tservice %d\t0\tok\n' % i for i in range(25))
+        self.assertEqual(self.run_main(data, '--stream', '--batch-size', '10'), 0)
+        self.assertEqual(self.sent, [(b'host', b'service %d' % i, 0, b'ok') for i in range(25)])
+        self.assertIn('Sent 25 results', self.stderr.getvalue())
+
+    def test_stream_continue_on_error(self):
+        data = b'host\t0\tok\nbad\nhost\t9\tbad state\nhost\t1\twarn\n'
+        self.assertEqual(self.run_main(data, '--stream', '--continue-on-error'), 0)
+        self.assertEqual(self.sent, [(b'host', b'', 0, b'ok'), (b'host', b'', 1, b'warn')])
+        self.assertIn('2 lines rejected', self.stderr.getvalue())
+
+    def test_stream_send_failures(self):
+        nsca.NscaSender.send_many.side_effect = socket.error('down')
+        self.assertEqual(self.run_main(b'host\t0\tok\n', '--stream'), 1)
+        self.assertIn('1 results failed', self.stderr.getvalue())
+
+    def test_rate(self):
+        init = nsca.NscaSender.__init__
+        with mock.patch.object(nsca.NscaSender, '__init__', autospec=True, side_effect=init) as mock_init:
+            self.run_main(b'host\t0\tok\n', '--rate', '50')
+        self.assertEqual(mock_init.call_args[1]['rate_limit'], 50)
+
+    def test_processes(self):
+        with mock.patch('send_nsca.sharded.ShardedNscaSender') as mock_sharded:
+            mock_sharded.return_value.close.return_value = {'sent': 1, 'failed': 0}
+            self.assertEqual(self.run_main(b'host\t0\tok\n', '--processes', '2', '--rate', '50'), 0)
+        self.assertEqual(mock_sharded.call_args[1]['processes'], 2)
+        self.assertEqual(mock_sharded.call_args[1]['rate_limit'], 25)
+        mock_sharded.return_value.send_service.assert_called_once_with(b'host', b'', 0, b'ok')
+
+    def test_import_does_not_load_multiprocessing(self):
+        code = 'import sys, send_nsca.cli; print("multiprocessing" in sys.modules)'
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(cli.__file__)))
+        self.assertEqual(output.strip(), b'False')
@@ -0,0 +1,129 @@
+import socket
+import threading
+
+import mock
+from unittest2 import TestCase
+
+from send_nsca import coalesce
+from send_nsca import nsca
+
+
+class TestCoalescingSender(TestCase):
+    def setUp(self):
+        self.sender = nsca.NscaSender(remote_host='test', config_path=None)
+        self.batches = []
+        self.sent = threading.Event()
+
+        def send_many(results, chunk_size=1000):
+            self.batches.append(list(results))
+            self.sent.set()
+            return []
+        p = mock.patch.object(self.sender, 'send_many', side_effect=send_many)
+        p.start()
+        self.addCleanup(p.stop)
+        self.now = 1000.0
+        p = mock.patch('time.time', side_effect=lambda: self.now)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def coalescer(self, **kwargs):
+        # a long window, so that only the tests' flushes send anything
+        kwargs.setdefault('window', 3600)
+        c = coalesce.CoalescingSender(self.sender, **kwargs)
+        self.addCleanup(c.close)
+        return c
+
+    def test_keeps_latest_per_key(self):
+        c = self.coalescer()
+        c.send_service(b'host', b'service', 0, b'first')
+        c.send_service(b'host', b'other', 0, b'other')
+        c.send_service(b'host', b'service', 2, b'second')
+        c.send_host(b'host', 0, b'up')
+        c.send_service(b'host', None, 1, b'still up')
+        self.assertEqual(c.flush(), 3)
+        self.assertEqual(self.batches, [[
+            (b'host', b'service', 2, b'second'),
+            (b'host', b'other', 0, b'other'),
+            (b'host', b'', 1, b'still up'),
+        ]])
+        self.assertEqual(c.flush(), 0)
+        self.assertEqual(c.counters(), {'received': 5, 'coalesced': 2, 'unchanged': 0, 'sent': 3, 'failed': 0, 'pending': 0})
+
+    def test_validates_immediately(self):
+        c = self.coalescer()
+        self.assertRaises(ValueError, c.send_service, b'host', b'service', 7, b'bad')
+        self.assertEqual(c.counters()['received'], 0)
+
+    def test_only_changes(self):
+        c = self.coalescer(only_changes=True, resend_interval=60)
+        self.assertTrue(c.send_service(b'host', b'service', 0, b'ok'))
+        c.flush()
+        self.assertFalse(c.send_service(b'host', b'service', 0, b'ok'))
+        self.assertTrue(c.send_service(b'host', b'service', 2, b'down'))
+        # back to what Nagios already has before the change was sent
+        self.assertFalse(c.send_service(b'host', b'service', 0, b'ok'))
+        self.assertEqual(c.flush(), 0)
+        self.now += 61
+        self.assertTrue(c.send_service(b'host', b'service', 0, b'ok'))
+        c.flush()
+        c.forget(b'host', b'service')
+        self.assertTrue(c.send_service(b'host', b'service', 0, b'ok'))
+        self.assertEqual(c.counters()['unchanged'], 2)
+
+    def test_forgets_results_older_than_resend_interval(self):
+        c = self.coalescer(only_changes=True, resend_interval=60)
+        c.send_service(b'host', b'old', 0, b'ok')
+        c.flush()
+        self.now += 30
+        c.send_service(b'host', b'newer', 0, b'ok')
+        c.flush()
+        self.now += 31
+        c.send_service(b'host', b'newest', 0, b'ok')
+        c.flush()
+        self.assertEqual(list(c._last_sent), [(b'host', b'newer'), (b'host', b'newest')])
+
+    def test_remembers_at_most_max_remembered(self):
+        c = self.coalescer(only_changes=True, max_remembered=2)
+        for service in (b'first', b'second', b'third'):
+            c.send_service(b'host', service, 0, b'ok')
+        c.flush()
+        c.send_service(b'host', b'second', 1, b'changed')
+        c.flush()
+        c.send_service(b'host', b'fourth', 0, b'ok')
+        c.flush()
+        self.assertEqual(list(c._last_sent), [(b'host', b'second'), (b'host', b'fourth')])
+        # forgotten, so sent again even though it's unchanged
+        self.assertTrue(c.send_service(b'host', b'first', 0, b'ok'))
+        self.assertFalse(c.send_service(b'host', b'fourth', 0, b'ok'))
+
+    def test_failed_send_is_not_remembered(self):
+        c = self.coalescer(only_changes=True)
+        c.send_service(b'host', b'service', 0, b'ok')
+        with mock.patch.object(self.sender, 'send_many', side_effect=socket.error('refused')):
+            self.assertEqual(c.flush(), 0)
+        self.assertTrue(c.send_service(b'host', b'service', 0, b'ok'))
+        self.assertEqual(c.counters()['failed'], 1)
+
+    def test_flushes_at_max_pending(self):
+        c = self.coalescer(max_pending=3)
+        for i in range(3):
+            c.send_service(b'host%d' % i, b'service', 0, b'')
+        self.assertTrue(self.sent.wait(5))
+        self.assertEqual(len(self.batches[0]), 3)
+
+    def test_flushes_on_timer(self):
+        c = self.coalescer(window=0.01)
+        self.now += 1
+        c.send_host(b'host', 0, b'')
+        with mock.patch('time.time', side_effect=lambda: self.now + 10):
+            self.assertTrue(self.sent.wait(5))
+        self.assertEqual(self.batches, [[(b'host', b'', 0, b'')]])
+
+    def test_close_sends_pending(self):
+        c = self.coalescer()
+        c.send_host(b'host', 0, b'')
+        with mock.patch.object(self.sender, 'disconnect') as mock_disconnect:
+            c.close()
+        self.assertEqual(self.batches, [[(b'host', b'', 0, b'')]])
+        self.assertTrue(mock_disconnect.called)
+        self.assertRaises(ValueError, c.send_host, b'host', 0, b'')
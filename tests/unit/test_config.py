@@ -1,5 +1,9 @@
 import io
+import os
+import shutil
+import tempfile
 
+import mock
 import six
 from unittest2 import TestCase
 
@@ -42,11 +46,12 @@ password = 1234
             3: True,
             4: True,
             5: False,
-            6: False,
+            6: True,
             7: False,
             8: True,
-            9: False,
+            9: True,
             10: False,
+            13: True,
             14: True,
             15: True,
             16: True,
@@ -62,3 +67,52 @@ password = 1234
                 self.assertEqual(self.sender.encryption_method_i, crypter)
             else:
                 self.assertRaises(send_nsca.nsca.ConfigParseError, self.sender.parse_config, stream)
+
+
+class TestConfigCache(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'send_nsca.cfg')
+        self.write(b"password = 1234\nencryption_method = 1\n")
+        self.cache = send_nsca.nsca.ConfigCache(check_interval=0)
+
+    def write(self, contents):
+        with open(self.path, 'wb') as f:
+            f.write(contents)
+
+    def test_parse_config_file(self):
+        config = send_nsca.nsca.parse_config_file(io.BytesIO(b"password = 1234\n"))
+        self.assertEqual(config.password, b"1234")
+        self.assertIsNone(config.encryption_method)
+        self.assertIsNone(config.Crypter)
+        self.assertRaises(AttributeError, setattr, config, 'password', b'changed')
+
+    def test_reuses_parsed_config_until_file_changes(self):
+        with mock.patch.object(self.cache, 'reload', wraps=self.cache.reload) as mock_reload:
+            config = self.cache.get(self.path)
+            self.assertIs(self.cache.get(self.path), config)
+            self.assertEqual(mock_reload.call_count, 1)
+            self.assertEqual((config.password, config.Crypter), (b"1234", send_nsca.nsca.XORCrypter))
+            self.write(b"password = 5678\nencryption_method = 0\n# now a different size\n")
+            self.assertEqual(self.cache.get(self.path).password, b"5678")
+            self.assertEqual(mock_reload.call_count, 2)
+
+    def test_check_interval(self):
+        self.cache.check_interval = 60
+        self.cache.get(self.path)
+        self.write(b"password = 5678\n# changed\n")
+        with mock.patch('os.stat') as mock_stat:
+            self.assertEqual(self.cache.get(self.path).password, b"1234")
+        self.assertFalse(mock_stat.called)
+        # until it's reloaded explicitly
+        self.assertEqual(self.cache.reload(self.path).password, b"5678")
+        self.assertEqual(self.cache.get(self.path).password, b"5678")
+
+    def test_senders_share_config(self):
+        send_nsca.nsca.config_cache.clear()
+        one = send_nsca.nsca.NscaSender(b"test_host", config_path=self.path)
+        with mock.patch.object(send_nsca.nsca, 'open', create=True, side_effect=AssertionError("re-read")):
+            two = send_nsca.nsca.NscaSender(b"test_host", config_path=self.path)
+        self.assertIs(one.config, two.config)
+        self.assertEqual((two.password, two.encryption_method_i, two.Crypter), (b"1234", 1, send_nsca.nsca.XORCrypter))
@@ -1,9 +1,16 @@
+import os
+import select
 import socket
+import threading
+import time
 
 import mock
+import six
 from unittest2 import TestCase
 
 import send_nsca
+from send_nsca import nsca
+from send_nsca import resolver
 from send_nsca.nsca import DEFAULT_PORT
 
 
@@ -20,6 +27,7 @@ class TestConnectionLogic(TestCase):
     sigil_two = object()
 
     def setUp(self):
+        resolver.default_cache.clear()
         self.sender = send_nsca.NscaSender(b'test_host', config_path=None)
 
     def test_no_result_fails(self):
@@ -77,12 +85,13 @@ class TestConnectionLogic(TestCase):
         with mock.patch('socket.getaddrinfo', mock_getaddrinfo):
             with mock.patch('socket.socket', mock_socket):
                 with mock.patch.object(self.sender, '_read_init_packet', mock_read_iv):
-                    self.sender.connect()
+                    with mock.patch.object(self.sender, '_wait_readable', side_effect=lambda conns, deadline: list(conns)):
+                        self.sender.connect()
         mock_socket.assert_any_call(socket.AF_INET, socket.SOCK_STREAM, socket.SOL_TCP)
         mock_socket.assert_any_call(socket.AF_INET, socket.SOCK_STREAM, socket.SOL_UDP)
         self.assertEqual(len(sockets), 2)
-        mock_read_iv.assert_any_call(sockets[0])
-        mock_read_iv.assert_any_call(sockets[1])
+        mock_read_iv.assert_any_call(sockets[0], mock.ANY)
+        mock_read_iv.assert_any_call(sockets[1], mock.ANY)
 
     def test_disconnect_disconnects(self):
         mock_getaddrinfo = mock.Mock(return_value=[self.addrinfo_one])
@@ -92,10 +101,161 @@ class TestConnectionLogic(TestCase):
         with mock.patch('socket.getaddrinfo', mock_getaddrinfo):
             with mock.patch('socket.socket', mock_socket):
                 with mock.patch.object(self.sender, '_read_init_packet', mock_read_iv):
-                    self.sender.timeout = test_timeout
-                    self.sender.connect()
-                    assert not mock_socket.return_value.close.called
-                    self.sender.disconnect()
+                    with mock.patch.object(self.sender, '_wait_readable', side_effect=lambda conns, deadline: list(conns)):
+                        self.sender.timeout = test_timeout
+                        self.sender.connect()
+                        assert not mock_socket.return_value.close.called
+                        self.sender.disconnect()
         mock_socket.assert_any_call(socket.AF_INET, socket.SOCK_STREAM, socket.SOL_TCP)
         mock_socket.return_value.settimeout.assert_called_once_with(test_timeout)
         mock_socket.return_value.close.assert_called_once_with()
+
+
+class TestConcurrentConnect(TestCase):
+    def setUp(self):
+        resolver.default_cache.clear()
+
+    def listener(self, send_init=True):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        s.listen(5)
+        self.addCleanup(s.close)
+        if send_init:
+            def serve():
+                conn, _ = s.accept()
+                conn.sendall(b'\0' * 128 + b'\0\0\0\1')
+                self.addCleanup(conn.close)
+            t = threading.Thread(target=serve)
+            t.daemon = True
+            t.start()
+        return ('127.0.0.1', s.getsockname()[1])
+
+    def unused_address(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        address = ('127.0.0.1', s.getsockname()[1])
+        s.close()
+        return address
+
+    def connect(self, addresses, timeout=2, send_to_all=True):
+        sender = send_nsca.NscaSender(b'test_host', config_path=None, timeout=timeout, send_to_all=send_to_all)
+        self.addCleanup(sender.disconnect)
+        addrinfos = [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', address) for address in addresses]
+        with mock.patch('socket.getaddrinfo', mock.Mock(return_value=addrinfos)):
+            sender.connect()
+        return sender
+
+    def test_connects_to_all(self):
+        addresses = [self.listener(), self.listener(), self.listener()]
+        sender = self.connect(addresses)
+        self.assertEqual(len(sender._conns), 3)
+        self.assertEqual(sender.connect_results, dict((address, None) for address in addresses))
+
+    def test_reports_failures(self):
+        good, refused, silent = self.listener(), self.unused_address(), self.listener(send_init=False)
+        start = time.time()
+        sender = self.connect([good, refused, silent], timeout=0.5)
+        # one deadline for everything, rather than a timeout per address
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(len(sender._conns), 1)
+        self.assertEqual(sender.connect_results[good], None)
+        self.assertTrue(isinstance(sender.connect_results[refused], socket.error))
+        self.assertTrue(isinstance(sender.connect_results[silent], socket.timeout))
+
+    def test_all_fail(self):
+        self.assertRaises(socket.error, self.connect, [self.unused_address(), self.listener(send_init=False)], timeout=0.3)
+
+    def test_first_to_connect(self):
+        refused, good = self.unused_address(), self.listener()
+        sender = self.connect([refused, good], send_to_all=False)
+        self.assertEqual(len(sender._conns), 1)
+        self.assertEqual(sender._conns[0][0].getpeername(), good)
+
+    def test_file_descriptors_above_fd_setsize(self):
+        try:
+            import resource
+        except ImportError:
+            self.skipTest("no resource module")
+        if six.PY2 or resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 2100:
+            self.skipTest("can't open file descriptors above 2048 here")
+        addresses = [self.listener(), self.listener()]
+        sender = send_nsca.NscaSender(b'test_host', config_path=None, timeout=2)
+        self.addCleanup(sender.disconnect)
+        start_connect = sender._start_connect
+        high_fds = iter(range(2048, 2100))
+
+        def start_high_connect(addrinfo):
+            # select() can't handle these, so this only works if connect() doesn't use it
+            s, connected = start_connect(addrinfo)
+            fd = next(high_fds)
+            os.dup2(s.fileno(), fd)
+            high = socket.socket(s.family, s.type, s.proto, fileno=fd)
+            s.close()
+            return high, connected
+        addrinfos = [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', address) for address in addresses]
+        with mock.patch('socket.getaddrinfo', mock.Mock(return_value=addrinfos)):
+            with mock.patch.object(sender, '_start_connect', side_effect=start_high_connect):
+                sender.connect()
+        self.assertEqual(len(sender._conns), 2)
+        self.assertTrue(all(conn.fileno() >= 2048 for conn, _, _ in sender._conns))
+
+
+class TestWaitForSockets(TestCase):
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.addCleanup(self.ours.close)
+        self.addCleanup(self.theirs.close)
+
+    def check(self):
+        self.assertEqual(nsca._wait_for_sockets([self.ours], [], 0), ([], [], []))
+        self.assertEqual(nsca._wait_for_sockets([], [self.ours], 0)[1], [self.ours])
+        self.theirs.sendall(b'x')
+        self.assertEqual(nsca._wait_for_sockets([self.ours], [], 1)[0], [self.ours])
+
+    def test_poll(self):
+        if not hasattr(select, 'poll'):
+            self.skipTest("no poll() here")
+        self.check()
+
+    def test_select_without_poll(self):
+        with mock.patch.object(nsca, 'select', mock.Mock(spec=['select'], select=select.select)):
+            self.check()
+
+
+class TestReadInitPacket(TestCase):
+    def setUp(self):
+        self.sender = send_nsca.NscaSender(b'test_host', config_path=None)
+        self.ours, self.theirs = socket.socketpair()
+        self.addCleanup(self.ours.close)
+        self.addCleanup(self.theirs.close)
+        self.ours.settimeout(7)
+        self.init_packet = b'\1' * 128 + b'\0\0\0\2'
+
+    def test_reassembles_short_reads(self):
+        def trickle():
+            for i in range(0, len(self.init_packet), 50):
+                self.theirs.sendall(self.init_packet[i:i + 50])
+                time.sleep(0.02)
+        t = threading.Thread(target=trickle)
+        t.start()
+        self.addCleanup(t.join)
+        self.assertEqual(self.sender._read_init_packet(self.ours, time.time() + 2), (b'\1' * 128, 2))
+        self.assertEqual(self.ours.gettimeout(), 7)
+
+    def test_deadline(self):
+        self.theirs.sendall(self.init_packet[:100])
+        start = time.time()
+        self.assertRaises(socket.timeout, self.sender._read_init_packet, self.ours, time.time() + 0.2)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(self.ours.gettimeout(), 7)
+
+    def test_closed_mid_packet(self):
+        self.theirs.sendall(self.init_packet[:100])
+        self.theirs.close()
+        self.assertRaises(socket.error, self.sender._read_init_packet, self.ours, time.time() + 2)
+
+    def test_separate_timeouts(self):
+        sender = send_nsca.NscaSender(b'test_host', config_path=None, timeout=5, handshake_timeout=1, send_timeout=0)
+        self.assertEqual(sender._timeout_for(sender.connect_timeout), 5)
+        self.assertEqual(sender._timeout_for(sender.handshake_timeout), 1)
+        self.assertEqual(sender._timeout_for(sender.send_timeout), None)
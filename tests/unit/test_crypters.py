@@ -0,0 +1,99 @@
+import os
+
+from unittest2 import TestCase
+
+from send_nsca import nsca
+from send_nsca.benchmark import legacy_crypto_crypter_setup, legacy_xor_encrypt
+
+
+class TestXORCrypter(TestCase):
+    def setUp(self):
+        self.iv = os.urandom(nsca._TRANSMITTED_IV_SIZE)
+        self.password = b'TestingPassword'
+        self.crypter = nsca.XORCrypter(self.iv, self.password, os.urandom)
+
+    def test_matches_bytewise_implementation(self):
+        for length in (1, 15, 128, 500, nsca._data_packet_size):
+            value = os.urandom(length)
+            self.assertEqual(self.crypter.encrypt(value), legacy_xor_encrypt(value, self.iv, self.password))
+
+    def test_round_trip(self):
+        packet = os.urandom(nsca._data_packet_size)
+        self.assertEqual(self.crypter.encrypt(self.crypter.encrypt(packet)), packet)
+
+    def test_batch_restarts_keystream_per_packet(self):
+        packets = [os.urandom(nsca._data_packet_size) for _ in range(5)]
+        expected = b''.join(self.crypter.encrypt(packet) for packet in packets)
+        self.assertEqual(self.crypter.encrypt_packets(b''.join(packets)), expected)
+
+    def test_batch_rejects_partial_packets(self):
+        self.assertRaises(ValueError, self.crypter.encrypt_packets, b'\0' * (nsca._data_packet_size + 1))
+
+    def test_empty_password(self):
+        crypter = nsca.XORCrypter(self.iv, b'', os.urandom)
+        packet = os.urandom(nsca._data_packet_size)
+        self.assertEqual(crypter.encrypt(packet), nsca.XORCrypter(self.iv, b'\0', os.urandom).encrypt(packet))
+
+
+class TestCryptoCrypterSetup(TestCase):
+    def test_setup_cached_per_class_and_password(self):
+        nsca._cipher_setups.clear()
+        iv = os.urandom(nsca._TRANSMITTED_IV_SIZE)
+        one = nsca.DES3Crypter(iv, b'TestingPassword-0123456789', os.urandom)
+        two = nsca.DES3Crypter(os.urandom(nsca._TRANSMITTED_IV_SIZE), b'TestingPassword-0123456789', os.urandom)
+        self.assertIs(one.cipher_factory, two.cipher_factory)
+        self.assertEqual(one.key, b'TestingPassword-01234567')
+        nsca.BlowFishCrypter(iv, b'TestingPassword-0123456789', os.urandom)
+        nsca.DES3Crypter(iv, b'OtherPassword-0123456789ab', os.urandom)
+        self.assertEqual(len(nsca._cipher_setups), 3)
+
+    def test_matches_uncached_cipher(self):
+        iv = os.urandom(nsca._TRANSMITTED_IV_SIZE)
+        packets = os.urandom(nsca._data_packet_size * 2)
+        for crypter_class in (nsca.DES3Crypter, nsca.BlowFishCrypter, nsca.RC2Crypter, nsca.CAST128Crypter):
+            crypter = crypter_class(iv, b'TestingPassword-0123456789', os.urandom)
+            legacy = legacy_crypto_crypter_setup(crypter_class, iv, b'TestingPassword-0123456789')
+            self.assertEqual(crypter.encrypt(packets), legacy.encrypt(packets), crypter_class.__name__)
+            self.assertEqual(crypter.decrypt(crypter_class(iv, b'TestingPassword-0123456789', os.urandom).encrypt(packets)), packets)
+
+
+class TestEncryptInto(TestCase):
+    def setUp(self):
+        self.iv = os.urandom(nsca._TRANSMITTED_IV_SIZE)
+        self.password = b'TestingPassword-0123456789'
+        self.packets = os.urandom(nsca._data_packet_size * 3)
+
+    def test_matches_encrypt_packets(self):
+        for crypter_class in (nsca.NullCrypter, nsca.XORCrypter, nsca.DES3Crypter, nsca.BlowFishCrypter, nsca.AES256Crypter):
+            buf = bytearray(self.packets)
+            encrypted = crypter_class(self.iv, self.password, os.urandom).encrypt_into(buf)
+            self.assertIsInstance(encrypted, memoryview)
+            self.assertIs(encrypted.obj, buf)
+            expected = crypter_class(self.iv, self.password, os.urandom).encrypt_packets(self.packets)
+            self.assertEqual(bytes(buf), expected, crypter_class.__name__)
+
+    def test_cipher_state_carries_over(self):
+        crypter = nsca.DES3Crypter(self.iv, self.password, os.urandom)
+        size = nsca._data_packet_size
+        encrypted = b''.join(bytes(crypter.encrypt_into(bytearray(self.packets[i:i + size]))) for i in range(0, len(self.packets), size))
+        self.assertEqual(encrypted, nsca.DES3Crypter(self.iv, self.password, os.urandom).encrypt(self.packets))
+
+    def test_falls_back_without_output_argument(self):
+        crypter = nsca.DES3Crypter(self.iv, self.password, os.urandom)
+        reference = nsca.DES3Crypter(self.iv, self.password, os.urandom)
+
+        class NoOutputCipher(object):
+            """PyCrypto's ciphers can't encrypt in place"""
+            def __init__(self, cipher):
+                self.cipher = cipher
+
+            def encrypt(self, value):
+                return self.cipher.encrypt(value)
+
+        crypter.crypter = NoOutputCipher(crypter.crypter)
+        crypter.encrypts_in_place = True
+        for _ in range(2):
+            buf = bytearray(self.packets)
+            crypter.encrypt_into(buf)
+            self.assertEqual(bytes(buf), reference.encrypt(self.packets))
+        self.assertFalse(crypter.encrypts_in_place)
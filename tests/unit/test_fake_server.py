@@ -0,0 +1,118 @@
+import os
+import socket
+import struct
+import sys
+import time
+
+from unittest2 import TestCase, skipIf
+
+from send_nsca import fake_server
+from send_nsca import nsca
+
+if sys.version_info >= (3, 7):
+    import asyncio
+
+PASSWORD = b'TestingPassword-0123456789abcdef'
+
+
+class TestDecodePacket(TestCase):
+    def build(self, timestamp=None):
+        return bytearray(nsca._pack_packet(b'host', b'service', 2, b'output', timestamp or int(time.time())))
+
+    def test_round_trip(self):
+        result = fake_server.decode_packet(bytes(self.build(timestamp=1000)), now=1010)
+        self.assertEqual(result[:5], (b'host', b'service', 2, b'output', 1000))
+
+    def test_rejects_bad_crc_version_and_age(self):
+        packet = self.build()
+        packet[-20] ^= 1
+        self.assertRaises(fake_server.PacketError, fake_server.decode_packet, bytes(packet))
+        packet = self.build()
+        struct.pack_into('!h', packet, 0, 2)
+        self.assertRaises(fake_server.PacketError, fake_server.decode_packet, bytes(packet))
+        packet = bytes(self.build(timestamp=1000))
+        self.assertRaises(fake_server.PacketError, fake_server.decode_packet, packet, max_packet_age=30, now=1031)
+        self.assertRaises(fake_server.PacketError, fake_server.decode_packet, packet[:-1])
+
+
+class TestThreadedNscaServer(TestCase):
+    def make_server(self, **kwargs):
+        server = fake_server.ThreadedNscaServer(password=PASSWORD, **kwargs).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def make_sender(self, server, crypt_id):
+        sender = nsca.NscaSender('127.0.0.1', config_path=None, port=server.port)
+        sender.Crypter = nsca.crypters[crypt_id]
+        sender.password = PASSWORD
+        self.addCleanup(sender.disconnect)
+        return sender
+
+    def test_every_supported_crypter(self):
+        for crypt_id, crypter in sorted(nsca.crypters.items()):
+            if issubclass(crypter, nsca.UnsupportedCrypter):
+                continue
+            server = self.make_server(crypt_id=crypt_id)
+            sender = self.make_sender(server, crypt_id)
+            sender.send_service(b'host', b'service', 1, b'single')
+            sender.send_many([(b'host', None, 0, b'batch %d' % i) for i in range(3)])
+            self.assertTrue(server.wait_for(4))
+            self.assertEqual(
+                [result[:4] for result in server.get_results()],
+                [(b'host', b'service', 1, b'single')] + [(b'host', b'', 0, b'batch %d' % i) for i in range(3)],
+                crypter.__name__,
+            )
+            self.assertEqual(server.rejected, 0)
+
+    def test_callback_and_rejects(self):
+        received = []
+        server = self.make_server(crypt_id=1, callback=received.append)
+        sender = self.make_sender(server, 1)
+        sender.password = b'wrong password'
+        sender.send_host(b'host', 0, b'garbled')
+        sender.password = PASSWORD
+        sender.disconnect()
+        sender.send_host(b'host', 0, b'fine')
+        self.assertTrue(server.wait_for(2))
+        self.assertEqual(server.rejected, 1)
+        self.assertEqual([result.output for result in received], [b'fine'])
+        self.assertTrue(server.results.empty())
+
+    def test_many_connections(self):
+        server = self.make_server(crypt_id=0)
+        conns = []
+        for _ in range(50):
+            conn = socket.create_connection(('127.0.0.1', server.port))
+            self.addCleanup(conn.close)
+            conns.append(conn)
+        for conn in conns:
+            iv, timestamp = struct.unpack(nsca._init_packet_format, conn.recv(struct.calcsize(nsca._init_packet_format), socket.MSG_WAITALL))
+            conn.sendall(nsca._pack_packet(b'host', b'', 0, b'', timestamp))
+        self.assertTrue(server.wait_for(50))
+        self.assertEqual(server.connections, 50)
+
+
+@skipIf(sys.version_info < (3, 7), "asyncio server tests need Python 3.7+")
+class TestAsyncNscaServer(TestCase):
+    def test_receives(self):
+        async def run():
+            server = fake_server.AsyncNscaServer(password=PASSWORD, crypt_id=3)
+            await server.start()
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+                iv, timestamp = struct.unpack(nsca._init_packet_format, await reader.readexactly(132))
+                crypter = nsca.DES3Crypter(iv, PASSWORD, os.urandom)
+                writer.write(crypter.encrypt(b''.join(
+                    nsca._pack_packet(b'host', b'service', 0, b'%d' % i, timestamp) for i in range(3))))
+                # a partial packet waits for the rest
+                writer.write(crypter.encrypt(nsca._pack_packet(b'host', b'service', 0, b'split', timestamp)[:100]))
+                await writer.drain()
+                deadline = time.time() + 2
+                while server.received < 3 and time.time() < deadline:
+                    await asyncio.sleep(0.01)
+                writer.close()
+            finally:
+                await server.stop()
+            return server
+        server = asyncio.run(run())
+        self.assertEqual([result.output for result in server.get_results()], [b'0', b'1', b'2'])
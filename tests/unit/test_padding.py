@@ -0,0 +1,73 @@
+import os
+import sys
+import threading
+
+from unittest2 import TestCase
+
+from send_nsca import nsca
+
+
+class TestPadding(TestCase):
+    def assertPadding(self, value, length):
+        self.assertEqual(len(value), length)
+        self.assertTrue(all(c in nsca._PADDING_ALPHABET for c in bytearray(value)), value)
+
+    def test_fresh(self):
+        padding = nsca.FreshPadding()
+        for length in (0, 1, 63, 511):
+            self.assertPadding(padding(length), length)
+
+    def test_pool_refills(self):
+        padding = nsca.PooledPadding(block_size=100)
+        first = padding(60)
+        self.assertPadding(first, 60)
+        # not enough left in the pool, so this comes from a new block
+        second = padding(60)
+        self.assertPadding(second, 60)
+        self.assertEqual(padding._offset, 60)
+        # requests bigger than a block are served directly
+        self.assertPadding(padding(500), 500)
+
+    def test_pool_shared_between_threads(self):
+        blocks = []
+
+        def random_generator(bytesz):
+            blocks.append(bytesz)
+            return os.urandom(bytesz)
+        padding = nsca.PooledPadding(block_size=100, random_generator=random_generator)
+        if hasattr(sys, 'setswitchinterval'):
+            self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+            sys.setswitchinterval(1e-6)
+
+        def use():
+            for _ in range(1000):
+                self.assertPadding(padding(10), 10)
+        threads = [threading.Thread(target=use) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # every block was used up exactly, with no slice handed out twice
+        self.assertEqual(len(blocks), 8 * 1000 * 10 // 100)
+        self.assertEqual(padding._offset, 100)
+
+    def test_pool_after_fork(self):
+        padding = nsca.PooledPadding(block_size=100)
+        padding(10)
+        # as if another thread held the lock when the process forked
+        padding._lock.acquire()
+        padding._after_fork()
+        self.assertEqual(padding._offset, 0)
+        self.assertPadding(padding(10), 10)
+
+    def test_sender_padding_modes(self):
+        self.assertEqual(
+            nsca.NscaSender('test', config_path=None, padding=nsca.PADDING_POOL).padding,
+            nsca.get_random_alphanumeric_bytes
+        )
+        self.assertTrue(isinstance(nsca.NscaSender('test', config_path=None, padding=nsca.PADDING_FRESH).padding, nsca.FreshPadding))
+        self.assertRaises(ValueError, nsca.NscaSender, 'test', config_path=None, padding='bogus')
+
+    def test_pack_packet_padding(self):
+        packet = nsca._pack_packet(b'host', b'service', 0, b'output', 0, padding=lambda n: b'-' * n)
+        self.assertTrue(packet[14:].startswith(b'host\0' + b'-' * (nsca.MAX_HOSTNAME_LENGTH - 5)))
@@ -0,0 +1,175 @@
+import os
+import socket
+import tempfile
+
+import mock
+from unittest2 import TestCase
+
+import send_nsca
+from send_nsca import nsca
+from send_nsca import pool
+
+
+class TestSenderPool(TestCase):
+    def setUp(self):
+        self.pool = pool.SenderPool(max_size=2, idle_timeout=60)
+        p = mock.patch.object(pool, 'NscaSender', side_effect=lambda **kwargs: mock.Mock(kwargs=kwargs))
+        self.mock_sender = p.start()
+        self.addCleanup(p.stop)
+
+    def send(self, remote_host='nsca', **kwargs):
+        kwargs.setdefault('config_path', None)
+        self.pool.send_service(remote_host, b'host', b'service', 0, b'ok', **kwargs)
+
+    def test_reuses_senders(self):
+        self.send()
+        self.send()
+        self.assertEqual(self.mock_sender.call_count, 1)
+        sender = self.pool._entries[list(self.pool._entries)[0]].sender
+        self.assertEqual(sender.send_service.call_count, 2)
+        sender.send_service.assert_called_with(b'host', b'service', 0, b'ok')
+        self.assertEqual(sender.kwargs, {'remote_host': 'nsca', 'config_path': None})
+
+    def test_keyed_by_options(self):
+        self.send()
+        self.send(port=1234)
+        self.send(timeout=3)
+        self.assertEqual(self.mock_sender.call_count, 3)
+
+    def test_max_size_evicts_least_recently_used(self):
+        self.send('one')
+        self.send('two')
+        first = self.pool._entries[list(self.pool._entries)[0]]
+        self.send('one')
+        self.send('three')
+        self.assertEqual(len(self.pool), 2)
+        self.assertEqual(sorted(key[0] for key in self.pool._entries), ['one', 'three'])
+        self.assertFalse(first.sender.disconnect.called)
+
+    def test_idle_timeout(self):
+        self.send()
+        entry = list(self.pool._entries.values())[0]
+        entry.last_used -= 120
+        self.send()
+        self.assertEqual(self.mock_sender.call_count, 2)
+        entry.sender.disconnect.assert_called_once_with()
+
+    def test_fork_safety(self):
+        self.send()
+        entry = list(self.pool._entries.values())[0]
+        # held by a thread that didn't make it across the fork
+        entry.lock.acquire()
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.send()
+        self.assertEqual(self.mock_sender.call_count, 2)
+        self.assertEqual(len(self.pool), 1)
+        # the child's copies of the sockets are closed, rather than leaked
+        entry.sender.disconnect.assert_called_once_with()
+        self.assertEqual(entry.sender.send_service.call_count, 1)
+
+    def test_sender_is_made_outside_the_lock(self):
+        locked = []
+
+        def make_sender(**kwargs):
+            locked.append(self.pool._lock.locked())
+            return mock.Mock(kwargs=kwargs)
+        self.mock_sender.side_effect = make_sender
+        self.send()
+        self.assertEqual(locked, [False])
+
+    def test_sender_made_meanwhile_by_another_thread(self):
+        made = []
+
+        def make_sender(**kwargs):
+            sender = mock.Mock(kwargs=kwargs)
+            made.append(sender)
+            if len(made) == 1:
+                # another thread checks out the same sender while we make ours
+                self.send()
+            return sender
+        self.mock_sender.side_effect = make_sender
+        self.send()
+        self.assertEqual(len(made), 2)
+        self.assertEqual(len(self.pool), 1)
+        kept = list(self.pool._entries.values())[0].sender
+        self.assertIs(kept, made[1])
+        self.assertEqual(kept.send_service.call_count, 2)
+        made[0].disconnect.assert_called_once_with()
+        self.assertFalse(made[0].send_service.called)
+
+    def test_config_change_makes_new_sender(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self.send(config_path=f.name)
+            self.send(config_path=f.name)
+            f.write(b'password = changed\n')
+            f.flush()
+            self.send(config_path=f.name)
+        self.assertEqual(self.mock_sender.call_count, 2)
+
+    def test_retries_once_on_connection_error(self):
+        self.mock_sender.side_effect = [
+            mock.Mock(**{'send_service.side_effect': socket.error}),
+            mock.Mock(),
+        ]
+        self.send()
+        self.assertEqual(self.mock_sender.call_count, 2)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_gives_up_after_retry(self):
+        self.mock_sender.side_effect = lambda **kwargs: mock.Mock(**{'send_service.side_effect': socket.error})
+        self.assertRaises(socket.error, self.send)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_partial_failure_is_not_retried(self):
+        self.mock_sender.side_effect = lambda **kwargs: mock.Mock(**{
+            'send_service.side_effect': nsca.PartialSendError('one server is down', ['10.0.0.2'])})
+        self.assertRaises(nsca.PartialSendError, self.send)
+        self.assertEqual(self.mock_sender.call_count, 1)
+        # kept, so the next send reuses it (and it reconnects to the server that's down)
+        self.assertEqual(len(self.pool), 1)
+        sender = list(self.pool._entries.values())[0].sender
+        self.assertEqual(sender.send_service.call_count, 1)
+        self.assertFalse(sender.disconnect.called)
+
+    def test_dict_and_list_options(self):
+        self.send(rate_limit={'10.0.0.1': 10, None: 100})
+        self.send(rate_limit={None: 100, '10.0.0.1': 10})
+        self.send(rate_limit={'10.0.0.1': 20, None: 100})
+        self.send(extra=[1, {'a': [2]}])
+        self.assertEqual(self.mock_sender.call_count, 3)
+        self.send(extra=[1, {'a': [2]}])
+        self.assertEqual(self.mock_sender.call_count, 3)
+
+    def test_unhashable_options_use_an_unpooled_sender(self):
+        class Unhashable(object):
+            __hash__ = None
+        senders = []
+        self.mock_sender.side_effect = lambda **kwargs: senders.append(mock.Mock()) or senders[-1]
+        self.send(stats=Unhashable())
+        self.assertEqual(len(senders), 1)
+        self.assertEqual(len(self.pool), 0)
+        senders[0].send_service.assert_called_once_with(b'host', b'service', 0, b'ok')
+        senders[0].disconnect.assert_called_once_with()
+
+    def test_config_version_uses_nanoseconds(self):
+        if not hasattr(os.stat_result, 'st_mtime_ns'):
+            self.skipTest("no nanosecond mtimes")
+        with tempfile.NamedTemporaryFile() as f:
+            key = self.pool._key('nsca', {'config_path': f.name})
+            os.utime(f.name, ns=(0, os.stat(f.name).st_mtime_ns + 1000))
+            self.assertNotEqual(self.pool._key('nsca', {'config_path': f.name}), key)
+
+
+class TestConvenienceFunctionPooling(TestCase):
+    def test_uses_default_pool(self):
+        with mock.patch.object(pool.default_pool, 'send_service') as mock_send:
+            send_nsca.nsca_ok(b'host', b'service', b'ok', remote_host='nsca', port=1234)
+        mock_send.assert_called_once_with('nsca', b'host', b'service', 0, b'ok', port=1234)
+
+    def test_opt_out(self):
+        with mock.patch.object(pool.default_pool, 'send_service') as mock_send:
+            with mock.patch.object(send_nsca, 'NscaSender') as mock_sender:
+                send_nsca.nsca_ok(b'host', b'service', b'ok', remote_host='nsca', pooled=False, config_path=None)
+        self.assertFalse(mock_send.called)
+        mock_sender.assert_called_once_with(remote_host='nsca', config_path=None)
+        mock_sender.return_value.disconnect.assert_called_once_with()
@@ -0,0 +1,111 @@
+import socket
+import threading
+
+import mock
+from unittest2 import TestCase
+
+from send_nsca import nsca
+from send_nsca import queued
+
+
+class TestQueuedNscaSender(TestCase):
+    def setUp(self):
+        self.sender = nsca.NscaSender(remote_host='test', config_path=None)
+        self.batches = []
+        # lets tests hold up the background thread
+        self.sending = threading.Event()
+        self.sending.set()
+        # set once the background thread has taken a batch off the queue
+        self.taken = threading.Event()
+
+        def send_many(batch):
+            self.taken.set()
+            self.sending.wait(5)
+            self.batches.append(list(batch))
+            return []
+        p = mock.patch.object(self.sender, 'send_many', side_effect=send_many)
+        p.start()
+        self.addCleanup(p.stop)
+        self.addCleanup(self.sending.set)
+
+    def results(self, n, offset=0):
+        return [(b'host', b'service', 0, b'output %d' % i) for i in range(offset, offset + n)]
+
+    def test_sends_in_batches(self):
+        q = queued.QueuedNscaSender(self.sender, batch_size=10)
+        self.sending.clear()
+        for result in self.results(25):
+            self.assertTrue(q.send_service(*result))
+        self.sending.set()
+        self.assertTrue(q.close())
+        self.assertEqual(sum(self.batches, []), self.results(25))
+        self.assertTrue(all(len(batch) <= 10 for batch in self.batches))
+        self.assertEqual(q.counters(), {'queued': 25, 'sent': 25, 'dropped': 0, 'failed': 0, 'pending': 0})
+
+    def test_validates_immediately(self):
+        q = queued.QueuedNscaSender(self.sender)
+        self.assertRaises(ValueError, q.send_service, b'host', b'service', 7, b'bad')
+        self.assertEqual(q.queued, 0)
+        q.close()
+
+    def fill(self, q, n):
+        """Queue n results while the background thread is stuck on the first"""
+        self.sending.clear()
+        self.taken.clear()
+        q.send_host(b'in flight', 0, b'')
+        self.assertTrue(self.taken.wait(5), "the background thread never took the first result")
+        return [q.send_service(*result) for result in self.results(n)]
+
+    def test_drop_oldest(self):
+        q = queued.QueuedNscaSender(self.sender, max_queue_size=3, full_policy=queued.DROP_OLDEST)
+        self.assertEqual(self.fill(q, 5), [True] * 5)
+        self.sending.set()
+        q.close()
+        self.assertEqual(sum(self.batches, [])[1:], self.results(3, offset=2))
+        self.assertEqual(q.dropped, 2)
+
+    def test_drop_newest(self):
+        q = queued.QueuedNscaSender(self.sender, max_queue_size=3, full_policy=queued.DROP_NEWEST)
+        self.assertEqual(self.fill(q, 5), [True] * 3 + [False] * 2)
+        self.sending.set()
+        q.close()
+        self.assertEqual(sum(self.batches, [])[1:], self.results(3))
+        self.assertEqual(q.dropped, 2)
+
+    def test_block(self):
+        q = queued.QueuedNscaSender(self.sender, max_queue_size=3, batch_size=1, full_policy=queued.BLOCK)
+        self.fill(q, 3)
+        blocked = threading.Thread(target=q.send_host, args=(b'blocked', 0, b''))
+        blocked.start()
+        blocked.join(0.1)
+        self.assertTrue(blocked.is_alive())
+        self.sending.set()
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+        q.close()
+        self.assertEqual(q.sent, 5)
+        self.assertEqual(q.dropped, 0)
+
+    def test_flush_timeout_and_close_drops_leftovers(self):
+        q = queued.QueuedNscaSender(self.sender, batch_size=1)
+        self.fill(q, 2)
+        self.assertFalse(q.flush(timeout=0.05))
+        closer = threading.Thread(target=q.close, kwargs={'timeout': 0.05})
+        closer.start()
+        closer.join(0.2)
+        self.sending.set()
+        closer.join(5)
+        self.assertEqual(q.counters()['pending'], 0)
+        self.assertEqual(q.sent + q.dropped, 3)
+        self.assertRaises(ValueError, q.send_host, b'host', 0, b'too late')
+
+    def test_counts_failures(self):
+        self.sender.send_many.side_effect = socket.error('nope')
+        q = queued.QueuedNscaSender(self.sender)
+        q.send_host(b'host', 0, b'')
+        q.close()
+        self.assertEqual(q.failed, 1)
+        self.assertEqual(q.sent, 0)
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, queued.QueuedNscaSender, self.sender, full_policy='bogus')
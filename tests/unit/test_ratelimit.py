@@ -0,0 +1,118 @@
+import socket
+import time
+
+import mock
+from unittest2 import TestCase
+
+from send_nsca import nsca
+from send_nsca import ratelimit
+from send_nsca import stats
+
+
+class TestTokenBucket(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        p = mock.patch('time.time', side_effect=lambda: self.now)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_paces_after_burst(self):
+        bucket = ratelimit.TokenBucket(100, burst=10)
+        self.assertEqual(bucket.reserve(10), 0)
+        self.assertAlmostEqual(bucket.reserve(1), 0.01)
+        # a batch bigger than the burst just waits longer
+        self.assertAlmostEqual(bucket.reserve(50), 0.51)
+        self.now += 0.51
+        self.assertAlmostEqual(bucket.reserve(0), 0)
+        # quiet spells only earn back the burst
+        self.now += 60
+        self.assertEqual(bucket.reserve(10), 0)
+        self.assertGreater(bucket.reserve(1), 0)
+
+    def test_wait_sleeps(self):
+        bucket = ratelimit.TokenBucket(10, burst=1)
+        with mock.patch('time.sleep') as mock_sleep:
+            self.assertEqual(bucket.wait(), 0)
+            bucket.wait()
+        mock_sleep.assert_called_once_with(0.1)
+
+    def test_adaptive_backoff_and_recovery(self):
+        bucket = ratelimit.TokenBucket(100, adaptive=True, slow_send=0.1, recovery_time=10)
+        bucket.sent(0.5)
+        self.assertEqual(bucket.rate, 50)
+        # the same blocked burst doesn't count twice
+        bucket.sent(0.5)
+        self.assertEqual(bucket.rate, 50)
+        for _ in range(5):
+            self.now += 1
+            bucket.sent(0.5)
+        self.assertEqual(bucket.rate, 10)
+        self.assertEqual(bucket.backoffs, 4)
+        self.now += 5
+        bucket.sent(0.001)
+        self.assertEqual(bucket.rate, 55)
+        self.now += 60
+        bucket.sent(0.001)
+        self.assertEqual(bucket.rate, 100)
+
+    def test_not_adaptive(self):
+        bucket = ratelimit.TokenBucket(100)
+        bucket.sent(5)
+        self.assertEqual(bucket.rate, 100)
+
+
+class TestSenderRateLimit(TestCase):
+    def add_conn(self, sender, address):
+        conn = mock.Mock()
+        sender._conns.append((conn, b'\0' * nsca._TRANSMITTED_IV_SIZE, 1234))
+        sender._handshake_times[conn] = time.time()
+        sender._conn_addrs[conn] = (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, (address, 5667))
+        return conn
+
+    def make_sender(self, **kwargs):
+        sender = nsca.NscaSender(remote_host='test', config_path=None, **kwargs)
+        sender.connect = mock.Mock()
+        sender.Crypter = nsca.NullCrypter
+        return sender
+
+    def test_each_server_paced_separately(self):
+        sender = self.make_sender(rate_limit={'10.0.0.1': 10, None: 1000}, rate_burst=5, stats=stats.InMemoryStats())
+        slow = self.add_conn(sender, '10.0.0.1')
+        fast = self.add_conn(sender, '10.0.0.2')
+        with mock.patch('time.sleep') as mock_sleep:
+            sender.send_many([(b'host', b'', 0, b'')] * 20)
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertAlmostEqual(mock_sleep.call_args_list[0][0][0], 1.5, places=2)
+        self.assertAlmostEqual(mock_sleep.call_args_list[1][0][0], 0.015, places=2)
+        self.assertEqual(sender.stats.summary()['timings'][stats.THROTTLE]['count'], 2)
+        self.assertEqual(sorted(sender._rate_limiters), ['10.0.0.1', '10.0.0.2'])
+        self.assertTrue(slow.sendall.called and fast.sendall.called)
+
+    def test_unlisted_server_unlimited(self):
+        sender = self.make_sender(rate_limit={'10.0.0.1': 10})
+        self.add_conn(sender, '10.0.0.2')
+        with mock.patch('time.sleep') as mock_sleep:
+            sender.send_many([(b'host', b'', 0, b'')] * 20)
+        self.assertFalse(mock_sleep.called)
+
+    def test_limiter_survives_reconnect(self):
+        sender = self.make_sender(rate_limit=10)
+        conn = self.add_conn(sender, '10.0.0.1')
+        limiter = sender._rate_limiter(conn)
+        new_conn = mock.Mock()
+        sender._conn_addrs[new_conn] = sender._conn_addrs[conn]
+        self.assertIs(sender._rate_limiter(new_conn), limiter)
+
+    def test_adaptive_backoff_reported(self):
+        sender = self.make_sender(rate_limit=100, adaptive_rate=True, stats=stats.InMemoryStats())
+        conn = self.add_conn(sender, '10.0.0.1')
+        clock = [1000.0]
+        sender._handshake_times[conn] = clock[0]
+
+        def blocked_sendall(payload):
+            clock[0] += 0.5
+        conn.sendall.side_effect = blocked_sendall
+        with mock.patch('time.time', side_effect=lambda: clock[0]):
+            sender.send_host(b'host', 0, b'')
+        self.assertEqual(sender._rate_limiter(conn).rate, 50)
+        self.assertEqual(sender.stats.counters[stats.RATE_BACKOFFS], 1)
@@ -0,0 +1,126 @@
+import os
+import socket
+import time
+
+import mock
+import six
+from unittest2 import TestCase
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from send_nsca import nsca
+
+
+class TestReconnect(TestCase):
+    addrinfo = (socket.AF_INET, socket.SOCK_STREAM, socket.SOL_TCP, ('10.0.0.1', nsca.DEFAULT_PORT))
+
+    def setUp(self):
+        self.sender = nsca.NscaSender(remote_host='test', config_path=None, reconnect_backoff=1, max_reconnect_backoff=3)
+        self.sender.Crypter = nsca.NullCrypter
+        self.sender._connected = True
+        p = mock.patch.object(self.sender, '_wait_readable', side_effect=lambda conns, deadline: list(conns))
+        p.start()
+        self.addCleanup(p.stop)
+        self.broken_conn = self.add_conn(mock.Mock(**{'sendall.side_effect': socket.error('broken pipe')}))
+
+    def add_conn(self, conn):
+        self.sender._conns.append((conn, b'iv', 1000))
+        self.sender._handshake_times[conn] = self.sender._last_used[conn] = time.time()
+        self.sender._conn_addrs[conn] = self.addrinfo
+        self.sender._cached_crypters[conn] = nsca.NullCrypter(b'iv', b'', None)
+        return conn
+
+    def test_reconnects_and_retries(self):
+        new_conn = mock.Mock()
+        with mock.patch.object(self.sender, '_connect_addrinfo', return_value=new_conn) as mock_connect:
+            with mock.patch.object(self.sender, '_read_init_packet', return_value=(b'new iv', 2000)):
+                self.sender.send_service(b'host', b'service', 0, b'ok')
+        mock_connect.assert_called_once_with(self.addrinfo, self.sender.timeout, deadline=mock.ANY)
+        self.assertEqual(new_conn.sendall.call_count, 1)
+        self.assertEqual(self.sender._conns, [(new_conn, b'new iv', 2000)])
+        # the stale socket's state has been thrown away
+        self.broken_conn.close.assert_called_once_with()
+        self.assertNotIn(self.broken_conn, self.sender._cached_crypters)
+        self.assertNotIn(self.broken_conn, self.sender._handshake_times)
+
+    def test_other_connections_still_sent_to(self):
+        good_conn = self.add_conn(mock.Mock())
+        with mock.patch.object(self.sender, '_connect_addrinfo', side_effect=socket.error('refused')):
+            self.assertRaises(socket.error, self.sender.send_service, b'host', b'service', 0, b'ok')
+        self.assertEqual(good_conn.sendall.call_count, 1)
+
+    def test_backoff(self):
+        with mock.patch.object(self.sender, '_connect_addrinfo', side_effect=socket.error('refused')) as mock_connect:
+            self.assertRaises(socket.error, self.sender.send_service, b'host', b'service', 0, b'ok')
+            self.assertEqual(mock_connect.call_count, 1)
+            self.assertEqual(self.sender._reconnect_delays[0], 2)
+            # still backing off, so don't even try
+            self.assertRaises(socket.error, self.sender.send_service, b'host', b'service', 0, b'ok')
+            self.assertEqual(mock_connect.call_count, 1)
+            for expected_delay in (4, 3, 3):
+                self.sender._next_reconnect_times[0] = 0
+                self.assertRaises(socket.error, self.sender.send_service, b'host', b'service', 0, b'ok')
+                self.assertEqual(self.sender._reconnect_delays[0], min(expected_delay, 3))
+        new_conn = mock.Mock()
+        self.sender._next_reconnect_times[0] = 0
+        with mock.patch.object(self.sender, '_connect_addrinfo', return_value=new_conn):
+            with mock.patch.object(self.sender, '_read_init_packet', return_value=(b'new iv', 2000)):
+                self.sender.send_service(b'host', b'service', 0, b'ok')
+        self.assertNotIn(0, self.sender._reconnect_delays)
+
+    def test_backoff_is_per_connection(self):
+        self.add_conn(mock.Mock(**{'sendall.side_effect': socket.error('broken pipe')}))
+        with mock.patch.object(self.sender, '_connect_addrinfo', side_effect=socket.error('refused')):
+            self.assertRaises(socket.error, self.sender.send_service, b'host', b'service', 0, b'ok')
+        self.assertEqual(self.sender._reconnect_delays, {0: 2, 1: 2})
+        # the first server is due a retry before the second; the second's backoff doesn't hold it back
+        self.sender._next_reconnect_times[0] = 0
+        new_conn = mock.Mock()
+        with mock.patch.object(self.sender, '_connect_addrinfo', side_effect=[new_conn]) as mock_connect:
+            with mock.patch.object(self.sender, '_read_init_packet', return_value=(b'new iv', 2000)):
+                self.assertRaises(socket.error, self.sender.send_service, b'host', b'service', 0, b'ok')
+        self.assertEqual(mock_connect.call_count, 1)
+        self.assertEqual(new_conn.sendall.call_count, 1)
+        self.assertEqual(self.sender._reconnect_delays, {1: 2})
+
+    def test_no_reconnect(self):
+        self.sender.reconnect = False
+        with mock.patch.object(self.sender, '_reconnect') as mock_reconnect:
+            self.assertRaises(socket.error, self.sender.send_service, b'host', b'service', 0, b'ok')
+        self.assertFalse(mock_reconnect.called)
+
+
+class TestPeerClosed(TestCase):
+    def setUp(self):
+        self.sender = nsca.NscaSender(remote_host='test', config_path=None)
+        self.ours, self.theirs = socket.socketpair()
+        self.addCleanup(self.ours.close)
+        self.sender._last_used[self.ours] = time.time() - 60
+
+    def test_open(self):
+        self.assertFalse(self.sender._peer_closed(self.ours))
+        self.theirs.close()
+
+    def test_closed(self):
+        self.theirs.close()
+        self.assertTrue(self.sender._peer_closed(self.ours))
+
+    def test_high_file_descriptor(self):
+        if six.PY2 or resource is None or resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 2100:
+            self.skipTest("can't open file descriptors above 2048 here")
+        os.dup2(self.ours.fileno(), 2050)
+        high = socket.socket(self.ours.family, self.ours.type, fileno=2050)
+        self.addCleanup(high.close)
+        self.sender._last_used[high] = time.time() - 60
+        # select() can't check this one, which mustn't make it look closed
+        self.assertFalse(self.sender._peer_closed(high))
+        self.theirs.close()
+        self.assertTrue(self.sender._peer_closed(high))
+
+    def test_recently_used_not_checked(self):
+        self.theirs.close()
+        self.sender._last_used[self.ours] = time.time()
+        self.assertFalse(self.sender._peer_closed(self.ours))
@@ -0,0 +1,84 @@
+import socket
+
+import mock
+from unittest2 import TestCase
+
+from send_nsca import nsca
+from send_nsca import resolver
+
+
+class TestResolverCache(TestCase):
+    addrinfo = (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', ('10.0.0.1', 5667))
+
+    def setUp(self):
+        self.cache = resolver.ResolverCache(ttl=60, negative_ttl=5, max_stale=600)
+        self.now = 1000.0
+        p = mock.patch('time.time', side_effect=lambda: self.now)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def lookup(self, host='nsca.example.com'):
+        return self.cache.getaddrinfo(host, 5667, socket.AF_UNSPEC, socket.SOCK_STREAM)
+
+    def test_caches_for_ttl(self):
+        with mock.patch('socket.getaddrinfo', return_value=[self.addrinfo]) as mock_getaddrinfo:
+            self.assertEqual(self.lookup(), [self.addrinfo])
+            self.now += 59
+            self.assertEqual(self.lookup(), [self.addrinfo])
+            self.assertEqual(mock_getaddrinfo.call_count, 1)
+            self.now += 2
+            self.lookup()
+            self.assertEqual(mock_getaddrinfo.call_count, 2)
+            self.lookup('other.example.com')
+            self.assertEqual(mock_getaddrinfo.call_count, 3)
+
+    def test_negative_caching(self):
+        with mock.patch('socket.getaddrinfo', side_effect=socket.gaierror('no such host')) as mock_getaddrinfo:
+            self.assertRaises(socket.gaierror, self.lookup)
+            self.assertRaises(socket.gaierror, self.lookup)
+            self.assertEqual(mock_getaddrinfo.call_count, 1)
+            self.now += 6
+            self.assertRaises(socket.gaierror, self.lookup)
+            self.assertEqual(mock_getaddrinfo.call_count, 2)
+
+    def test_serves_stale_while_resolver_fails(self):
+        with mock.patch('socket.getaddrinfo', return_value=[self.addrinfo]):
+            self.lookup()
+        self.now += 120
+        with mock.patch('socket.getaddrinfo', side_effect=socket.gaierror('resolver down')) as mock_getaddrinfo:
+            self.assertEqual(self.lookup(), [self.addrinfo])
+            # and doesn't ask again until negative_ttl is up
+            self.assertEqual(self.lookup(), [self.addrinfo])
+            self.assertEqual(mock_getaddrinfo.call_count, 1)
+            self.now += 600
+            self.assertRaises(socket.gaierror, self.lookup)
+
+    def test_clear(self):
+        with mock.patch('socket.getaddrinfo', return_value=[self.addrinfo]) as mock_getaddrinfo:
+            self.lookup()
+            self.lookup('other.example.com')
+            self.cache.clear('nsca.example.com')
+            self.lookup()
+            self.lookup('other.example.com')
+            self.assertEqual(mock_getaddrinfo.call_count, 3)
+            self.cache.clear()
+            self.lookup('other.example.com')
+            self.assertEqual(mock_getaddrinfo.call_count, 4)
+
+
+class TestSenderDnsCache(TestCase):
+    def setUp(self):
+        resolver.default_cache.clear()
+
+    def test_shared_by_default(self):
+        self.assertIs(nsca.NscaSender('test', config_path=None).dns_cache, resolver.default_cache)
+        own = resolver.ResolverCache()
+        self.assertIs(nsca.NscaSender('test', config_path=None, dns_cache=own).dns_cache, own)
+
+    def test_connects_use_cache(self):
+        for dns_cache, expected_lookups in ((resolver.ResolverCache(), 1), (None, 2)):
+            sender = nsca.NscaSender('test', config_path=None, dns_cache=dns_cache)
+            with mock.patch('socket.getaddrinfo', return_value=[]) as mock_getaddrinfo:
+                for _ in range(2):
+                    self.assertRaises(socket.error, sender._sock_connect, 'test', 5667)
+            self.assertEqual(mock_getaddrinfo.call_count, expected_lookups)
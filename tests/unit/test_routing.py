@@ -0,0 +1,217 @@
+import socket
+
+import mock
+from unittest2 import TestCase
+
+from send_nsca import coalesce
+from send_nsca import fake_server
+from send_nsca import nsca
+from send_nsca import resolver
+from send_nsca import routing
+
+
+class TestParseEndpoint(TestCase):
+    def test_forms(self):
+        self.assertEqual(routing.parse_endpoint('nsca1'), ('nsca1', 5667))
+        self.assertEqual(routing.parse_endpoint('nsca1:5668'), ('nsca1', 5668))
+        self.assertEqual(routing.parse_endpoint('[::1]:5668'), ('::1', 5668))
+        self.assertEqual(routing.parse_endpoint('::1', 1234), ('::1', 1234))
+        self.assertEqual(routing.parse_endpoint(('nsca1', 1)), ('nsca1', 1))
+
+
+class RoutingTestCase(TestCase):
+    def make_router(self, strategy, count=3, **kwargs):
+        router = routing.RoutingNscaSender(['nsca%d:%d' % (i, 5667 + i) for i in range(count)], strategy=strategy,
+                                           config_path=None, **kwargs)
+        self.batches = dict((endpoint, []) for endpoint in router.endpoints)
+        for endpoint in router.endpoints:
+            endpoint.sender.send_many = mock.Mock(side_effect=self.sender_for(endpoint))
+        return router
+
+    def sender_for(self, endpoint):
+        def send_many(batch, chunk_size=1000):
+            self.batches[endpoint].append(batch)
+        return send_many
+
+    def results(self, n):
+        return [(b'host%d' % i, b'service', 0, b'output') for i in range(n)]
+
+    def sent_to(self, endpoint):
+        return sum(self.batches[endpoint], [])
+
+
+class TestStrategies(RoutingTestCase):
+    def test_hash_keeps_hosts_together(self):
+        router = self.make_router(routing.HASH)
+        results = self.results(300) * 2
+        self.assertEqual(router.send_many(results), [])
+        for endpoint in router.endpoints:
+            # one send_many per endpoint, with a fair share of the hosts
+            self.assertEqual(len(self.batches[endpoint]), 1)
+            self.assertGreater(len(self.sent_to(endpoint)), 100)
+            for host, _, _, _ in self.sent_to(endpoint):
+                self.assertIs(router.route(host), endpoint)
+
+    def test_hash_is_consistent(self):
+        before = self.make_router(routing.HASH, count=4)
+        after = self.make_router(routing.HASH, count=5)
+        hosts = [b'host%d' % i for i in range(1000)]
+        moved = [host for host in hosts if before.route(host).port != after.route(host).port]
+        # only the new endpoint's share moves (about a fifth)
+        self.assertLess(len(moved), 300)
+        self.assertTrue(all(after.route(host).port == 5671 for host in moved))
+
+    def test_round_robin(self):
+        router = self.make_router(routing.ROUND_ROBIN)
+        router.send_many(self.results(9))
+        self.assertEqual([len(self.sent_to(endpoint)) for endpoint in router.endpoints], [3, 3, 3])
+        router.send_host(b'host', 0, b'')
+        router.send_host(b'host', 0, b'')
+        self.assertEqual([len(self.sent_to(endpoint)) for endpoint in router.endpoints], [4, 4, 3])
+
+    def test_least_loaded(self):
+        router = self.make_router(routing.LEAST_LOADED)
+        router.endpoints[0].in_flight = 5
+        router.endpoints[1].send_time = 0.01
+        router.endpoints[2].send_time = 0.001
+        router.send_many(self.results(10))
+        self.assertEqual(len(self.sent_to(router.endpoints[2])), 10)
+        self.assertEqual(len(self.batches[router.endpoints[2]]), 1)
+
+    def test_validation_errors(self):
+        router = self.make_router(routing.HASH)
+        errors = router.send_many([(b'host', b'service', 9, b'bad'), (b'host', None, 0, b'ok')])
+        self.assertEqual([index for index, _, _ in errors], [0])
+        self.assertEqual(sum((self.sent_to(e) for e in router.endpoints), []), [(b'host', b'', 0, b'ok')])
+        self.assertRaises(ValueError, router.send_service, b'host', b'service', 9, b'bad')
+
+
+class TestFailover(RoutingTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        p = mock.patch('time.time', side_effect=lambda: self.now)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def break_endpoint(self, endpoint):
+        endpoint.sender.send_many.side_effect = socket.error('connection refused')
+
+    def test_fails_over_and_retries_later(self):
+        router = self.make_router(routing.HASH, retry_interval=10)
+        down = router.route(b'host1')
+        self.break_endpoint(down)
+        results = self.results(30)
+        router.send_many(results)
+        self.assertFalse(down.healthy)
+        delivered = sum((self.sent_to(e) for e in router.endpoints if e is not down), [])
+        self.assertEqual(sorted(delivered), sorted(results))
+        # each host fails over to the next endpoint on the ring, and stays there
+        moved_to = router.route(b'host1')
+        self.assertIsNot(moved_to, down)
+        router.send_host(b'host1', 0, b'')
+        self.assertEqual(self.sent_to(moved_to)[-1], (b'host1', b'', 0, b''))
+        self.assertEqual(down.sender.send_many.call_count, 1)
+        # once it's due, the endpoint gets traffic again, and is back up if that works
+        self.now += 11
+        self.assertIs(router.route(b'host1'), down)
+        down.sender.send_many.side_effect = self.sender_for(down)
+        router.send_host(b'host1', 0, b'')
+        self.assertTrue(down.healthy)
+        self.assertEqual(self.sent_to(down), [(b'host1', b'', 0, b'')])
+
+    def partly_send(self, endpoint, count, error):
+        def send_many(batch, chunk_size=1000):
+            self.batches[endpoint].append(batch[:count])
+            error.sent = count
+            raise error
+        endpoint.sender.send_many.side_effect = send_many
+
+    def test_only_reroutes_what_wasnt_sent(self):
+        router = self.make_router(routing.LEAST_LOADED, count=2)
+        first, second = router.endpoints
+        self.partly_send(first, 4, socket.error('connection reset'))
+        results = self.results(10)
+        router.send_many(results, chunk_size=4)
+        self.assertEqual(self.sent_to(first), results[:4])
+        self.assertEqual(self.sent_to(second), results[4:])
+        self.assertEqual((first.sent, first.failed), (4, 6))
+
+    def test_partial_send_error_is_kept(self):
+        router = self.make_router(routing.LEAST_LOADED, count=2)
+        first, second = router.endpoints
+        # the second chunk reached one of the first endpoint's servers
+        self.partly_send(first, 4, nsca.PartialSendError('connection reset', ['10.0.0.2']))
+        results = self.results(10)
+        with self.assertRaises(nsca.PartialSendError) as cm:
+            router.send_many(results, chunk_size=4)
+        self.assertEqual(cm.exception.missed, ['10.0.0.2'])
+        self.assertEqual(self.sent_to(second), results[8:])
+
+    def test_all_down(self):
+        router = self.make_router(routing.ROUND_ROBIN, count=2)
+        for endpoint in router.endpoints:
+            self.break_endpoint(endpoint)
+        self.assertRaises(socket.error, router.send_many, self.results(4))
+        self.assertEqual([e.healthy for e in router.endpoints], [False, False])
+        self.assertEqual(sum(e.failed for e in router.endpoints), 4)
+        # still tried, soonest-due first, rather than refusing outright
+        self.assertRaises(socket.error, router.send_host, b'host', 0, b'')
+        self.assertEqual(sum(e.failed for e in router.endpoints), 6)
+
+    def test_max_failures(self):
+        router = self.make_router(routing.ROUND_ROBIN, count=2, max_failures=2)
+        self.break_endpoint(router.endpoints[0])
+        router.send_host(b'host', 0, b'')
+        self.assertTrue(router.endpoints[0].healthy)
+        router.send_host(b'host', 0, b'')
+        router.send_host(b'host', 0, b'')
+        self.assertFalse(router.endpoints[0].healthy)
+        self.assertEqual(len(self.sent_to(router.endpoints[1])), 3)
+
+    def test_check_health(self):
+        router = self.make_router(routing.HASH, count=2, retry_interval=10)
+        endpoint = router.endpoints[0]
+        self.break_endpoint(endpoint)
+        router.send_many(self.results(20))
+        with mock.patch.object(endpoint.sender, 'connect', side_effect=socket.error('refused')) as mock_connect:
+            self.assertEqual(router.check_health(), 1)
+            self.assertFalse(mock_connect.called)
+            self.now += 11
+            self.assertEqual(router.check_health(), 1)
+            self.assertEqual(mock_connect.call_count, 1)
+        self.now += 11
+        with mock.patch.object(endpoint.sender, 'connect'):
+            self.assertEqual(router.check_health(), 2)
+        self.assertEqual(router.status()[0]['healthy'], True)
+
+
+class TestRoutingEndToEnd(TestCase):
+    def test_spreads_across_receivers(self):
+        resolver.default_cache.clear()
+        servers = []
+        for _ in range(3):
+            server = fake_server.ThreadedNscaServer(password=b'TestingPassword', crypt_id=1).start()
+            self.addCleanup(server.stop)
+            servers.append(server)
+        router = routing.RoutingNscaSender([('127.0.0.1', server.port) for server in servers], config_path=None)
+        self.addCleanup(router.disconnect)
+        for endpoint in router.endpoints:
+            endpoint.sender.Crypter = nsca.XORCrypter
+            endpoint.sender.password = b'TestingPassword'
+        results = [(b'host%d' % i, b'service', 0, b'output') for i in range(60)]
+        self.assertEqual(router.send_many(results), [])
+        for server, endpoint in zip(servers, router.endpoints):
+            self.assertTrue(server.wait_for(endpoint.sent))
+        received = sum((server.get_results() for server in servers), [])
+        self.assertEqual(sorted(r[:4] for r in received), sorted(results))
+        self.assertTrue(all(server.received for server in servers))
+
+    def test_behind_coalescing_sender(self):
+        router = routing.RoutingNscaSender(['nsca1', 'nsca2'], config_path=None)
+        for endpoint in router.endpoints:
+            endpoint.sender.send_many = mock.Mock(return_value=[])
+        c = coalesce.CoalescingSender(router, window=3600)
+        c.send_host(b'host', 0, b'')
+        c.send_host(b'host', 1, b'')
+        self.assertEqual(c.flush(), 1)
+        c.close()
@@ -0,0 +1,94 @@
+import os
+import socket
+import time
+
+import mock
+from unittest2 import TestCase
+
+from send_nsca import nsca
+
+
+class TestSendMany(TestCase):
+    def setUp(self):
+        self.sender = nsca.NscaSender(remote_host='test', config_path=None)
+        self.sender.Crypter = nsca.XORCrypter
+        self.sender.password = b'TestingPassword'
+        self.iv = os.urandom(nsca._TRANSMITTED_IV_SIZE)
+        self.conn = mock.Mock()
+        self.sender._conns = [(self.conn, self.iv, 1234)]
+        self.sender._handshake_times = {self.conn: time.time()}
+        p = mock.patch.object(self.sender, 'connect')
+        p.start()
+        self.addCleanup(p.stop)
+
+    def decode(self, data, iv=None):
+        """XOR is its own inverse; return the (host, service, state, output) of each packet"""
+        crypter = nsca.XORCrypter(iv or self.iv, self.sender.password, os.urandom)
+        data = crypter.encrypt_packets(data)
+        size = nsca._data_packet_size
+        results = []
+        for offset in range(0, len(data), size):
+            version, crc, timestamp, state, host, service, output = nsca.struct.unpack(
+                nsca._data_packet_format, data[offset:offset + size]
+            )
+            self.assertEqual(version, nsca.PACKET_VERSION)
+            self.assertEqual(timestamp, 1234)
+            results.append((host.split(b'\0')[0], service.split(b'\0')[0], state, output.split(b'\0')[0]))
+        return results
+
+    def test_single_sendall(self):
+        results = [(b'host%d' % i, b'service', i % 4, b'output') for i in range(10)]
+        errors = self.sender.send_many(results)
+        self.assertEqual(errors, [])
+        self.assertEqual(self.conn.sendall.call_count, 1)
+        self.assertEqual(self.decode(self.conn.sendall.call_args[0][0]), results)
+
+    def test_sends_memoryview_of_packed_buffer(self):
+        self.sender.send_many([(b'host', b'service', 0, b'output')])
+        self.sender.send_service(b'host', b'service', 1, b'output')
+        for args, _ in self.conn.sendall.call_args_list:
+            self.assertIsInstance(args[0], memoryview)
+        self.assertIs(self.conn.sendall.call_args[0][0].obj, self.sender._packet_builder.buffer)
+        self.assertEqual(self.decode(self.conn.sendall.call_args[0][0]), [(b'host', b'service', 1, b'output')])
+
+    def test_multiple_connections(self):
+        other_iv = os.urandom(nsca._TRANSMITTED_IV_SIZE)
+        other = mock.Mock()
+        self.sender._conns.append((other, other_iv, 1234))
+        self.sender._handshake_times[other] = time.time()
+        results = [(b'host%d' % i, b'service', 0, b'output') for i in range(3)]
+        self.sender.send_many(results)
+        self.assertEqual(self.decode(self.conn.sendall.call_args[0][0]), results)
+        # each connection encrypted its own copy of the packets
+        self.assertEqual(self.decode(other.sendall.call_args[0][0], other_iv), results)
+
+    def test_chunks(self):
+        results = [(b'host', None, 0, b'output %d' % i) for i in range(7)]
+        self.sender.send_many(results, chunk_size=3)
+        self.assertEqual(self.conn.sendall.call_count, 3)
+        sent = b''.join(args[0] for args, _ in self.conn.sendall.call_args_list)
+        self.assertEqual(self.decode(sent), [(b'host', b'', 0, b'output %d' % i) for i in range(7)])
+
+    def test_failed_chunk_says_how_many_were_sent(self):
+        self.sender.reconnect = False
+        self.conn.sendall.side_effect = [None, socket.error('connection reset')]
+        results = [(b'host', b'service', 9, b'bad')] + [(b'host', None, 0, b'output %d' % i) for i in range(7)]
+        with self.assertRaises(socket.error) as cm:
+            self.sender.send_many(results, chunk_size=3)
+        self.assertEqual(cm.exception.sent, 3)
+
+    def test_validation_errors(self):
+        results = [
+            (b'host', b'service', 0, b'ok'),
+            (b'host', b'service', 7, b'bad state'),
+            (b'host', b'service', 0),
+            (b'host', b'service', 1, b'warning'),
+        ]
+        errors = self.sender.send_many(results)
+        self.assertEqual([(index, result) for index, result, _ in errors], [(1, results[1]), (2, results[2])])
+        self.assertEqual(self.decode(self.conn.sendall.call_args[0][0]), [results[0], results[3]])
+
+    def test_nothing_valid_does_not_connect(self):
+        self.sender.send_many([(b'host', b'service', 9, b'bad')])
+        self.assertFalse(self.sender.connect.called)
+        self.assertFalse(self.conn.sendall.called)
@@ -0,0 +1,72 @@
+import multiprocessing
+import os
+import socket
+
+import mock
+from unittest2 import TestCase, skipUnless
+
+from send_nsca import nsca
+from send_nsca import sharded
+
+try:
+    fork_context = multiprocessing.get_context('fork')
+except (AttributeError, ValueError):
+    fork_context = multiprocessing if hasattr(os, 'fork') else None
+
+
+class TestShardFor(TestCase):
+    def test_stable_and_in_range(self):
+        self.assertEqual(sharded.shard_for(b'host', b'service', 8), sharded.shard_for(b'host', b'service', 8))
+        shards = set(sharded.shard_for(b'host%d' % i, b'service', 4) for i in range(100))
+        self.assertEqual(shards, set(range(4)))
+
+
+@skipUnless(fork_context, "workers inherit the patched sender through fork()")
+class TestShardedNscaSender(TestCase):
+    def setUp(self):
+        # what each worker sends comes back to us through this queue
+        self.sent = fork_context.Queue()
+
+        def send_many(sender, batch):
+            for result in batch:
+                if result[3] == b'fail':
+                    raise socket.error('nope')
+            self.sent.put(list(batch))
+            return []
+        p = mock.patch.object(nsca.NscaSender, 'send_many', autospec=True, side_effect=send_many)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def make_sender(self, **kwargs):
+        return sharded.ShardedNscaSender('test', config_path=None, mp_context=fork_context, **kwargs)
+
+    def drain(self):
+        batches = []
+        while not self.sent.empty():
+            batches.append(self.sent.get(timeout=1))
+        return batches
+
+    def test_preserves_order_per_key(self):
+        s = self.make_sender(processes=3, batch_size=7)
+        results = [(b'host%d' % (i % 5), b'service', 0, b'%d' % i) for i in range(100)]
+        self.assertEqual(s.send_many(results), [])
+        stats = s.close()
+        self.assertEqual(stats['sent'], 100)
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual(len(stats['workers']), 3)
+        sent = sum(self.drain(), [])
+        self.assertEqual(sorted(sent), sorted(results))
+        for host in set(result[0] for result in results):
+            self.assertEqual([r for r in sent if r[0] == host], [r for r in results if r[0] == host])
+
+    def test_validation_and_failures(self):
+        s = self.make_sender(processes=2, batch_size=1)
+        errors = s.send_many([(b'host', b'a', 0, b'ok'), (b'host', b'b', 7, b'bad'), (b'host', b'c', 0, b'fail')])
+        self.assertEqual([index for index, _, _ in errors], [1])
+        stats = s.close()
+        self.assertEqual((stats['sent'], stats['failed'], stats['batches']), (1, 1, 2))
+        self.assertRaises(ValueError, s.send_host, b'host', 0, b'too late')
+
+    def test_close_without_sending(self):
+        stats = self.make_sender(processes=2).close()
+        self.assertEqual((stats['sent'], stats['failed']), (0, 0))
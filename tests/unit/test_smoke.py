@@ -20,3 +20,25 @@ class SmokeTestCase(TestCase):
         with mock.patch('send_nsca.nsca.get_random_alphanumeric_bytes', mock_random_alphanumeric_bytes):
             for args, result in vectors:
                 self.assertEqual(send_nsca.nsca._pack_packet(*args), result)
+
+    def test_packet_builder_reuse(self):
+        builder = send_nsca.nsca.PacketBuilder(padding=mock_random_alphanumeric_bytes)
+        long_packet = builder.build(b"h" * 64, b"s" * 128, 2, b"o" * 512, 1234)
+        short_packet = builder.build(b"test_host", b"test_service", 0, b"foo", 0)
+        self.assertEqual(len(long_packet), send_nsca.nsca._data_packet_size)
+        with mock.patch('send_nsca.nsca.get_random_alphanumeric_bytes', mock_random_alphanumeric_bytes):
+            self.assertEqual(short_packet, send_nsca.nsca._pack_packet(b"test_host", b"test_service", 0, b"foo", 0))
+
+    def test_packet_builder_pack_into(self):
+        builder = send_nsca.nsca.PacketBuilder(padding=mock_random_alphanumeric_bytes)
+        size = send_nsca.nsca._data_packet_size
+        buf = bytearray(b'\xff' * (size * 2))
+        builder.pack_into(buf, size, b"test_host", b"test_service", 0, b"foo", 0)
+        self.assertEqual(bytes(buf[:size]), b'\xff' * size)
+        self.assertEqual(bytes(buf[size:]), builder.build(b"test_host", b"test_service", 0, b"foo", 0))
+
+    def test_packet_builder_build_into(self):
+        builder = send_nsca.nsca.PacketBuilder(padding=mock_random_alphanumeric_bytes)
+        buf = builder.build_into(b"test_host", b"test_service", 0, b"foo", 0)
+        self.assertIs(buf, builder.buffer)
+        self.assertEqual(bytes(buf), builder.build(b"test_host", b"test_service", 0, b"foo", 0))
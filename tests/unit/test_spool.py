@@ -0,0 +1,195 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+import mock
+from unittest2 import TestCase
+
+from send_nsca import nsca
+from send_nsca import spool
+
+
+class TestSpool(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'spool')
+
+    def make_spool(self, **kwargs):
+        s = spool.Spool(self.path, **kwargs)
+        self.addCleanup(s.close)
+        return s
+
+    def replay(self, s, **kwargs):
+        batches = []
+        s.replay(lambda results, destination: batches.append(results), **kwargs)
+        return batches
+
+    def test_round_trip(self):
+        s = self.make_spool(fsync=spool.FSYNC_ALWAYS)
+        s.append(b'host', b'service', 2, b'output')
+        s.append(b'host', b'', 0, b'')
+        self.assertEqual(len(s), 2)
+        self.assertEqual(os.path.getsize(self.path), 2 * spool.RECORD_SIZE)
+        self.assertEqual(self.replay(s), [[(b'host', b'service', 2, b'output'), (b'host', b'', 0, b'')]])
+        self.assertEqual(len(s), 0)
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_survives_restart(self):
+        s = self.make_spool(fsync=spool.FSYNC_ALWAYS)
+        s.append(b'host', b'service', 1, b'still here')
+        s.close()
+        s = self.make_spool()
+        self.assertEqual(len(s), 1)
+        self.assertEqual(self.replay(s), [[(b'host', b'service', 1, b'still here')]])
+
+    def test_timestamp_order_batches_and_max_age(self):
+        s = self.make_spool(max_age=30)
+        now = time.time()
+        s.append(b'host', b'', 0, b'second', timestamp=now - 5)
+        s.append(b'host', b'', 0, b'too old', timestamp=now - 60)
+        s.append(b'host', b'', 0, b'first', timestamp=now - 10)
+        s.append(b'host', b'', 0, b'third', timestamp=now)
+        batches = self.replay(s, batch_size=2)
+        self.assertEqual([[output for _, _, _, output in batch] for batch in batches], [[b'first', b'second'], [b'third']])
+        self.assertEqual(s.dropped, 1)
+
+    def test_max_bytes(self):
+        s = self.make_spool(max_bytes=spool.RECORD_SIZE * 2)
+        self.assertEqual(s.extend([(b'host', b'', 0, b'%d' % i) for i in range(3)]), 2)
+        self.assertFalse(s.append(b'host', b'', 0, b'no room'))
+        self.assertEqual(len(s), 2)
+        self.assertEqual(s.dropped, 2)
+
+    def test_skips_torn_records(self):
+        s = self.make_spool(fsync=spool.FSYNC_ALWAYS)
+        s.append(b'host', b'', 0, b'intact')
+        with open(self.path, 'ab') as f:
+            f.write(b'\0' * (spool.RECORD_SIZE + 10))
+        self.assertEqual(self.replay(s), [[(b'host', b'', 0, b'intact')]])
+
+    def test_reopen_cuts_off_torn_record(self):
+        s = self.make_spool(fsync=spool.FSYNC_ALWAYS)
+        s.append(b'host', b'', 0, b'before')
+        s.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'NSP1' + b'\0' * 100)
+        s = self.make_spool(fsync=spool.FSYNC_ALWAYS)
+        self.assertEqual(os.path.getsize(self.path), spool.RECORD_SIZE)
+        s.append(b'host', b'', 2, b'after')
+        self.assertEqual(self.replay(s), [[(b'host', b'', 0, b'before'), (b'host', b'', 2, b'after')]])
+
+    def test_failed_replay_keeps_the_rest(self):
+        s = self.make_spool()
+        s.extend([(b'host', b'', 0, b'%d' % i) for i in range(5)])
+        sent = []
+
+        def send_batch(batch, destination):
+            if sent:
+                raise socket.error('gone again')
+            sent.append(batch)
+        self.assertRaises(socket.error, s.replay, send_batch, batch_size=2)
+        self.assertEqual(len(s), 3)
+        self.assertEqual([output for _, _, _, output in self.replay(s)[0]], [b'2', b'3', b'4'])
+
+    def test_destinations(self):
+        s = self.make_spool()
+        s.append(b'host', b'', 0, b'everyone')
+        s.append(b'host', b'', 1, b'one', destination='10.0.0.2')
+        s.append(b'host', b'', 2, b'other', destination='10.0.0.3')
+        batches = []
+        s.replay(lambda results, destination: batches.append((destination, results)))
+        self.assertEqual(batches, [
+            (None, [(b'host', b'', 0, b'everyone')]),
+            ('10.0.0.2', [(b'host', b'', 1, b'one')]),
+            ('10.0.0.3', [(b'host', b'', 2, b'other')]),
+        ])
+
+    def test_partly_failed_replay_keeps_only_what_was_missed(self):
+        s = self.make_spool()
+        s.extend([(b'host', b'', 0, b'%d' % i) for i in range(3)])
+        sent = []
+
+        def send_batch(batch, destination):
+            sent.append((destination, batch))
+            if destination is None and not sent[1:]:
+                raise nsca.PartialSendError('one of them is down', ['10.0.0.2'])
+        s.replay(send_batch, batch_size=2)
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(len(s), 2)
+        del sent[:]
+        s.replay(send_batch)
+        self.assertEqual(sent, [('10.0.0.2', [(b'host', b'', 0, b'0'), (b'host', b'', 0, b'1')])])
+        self.assertEqual(len(s), 0)
+
+    def test_bad_fsync_policy(self):
+        self.assertRaises(ValueError, spool.Spool, self.path, fsync='sometimes')
+
+
+class TestSpoolingSender(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.spool = spool.Spool(os.path.join(directory, 'spool'))
+        self.addCleanup(self.spool.close)
+        self.sender = nsca.NscaSender(remote_host='test', config_path=None, spool=self.spool)
+        self.sent = []
+        p = mock.patch.object(self.sender, '_send_chunk',
+                              side_effect=lambda chunk, destination=None: self.sent.extend(chunk))
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_spools_while_down_and_replays_first(self):
+        with mock.patch.object(self.sender, 'connect', side_effect=socket.error('down')):
+            self.sender.send_service(b'host', b'service', 2, b'down')
+            self.assertEqual(self.sender.send_many([(b'host', b'other', 2, b'also down')]), [])
+        self.assertEqual(len(self.spool), 2)
+        with mock.patch.object(self.sender, 'connect'):
+            with mock.patch.object(self.sender, '_send_to_conns') as mock_send:
+                self.sender.send_service(b'host', b'service', 0, b'up')
+        self.assertEqual(self.sent, [(b'host', b'service', 2, b'down'), (b'host', b'other', 2, b'also down')])
+        self.assertEqual(mock_send.call_count, 1)
+        self.assertEqual(len(self.spool), 0)
+
+    def test_no_spool_raises(self):
+        self.sender.spool = None
+        with mock.patch.object(self.sender, 'connect', side_effect=socket.error('down')):
+            self.assertRaises(socket.error, self.sender.send_service, b'host', b'service', 2, b'down')
+
+
+class TestSpoolingToSeveralServers(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.spool = spool.Spool(os.path.join(directory, 'spool'))
+        self.addCleanup(self.spool.close)
+        self.sender = nsca.NscaSender(remote_host='test', config_path=None, spool=self.spool, reconnect=False)
+        self.sender.Crypter = nsca.NullCrypter
+        self.sender._connected = True
+        self.good_conn = self.add_conn(mock.Mock(), '10.0.0.1')
+        self.bad_conn = self.add_conn(mock.Mock(**{'sendall.side_effect': socket.error('broken pipe')}), '10.0.0.2')
+
+    def add_conn(self, conn, address):
+        self.sender._conns.append((conn, b'iv', 1000))
+        self.sender._handshake_times[conn] = self.sender._last_used[conn] = time.time()
+        self.sender._conn_addrs[conn] = (socket.AF_INET, socket.SOCK_STREAM, socket.SOL_TCP, (address, nsca.DEFAULT_PORT))
+        self.sender._cached_crypters[conn] = nsca.NullCrypter(b'iv', b'', None)
+        return conn
+
+    def test_only_the_failed_server_gets_a_replay(self):
+        self.sender.send_service(b'host', b'service', 2, b'first')
+        self.assertEqual(len(self.spool), 1)
+        self.sender.send_many([(b'host', b'service', 0, b'second'), (b'host', b'other', 0, b'third')])
+        # the healthy server got each result exactly once
+        self.assertEqual(self.good_conn.sendall.call_count, 2)
+        self.assertEqual(len(self.spool), 3)
+        self.bad_conn.sendall.side_effect = None
+        self.bad_conn.sendall.reset_mock()
+        self.sender.send_host(b'host', 0, b'fourth')
+        self.assertEqual(self.good_conn.sendall.call_count, 3)
+        # the spooled results, then the new one
+        self.assertEqual([len(call[0][0]) // nsca._data_packet_size for call in self.bad_conn.sendall.call_args_list],
+                         [3, 1])
+        self.assertEqual(len(self.spool), 0)
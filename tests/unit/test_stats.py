@@ -0,0 +1,73 @@
+import socket
+
+import mock
+from unittest2 import TestCase
+
+from send_nsca import fake_server
+from send_nsca import nsca
+from send_nsca import resolver
+from send_nsca import stats
+
+
+class TestInMemoryStats(TestCase):
+    def test_counters_and_timings(self):
+        s = stats.InMemoryStats(max_timings=100)
+        s.incr('things')
+        s.incr('things', 4)
+        for i in range(1, 201):
+            s.timing('took', i / 1000.0)
+        self.assertEqual(s.counters['things'], 5)
+        # only the most recent 100 are kept
+        self.assertEqual(s.percentile('took', 50), 0.15)
+        self.assertIsNone(s.percentile('missing', 50))
+        summary = s.summary()
+        self.assertEqual(summary['counters'], {'things': 5})
+        self.assertEqual(summary['timings']['took']['count'], 100)
+        self.assertEqual(summary['timings']['took']['max'], 0.2)
+        s.reset()
+        self.assertEqual(s.summary(), {'counters': {}, 'timings': {}})
+
+
+class TestSenderStats(TestCase):
+    def setUp(self):
+        resolver.default_cache.clear()
+        self.server = fake_server.ThreadedNscaServer(password=b'TestingPassword', crypt_id=3).start()
+        self.addCleanup(self.server.stop)
+        self.stats = stats.InMemoryStats()
+        self.sender = nsca.NscaSender('127.0.0.1', config_path=None, port=self.server.port, stats=self.stats)
+        self.sender.Crypter = nsca.DES3Crypter
+        self.sender.password = b'TestingPassword'
+        self.addCleanup(self.sender.disconnect)
+
+    def test_instruments_sends(self):
+        self.sender.send_service(b'host', b'service', 0, b'one')
+        self.sender.send_many([(b'host', b'service', 0, b'%d' % i) for i in range(3)] + [(b'host', b'service', 9, b'bad')])
+        self.assertRaises(ValueError, self.sender.send_host, u'host', 0, b'unicode host')
+        self.assertTrue(self.server.wait_for(4))
+        counters = self.stats.counters
+        self.assertEqual(counters[stats.PACKETS_SENT], 4)
+        self.assertEqual(counters[stats.BYTES_SENT], 4 * nsca._data_packet_size)
+        self.assertEqual(counters[stats.VALIDATION_FAILURES], 2)
+        timings = self.stats.summary()['timings']
+        for name in (stats.DNS, stats.CONNECT, stats.HANDSHAKE):
+            self.assertEqual(timings[name]['count'], 1, name)
+        for name in (stats.PACK, stats.ENCRYPT, stats.SENDALL):
+            self.assertEqual(timings[name]['count'], 2, name)
+
+    def test_counts_failures(self):
+        with mock.patch('socket.getaddrinfo', side_effect=socket.gaierror('no such host')):
+            self.assertRaises(socket.error, self.sender.send_host, b'host', 0, b'')
+        self.assertEqual(self.stats.counters[stats.DNS_FAILURES], 1)
+        # forget the negatively-cached failure
+        resolver.default_cache.clear()
+        self.sender.connect()
+        with mock.patch.object(self.sender, '_peer_closed', return_value=True):
+            self.sender.send_host(b'host', 0, b'')
+        self.assertEqual(self.stats.counters[stats.RECONNECTS], 1)
+
+    def test_no_stats(self):
+        self.sender.stats = None
+        self.sender.send_host(b'host', 0, b'')
+        self.sender.send_many([(b'host', None, 0, b'')])
+        self.assertTrue(self.server.wait_for(2))
+        self.assertEqual(self.stats.summary(), {'counters': {}, 'timings': {}})